@@ -0,0 +1,317 @@
+"""
+(c) 2012-2024 Martin Wendt; see https://github.com/mar10/pyftpsync
+Licensed under the MIT license: https://www.opensource.org/licenses/mit-license.php
+
+Asyncio support.
+
+The targets and synchronizers of pyftpsync are blocking. This module runs them
+on a bounded set of connections, each one served by a dedicated thread, so
+they can be awaited from an asyncio event loop::
+
+    s = AsyncBiDirSynchronizer(local, remote, {"resolve": "local", "workers": 8})
+    await s.run()
+"""
+
+import asyncio
+import contextlib
+import copy
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+from posixpath import join as join_url
+from posixpath import normpath as normpath_url
+
+from ftpsync.synchronizers import (
+    BiDirSynchronizer,
+    DownloadSynchronizer,
+    UploadSynchronizer,
+)
+from ftpsync.util import write_error
+
+
+async def _gather(tasks):
+    """Wait for all tasks, but cancel the others as soon as one fails."""
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+class _AsyncConnection:
+    """A target instance that is only accessed by its own thread.
+
+    Targets must be opened and closed by the same thread, and cannot be
+    used concurrently anyway.
+    """
+
+    def __init__(self, target):
+        self.target = target
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="pyftpsync-aio"
+        )
+
+    def __str__(self):
+        return f"_AsyncConnection<{self.target}>"
+
+    async def run(self, func, *args):
+        """Call `func(*args)` in the connection's thread."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def close(self):
+        try:
+            await self.run(self.target.close)
+        finally:
+            self._executor.shutdown(wait=False)
+
+
+# ===============================================================================
+# AsyncTarget
+# ===============================================================================
+class AsyncTarget:
+    """Asyncio wrapper for a :class:`ftpsync.targets._Target`.
+
+    The wrapped target is opened by :meth:`open` (and so writes the lock file,
+    if any). All other operations are executed by clones of the target (see
+    :meth:`ftpsync.targets._Target.clone`), i.e. by up to `connections`
+    additional connections, which are opened on demand.
+
+    Args:
+        target (:class:`ftpsync.targets._Target`): unconnected target
+        connections (int): maximum number of additional connections
+    """
+
+    def __init__(self, target, connections=4):
+        assert connections > 0
+        self.target = target
+        self.connections = connections
+        self._primary = None
+        #: All clones that were opened so far
+        self._conns = []
+        #: Clones that are currently not borrowed
+        self._idle = []
+        self._sem = None
+
+    def __str__(self):
+        return f"AsyncTarget<{self.target}, connections: {len(self._conns)}>"
+
+    async def open(self):
+        # Create the semaphore here, so it is bound to the running loop
+        self._sem = asyncio.Semaphore(self.connections)
+        self._primary = _AsyncConnection(self.target)
+        await self._primary.run(self._open_primary)
+
+    def _open_primary(self):
+        target = self.target
+        target.open()
+        if getattr(target, "lock_data", None):
+            # Listing the root folder lets FTP and SFTP targets compare the
+            # lock file's mtime with our clock. The resulting `server_time_ofs`
+            # is then inherited by the clones.
+            target.get_dir()
+
+    async def close(self):
+        conns, self._conns, self._idle = self._conns, [], []
+        for conn in conns:
+            try:
+                await conn.close()
+            except Exception as e:
+                write_error(f"Could not close {conn}: {e!r}")
+        if self._primary:
+            try:
+                await self._primary.close()
+            finally:
+                self._primary = None
+
+    @staticmethod
+    def _cwd(target, rel_path):
+        path = normpath_url(join_url(target.root_dir, rel_path))
+        if target.cur_dir != path:
+            target.cwd(path)
+
+    @contextlib.asynccontextmanager
+    async def connection(self, rel_path=None):
+        """Borrow a connection, optionally positioned at `rel_path`.
+
+        Examples:
+            async with atarget.connection("folder1") as conn:
+                entries = await conn.run(conn.target.get_dir)
+        """
+        assert self._sem, "AsyncTarget is not open"
+        await self._sem.acquire()
+        try:
+            if self._idle:
+                conn = self._idle.pop()
+            else:
+                conn = _AsyncConnection(self.target.clone())
+                try:
+                    await conn.run(conn.target.open)
+                except BaseException:
+                    await conn.close()
+                    raise
+                self._conns.append(conn)
+        except BaseException:
+            self._sem.release()
+            raise
+
+        try:
+            if rel_path is not None:
+                await conn.run(self._cwd, conn.target, rel_path)
+            yield conn
+        finally:
+            # Pending calls of a cancelled task are still executed first,
+            # because every connection has a single thread
+            self._idle.append(conn)
+            self._sem.release()
+
+    async def get_dir(self, rel_path=""):
+        """Return a list of entries of the `rel_path` folder."""
+        async with self.connection(rel_path) as conn:
+            return await conn.run(conn.target.get_dir)
+
+    @contextlib.asynccontextmanager
+    async def open_readable(self, rel_path, name):
+        """Yield a file-like object with the content of `rel_path/name`.
+
+        The content is read into memory, so the connection is released
+        immediately.
+        """
+        async with self.connection(rel_path) as conn:
+            data = await conn.run(self._read_bytes, conn.target, name)
+        with io.BytesIO(data) as fp:
+            yield fp
+
+    @staticmethod
+    def _read_bytes(target, name):
+        fp = target.open_readable(name)
+        try:
+            return fp.read()
+        finally:
+            fp.close()
+
+    async def write_file(self, rel_path, name, fp_src, blocksize=None, callback=None):
+        """Write binary data from file-like to `rel_path/name`."""
+        async with self.connection(rel_path) as conn:
+            target = conn.target
+            if blocksize is None:
+                blocksize = target.DEFAULT_BLOCKSIZE
+            await conn.run(target.write_file, name, fp_src, blocksize, callback)
+
+
+# ===============================================================================
+# AsyncSynchronizer
+# ===============================================================================
+class AsyncSynchronizer:
+    """Run a synchronizer as asyncio tasks.
+
+    Every folder is processed by a task that borrows a local and a remote
+    connection, lists both in parallel, and then runs the synchronizer's
+    handlers for the entries of this folder in the connection's thread.
+    This reuses :meth:`ftpsync.synchronizers.BaseSynchronizer._sync_entries`,
+    so the results are the same as with the blocking `run()`.
+    Sub-folders are then processed concurrently.
+
+    The `workers` option defines the number of connections per target
+    (limited by `max_connections`).
+    Interactive conflict resolution (`resolve: "ask"`) is not supported.
+    """
+
+    #: The synchronizer class that implements the handlers
+    synchronizer_class = None
+
+    def __init__(self, local, remote, options):
+        self.sync = self.synchronizer_class(local, remote, options)
+        self.options = self.sync.options
+        if self.options.get("resolve") == "ask":
+            raise RuntimeError(
+                "Interactive conflict resolution is not supported by the asyncio "
+                "engine: pass `resolve`"
+            )
+        connections = max(1, self.sync._get_worker_count())
+        self.local = AsyncTarget(local, connections)
+        self.remote = AsyncTarget(remote, connections)
+        #: Synchronizer copies, bound to a pair of clones {(id, id): synchronizer}
+        self._views = {}
+
+    def __str__(self):
+        return f"{self.__class__.__name__}<{self.local}, {self.remote}>"
+
+    def get_stats(self):
+        return self.sync.get_stats()
+
+    async def run(self):
+        sync = self.sync
+        start = time.time()
+        try:
+            sync._bind_targets()
+            await self.local.open()
+            await self.remote.open()
+            await self._sync_dir("")
+        finally:
+            sync._unbind_targets()
+            try:
+                await self.local.close()
+            finally:
+                await self.remote.close()
+                self._views = {}
+        sync._finalize_stats(start)
+        return True
+
+    def _get_view(self, local, remote):
+        """Return a copy of the synchronizer that is bound to two clones.
+
+        Copies share the options and stats of the original synchronizer.
+        """
+        key = (id(local), id(remote))
+        view = self._views.get(key)
+        if view is None:
+            view = copy.copy(self.sync)
+            view.local = local
+            view.remote = remote
+            self._views[key] = view
+        local.synchronizer = remote.synchronizer = view
+        local.peer = remote
+        remote.peer = local
+        return view
+
+    async def _sync_dir(self, rel_path):
+        # Connections are always borrowed in the same order (local, remote)
+        # and released before we recurse, so we cannot dead-lock
+        async with self.local.connection(rel_path) as local_conn:
+            async with self.remote.connection(rel_path) as remote_conn:
+                local, remote = local_conn.target, remote_conn.target
+                view = self._get_view(local, remote)
+                local_entries, remote_entries = await asyncio.gather(
+                    local_conn.run(view._get_dir_timed, local, "local_list_time"),
+                    remote_conn.run(view._get_dir_timed, remote, "remote_list_time"),
+                )
+                sub_dirs = await local_conn.run(
+                    view._sync_entries, local_entries, remote_entries
+                )
+
+        tasks = [
+            asyncio.ensure_future(self._sync_dir(join_url(rel_path, name)))
+            for name in sub_dirs
+        ]
+        await _gather(tasks)
+
+
+class AsyncBiDirSynchronizer(AsyncSynchronizer):
+    """Asyncio variant of :class:`ftpsync.synchronizers.BiDirSynchronizer`."""
+
+    synchronizer_class = BiDirSynchronizer
+
+
+class AsyncUploadSynchronizer(AsyncSynchronizer):
+    """Asyncio variant of :class:`ftpsync.synchronizers.UploadSynchronizer`."""
+
+    synchronizer_class = UploadSynchronizer
+
+
+class AsyncDownloadSynchronizer(AsyncSynchronizer):
+    """Asyncio variant of :class:`ftpsync.synchronizers.DownloadSynchronizer`."""
+
+    synchronizer_class = DownloadSynchronizer
@@ -0,0 +1,212 @@
+"""
+(c) 2012-2024 Martin Wendt; see https://github.com/mar10/pyftpsync
+Licensed under the MIT license: https://www.opensource.org/licenses/mit-license.php
+
+Compact binary format for directory metadata (`--meta-format binary`).
+
+The file starts with a fixed header, followed by a stream of records, which
+is optionally zlib compressed::
+
+    header:  b"PFSM" <format version: u8> <flags: u8>
+    records: <type: u8> <payload>
+
+    FILE       <name> <m: f64> <s: i64> <u: f64>   entry of "mtimes"
+    PEER       <peer id>                           following SYNC records
+                                                   belong to this peer
+    SYNC       <name> <m: f64> <s: i64> <u: f64>   entry of "peer_sync"
+    LAST_SYNC  <u: f64>                            ":last_sync" of the peer
+
+Strings are stored as <length: u32> <utf-8 bytes>, integers and floats in
+little-endian byte order. Missing values are stored as NaN (floats) or -1
+(sizes).
+
+Records are decoded while the file is read, so the (decompressed) file
+content is never held in memory as a whole.
+"""
+
+import math
+import struct
+import zlib
+
+MAGIC = b"PFSM"
+#: Incremented when the format changes
+FORMAT_VERSION = 1
+#: Header flag: the record stream is zlib compressed
+FLAG_ZLIB = 0x01
+#: Record streams larger than this are compressed
+COMPRESS_MIN_SIZE = 1024
+
+REC_FILE = 1
+REC_PEER = 2
+REC_SYNC = 3
+REC_LAST_SYNC = 4
+
+_HEADER = struct.Struct("<4sBB")
+_TYPE = struct.Struct("<B")
+_LEN = struct.Struct("<I")
+_ENTRY = struct.Struct("<dqd")
+_FLOAT = struct.Struct("<d")
+
+_READ_SIZE = 64 * 1024
+
+
+def _pack_str(s):
+    b = s.encode("utf-8")
+    return _LEN.pack(len(b)) + b
+
+
+def _pack_entry(info):
+    m = info.get("m")
+    s = info.get("s")
+    u = info.get("u")
+    return _ENTRY.pack(
+        math.nan if m is None else m,
+        -1 if s is None else s,
+        math.nan if u is None else u,
+    )
+
+
+def _unpack_entry(buf):
+    m, s, u = _ENTRY.unpack(buf)
+    return {
+        "m": None if math.isnan(m) else m,
+        "s": None if s < 0 else s,
+        "u": None if math.isnan(u) else u,
+    }
+
+
+def dumps(meta_dict, compress=None):
+    """Return the binary representation of a `DirMetadata.dir` dict.
+
+    Args:
+        meta_dict (dict): {"mtimes": {...}, "peer_sync": {...}}
+        compress (bool, optional): default: compress if the record stream
+            is larger than :data:`COMPRESS_MIN_SIZE`
+    Returns:
+        bytes
+    """
+    parts = []
+    for name, info in meta_dict.get("mtimes", {}).items():
+        parts.append(_TYPE.pack(REC_FILE) + _pack_str(name) + _pack_entry(info))
+    for peer_id, peer_info in meta_dict.get("peer_sync", {}).items():
+        parts.append(_TYPE.pack(REC_PEER) + _pack_str(peer_id))
+        for name, info in peer_info.items():
+            if name == ":last_sync":
+                parts.append(_TYPE.pack(REC_LAST_SYNC) + _FLOAT.pack(info))
+            elif not name.startswith(":"):
+                parts.append(
+                    _TYPE.pack(REC_SYNC) + _pack_str(name) + _pack_entry(info)
+                )
+    body = b"".join(parts)
+    if compress is None:
+        compress = len(body) > COMPRESS_MIN_SIZE
+    flags = 0
+    if compress:
+        flags |= FLAG_ZLIB
+        body = zlib.compress(body)
+    return _HEADER.pack(MAGIC, FORMAT_VERSION, flags) + body
+
+
+class RecordReader:
+    """Iterate over the records of a binary metadata file.
+
+    Yields (record_type, name, value) tuples, where `value` is an
+    {"m", "s", "u"} dict for FILE and SYNC records, a float for LAST_SYNC
+    records and None otherwise.
+
+    Args:
+        fp (file-like): opened for reading bytes
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.decompressor = None
+        self.buf = b""
+        self.pos = 0
+        self.eof = False
+        #: Number of bytes that were read from `fp` so far
+        self.bytes_read = 0
+
+        try:
+            header = self._read(_HEADER.size)
+        except ValueError:
+            raise ValueError("Not a binary metadata file") from None
+        magic, version, flags = _HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ValueError("Not a binary metadata file")
+        elif version != FORMAT_VERSION:
+            raise ValueError(f"Unsupported binary metadata version: {version}")
+        if flags & FLAG_ZLIB:
+            self.decompressor = zlib.decompressobj()
+            self.buf = self.decompressor.decompress(self.buf[self.pos :])
+            self.pos = 0
+
+    def _fill(self):
+        """Append the next chunk to the buffer (return False at the end)."""
+        if self.eof:
+            return False
+        chunk = self.fp.read(_READ_SIZE)
+        self.bytes_read += len(chunk)
+        if not chunk:
+            self.eof = True
+            if self.decompressor:
+                chunk = self.decompressor.flush()
+        elif self.decompressor:
+            chunk = self.decompressor.decompress(chunk)
+        self.buf = self.buf[self.pos :] + chunk
+        self.pos = 0
+        return True
+
+    def _read(self, n, at_start=False):
+        """Return exactly `n` bytes.
+
+        Only a record start (`at_start`) may hit a clean end of the stream, which
+        returns b"". Raise ValueError if the stream ends inside a record.
+        """
+        while len(self.buf) - self.pos < n:
+            if not self._fill():
+                if at_start and self.pos == len(self.buf):
+                    return b""
+                raise ValueError("Truncated metadata record")
+        res = self.buf[self.pos : self.pos + n]
+        self.pos += n
+        return res
+
+    def __iter__(self):
+        read = self._read
+        while True:
+            rec_type = read(1, True)
+            if not rec_type:
+                return
+            rec_type = rec_type[0]
+            if rec_type == REC_LAST_SYNC:
+                yield rec_type, None, _FLOAT.unpack(read(_FLOAT.size))[0]
+                continue
+            (size,) = _LEN.unpack(read(_LEN.size))
+            name = read(size).decode("utf-8")
+            if rec_type == REC_PEER:
+                yield rec_type, name, None
+            elif rec_type in (REC_FILE, REC_SYNC):
+                yield rec_type, name, _unpack_entry(read(_ENTRY.size))
+            else:
+                raise ValueError(f"Invalid metadata record type: {rec_type}")
+
+
+def load(fp):
+    """Return a (`DirMetadata.dir` dict, byte count) tuple from a binary file."""
+    mtimes = {}
+    peer_sync = {}
+    peer = None
+    reader = RecordReader(fp)
+    for rec_type, name, value in reader:
+        if rec_type == REC_FILE:
+            mtimes[name] = value
+        elif rec_type == REC_PEER:
+            peer = peer_sync.setdefault(name, {})
+        elif peer is None:
+            raise ValueError("Missing peer record")
+        elif rec_type == REC_SYNC:
+            peer[name] = value
+        else:
+            peer[":last_sync"] = value
+    return {"mtimes": mtimes, "peer_sync": peer_sync}, reader.bytes_read
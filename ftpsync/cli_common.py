@@ -63,6 +63,29 @@ common_parser.add_argument(
     "--ftp-active", action="store_true", help="use Active FTP mode instead of passive"
 )
 
+common_parser.add_argument(
+    "--fxp",
+    action="store_true",
+    help="when both targets are FTP servers, let them transfer files directly "
+    "(FXP: PASV on the source, PORT on the destination), relaying the data "
+    "if one of the servers refuses",
+)
+
+common_parser.add_argument(
+    "--delta",
+    action="store_true",
+    help="send only the changed blocks of modified files (like rsync), if both "
+    "targets are local folders or SFTP servers that can run `python3`",
+)
+
+common_parser.add_argument(
+    "--compare-content",
+    action="store_true",
+    help="compare the content of equally sized files that differ in "
+    "modification time or were modified on both sides, and treat equal "
+    "files as unchanged (uses server side checksums if available)",
+)
+
 common_parser.add_argument(
     "--migrate",
     action="store_true",
@@ -71,12 +94,173 @@ common_parser.add_argument(
     "with current format. Existing data will be discarded",
 )
 
+common_parser.add_argument(
+    "--workers",
+    type=int,
+    default=1,
+    help="number of parallel file transfers; every worker opens its own "
+    "connection (default: %(default)s)",
+)
+
+common_parser.add_argument(
+    "--transfer-order",
+    choices=["listing", "smallest", "largest", "newest"],
+    default="listing",
+    help="order of the file transfers in a directory (default: %(default)s)",
+)
+
+common_parser.add_argument(
+    "--large-file-size",
+    type=int,
+    default=16 * 1024 * 1024,
+    metavar="BYTES",
+    help="files of this size or larger are transferred by the "
+    "--large-file-workers (default: %(default)s)",
+)
+
+common_parser.add_argument(
+    "--large-file-workers",
+    type=int,
+    default=0,
+    metavar="N",
+    help="number of --workers that are reserved for large files, so small "
+    "files are not blocked by them (default: %(default)s)",
+)
+
+common_parser.add_argument(
+    "--max-connections",
+    type=int,
+    help="maximum number of connections per server, including the main "
+    "connection (limits --workers, default: unlimited)",
+)
+
+common_parser.add_argument(
+    "--keepalive",
+    type=float,
+    default=60,
+    help="send a keepalive request on connections that are idle for "
+    "KEEPALIVE seconds, reconnecting if necessary (0: off, default: %(default)s)",
+)
+
+common_parser.add_argument(
+    "--prefetch",
+    action="store_true",
+    help="list sub-directories in the background, using a secondary "
+    "connection per target",
+)
+
+common_parser.add_argument(
+    "--stat-index",
+    action="store_true",
+    help="UNSAFE: cache listings of local directories in the root folder and "
+    "re-use them while a directory's mtime is unchanged, without calling "
+    "stat() for its files. Files that are modified in place (instead of "
+    "being replaced) by other applications are NOT detected",
+)
+
+common_parser.add_argument(
+    "--hash-cache",
+    action="store_true",
+    help="store digests of local files in the root folder (re-used while a "
+    "file's inode, size, and mtime are unchanged), so `--compare-content` "
+    "does not read unchanged files again and recognizes files that were "
+    "only touched since the last synchronization",
+)
+
+common_parser.add_argument(
+    "--trust-cache",
+    action="store_true",
+    help="cache listings of remote directories in the user's cache folder and "
+    "re-use them while the parent listing reports an unchanged modify time "
+    "(changes that other clients made below unchanged directories are not "
+    "detected)",
+)
+common_parser.add_argument(
+    "--refresh-cache",
+    action="store_true",
+    help="list all remote directories and rewrite the cache that is used by "
+    "--trust-cache",
+)
+
+common_parser.add_argument(
+    "--list-tree",
+    action="store_true",
+    help="list the whole remote tree with one request when the target is "
+    "opened (FTP: LIST -R or STAT -R, SFTP: `find` on an exec channel), if the "
+    "server supports it. "
+    "FTP listings report modification times in the server's local time "
+    "(converted using the MLSD listing of the root folder; if no recent file "
+    "allows this, MLSD is used for every directory) with a resolution of one "
+    "minute (one day for files older than six months), so this is mainly "
+    "useful for the scan and tree commands and for files that were uploaded "
+    "by pyftpsync",
+)
+
+common_parser.add_argument(
+    "--manifest",
+    action="store_true",
+    help="store the metadata of all remote directories in one file in the "
+    "remote root folder, instead of one .pyftpsync-meta.json per directory",
+)
+
+common_parser.add_argument(
+    "--meta-format",
+    choices=["json", "binary"],
+    default="json",
+    help="format of the metadata files that are written (default: %(default)s); "
+    "files in the other format are converted when a directory is synchronized",
+)
+
+common_parser.add_argument(
+    "--meta-journal",
+    action="store_true",
+    help="append metadata changes to a journal file instead of rewriting the "
+    "metadata file of a directory (the journal is merged when it grows large)",
+)
+
+common_parser.add_argument(
+    "--resume",
+    action="store_true",
+    help="copy large files to a temporary part file first, so interrupted "
+    "transfers are resumed by the next run",
+)
+
+plan_group = common_parser.add_mutually_exclusive_group()
+plan_group.add_argument(
+    "--write-plan",
+    metavar="FILE",
+    help="don't synchronize, but write the resulting operations to FILE "
+    "(JSON lines)",
+)
+plan_group.add_argument(
+    "--execute-plan",
+    metavar="FILE",
+    help="perform the operations of a plan that was written by --write-plan "
+    "(entries that were modified in the meantime are skipped)",
+)
+
 common_parser.add_argument(
     "--no-verify-host-keys",
     action="store_true",
     help="do not check SFTP connection against `~/.ssh/known_hosts`",
 )
 
+common_parser.add_argument(
+    "--sftp-block-size",
+    type=int,
+    metavar="BYTES",
+    help="size of the SFTP read and write requests; many requests are kept "
+    "in flight per file (default: 32768, some servers accept up to 262144)",
+)
+
+common_parser.add_argument(
+    "--sftp-window-size",
+    type=int,
+    metavar="BYTES",
+    help="SSH window size of SFTP connections, i.e. how many bytes may be in "
+    "flight; raise this for links with high latency (default: 2097152)",
+)
+
 
 # --- matcher_parser ---------------------------------------------------------
 
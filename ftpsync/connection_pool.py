@@ -0,0 +1,164 @@
+"""
+(c) 2012-2024 Martin Wendt; see https://github.com/mar10/pyftpsync
+Licensed under the MIT license: https://www.opensource.org/licenses/mit-license.php
+"""
+
+import contextlib
+import threading
+import time
+
+from ftpsync.util import write, write_error
+
+#: Default interval (seconds) for keepalive requests on idle connections
+DEFAULT_KEEPALIVE = 60
+
+
+# ===============================================================================
+# ConnectionPool
+# ===============================================================================
+class ConnectionPool:
+    """Opened clones of a target that can be borrowed by worker threads.
+
+    Connections are opened on demand (see :meth:`ftpsync.targets._Target.clone`)
+    and returned to the pool after use, so the login overhead is only paid
+    once per connection.
+    A background thread calls :meth:`ftpsync.targets._Target.keepalive` on
+    connections that have been idle for `keepalive` seconds. This also
+    re-establishes dropped connections (restoring the working directory).
+
+    Args:
+        target (:class:`ftpsync.targets._Target`): the primary target
+        max_size (int): maximum number of open connections (None: unlimited)
+        keepalive (float): keepalive interval in seconds (0: disable)
+    """
+
+    def __init__(self, target, max_size=None, keepalive=DEFAULT_KEEPALIVE):
+        assert max_size is None or max_size > 0
+        self.target = target
+        self.max_size = max_size
+        self.keepalive = keepalive
+        #: Protects `_idle` and `_size`
+        self._cv = threading.Condition()
+        #: List of (clone, last_used) tuples
+        self._idle = []
+        #: Number of open connections (idle or borrowed)
+        self._size = 0
+        self._closed = False
+        self._stop = threading.Event()
+        self._thread = None
+        if keepalive:
+            self._thread = threading.Thread(
+                target=self._keepalive_loop, name="pyftpsync-keepalive", daemon=True
+            )
+            self._thread.start()
+
+    def __str__(self):
+        return "ConnectionPool<{}, size: {}, idle: {}>".format(
+            self.target, self._size, len(self._idle)
+        )
+
+    def acquire(self, path=None):
+        """Return an opened clone, optionally positioned at `path`.
+
+        Idle connections that are already in `path` are preferred.
+        Blocks while `max_size` connections are in use.
+        """
+        with self._cv:
+            while True:
+                if self._closed:
+                    raise RuntimeError(f"{self} is closed")
+                if self._idle:
+                    idx = len(self._idle) - 1
+                    for i, (clone, _) in enumerate(self._idle):
+                        if clone.cur_dir == path:
+                            idx = i
+                            break
+                    clone, last_used = self._idle.pop(idx)
+                    break
+                if self.max_size is None or self._size < self.max_size:
+                    self._size += 1
+                    clone = last_used = None
+                    break
+                self._cv.wait()
+
+        try:
+            if clone is None:
+                clone = self.target.clone()
+                if self.target.get_option("verbose", 3) >= 5:
+                    write(f"{threading.current_thread().name}: open {clone}")
+                clone.open()
+            elif self.keepalive and time.monotonic() - last_used >= self.keepalive:
+                # The keepalive thread did not get here in time
+                clone.keepalive()
+            if path is not None and clone.cur_dir != path:
+                clone.cwd(path)
+        except Exception:
+            self.release(clone, discard=True)
+            raise
+        return clone
+
+    def release(self, clone, discard=False):
+        """Return a connection to the pool (or close it if `discard` is true)."""
+        with self._cv:
+            if discard or self._closed:
+                self._size -= 1
+            else:
+                self._idle.append((clone, time.monotonic()))
+                clone = None
+            self._cv.notify()
+        if clone is not None:
+            self._close_clone(clone)
+
+    @contextlib.contextmanager
+    def connection(self, path=None):
+        """Borrow a connection.
+
+        Examples:
+            with pool.connection(target.cur_dir) as clone:
+                clone.remove_file(name)
+        """
+        clone = self.acquire(path)
+        try:
+            yield clone
+        finally:
+            self.release(clone)
+
+    def close(self):
+        """Close all idle connections (borrowed ones are closed on release)."""
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        with self._cv:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cv.notify_all()
+        for clone, _ in idle:
+            self._close_clone(clone)
+
+    @staticmethod
+    def _close_clone(clone):
+        if clone is None:
+            return
+        try:
+            clone.close()
+        except Exception as e:
+            write_error(f"Could not close {clone}: {e!r}")
+
+    def _keepalive_loop(self):
+        while not self._stop.wait(self.keepalive / 2):
+            now = time.monotonic()
+            with self._cv:
+                # Stale connections are treated as borrowed while we ping them
+                stale = [t for t in self._idle if now - t[1] >= self.keepalive]
+                for t in stale:
+                    self._idle.remove(t)
+            for clone, _ in stale:
+                try:
+                    clone.keepalive()
+                except Exception as e:
+                    write_error(f"Dropping connection {clone}: {e!r}")
+                    self.release(clone, discard=True)
+                else:
+                    self.release(clone)
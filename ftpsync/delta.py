@@ -0,0 +1,309 @@
+"""
+(c) 2012-2024 Martin Wendt; see https://github.com/mar10/pyftpsync
+Licensed under the MIT license: https://www.opensource.org/licenses/mit-license.php
+
+Block delta transfer of modified files (`--delta`), similar to rsync.
+
+The receiver sends a *signature* of its version of the file, i.e. a weak
+rolling checksum (Adler-32) and a strong digest of every block.
+The sender searches its version for these blocks and sends a *delta*:
+references to blocks that the receiver already has and the data in between.
+The receiver writes the new version to a temporary file, checks its digest,
+and replaces the old version.
+
+This module only uses the standard library, because it is also run on SFTP
+servers (see :func:`helper_command`)::
+
+    $ python3 -c <this module> signature PATH BLOCK_SIZE > signature
+    $ python3 -c <this module> delta PATH < signature > delta
+    $ python3 -c <this module> patch PATH TEMP_PATH < delta
+"""
+
+import base64
+import hashlib
+import mmap
+import os
+import shlex
+import struct
+import sys
+import zlib
+
+#: Suffix of the temporary file while a delta is applied (ends with the
+#: `.pyftpsync-part` suffix, so it is never synchronized)
+TEMP_SUFFIX = ".delta.pyftpsync-part"
+#: Block sizes grow with the square root of the file size (like rsync)
+MIN_BLOCKSIZE = 2 * 1024
+MAX_BLOCKSIZE = 128 * 1024
+#: Unmatched data is searched byte by byte (in Python) for this many bytes
+#: after the last matching block. Then only block boundaries are checked,
+#: except for one block per window. This keeps appended data cheap, while
+#: shifted blocks are still found after large insertions.
+SEARCH_WINDOW = 1024 * 1024
+#: Maximum size of a literal data record
+LITERAL_CHUNK = 256 * 1024
+
+SIGNATURE_MAGIC = b"PFSS1"
+DELTA_MAGIC = b"PFSD1"
+_SIGNATURE_HEADER = struct.Struct(">5sII")  # magic, block size, block count
+_BLOCK = struct.Struct(">I16s")  # weak checksum, strong digest
+_COPY = struct.Struct(">QQ")  # offset in the old version, length
+_DATA = struct.Struct(">I")  # length of the following data
+_END = struct.Struct(">Q32s")  # size and digest of the new version
+_ADLER_MOD = 65521
+
+#: Compressed source of this module (see :func:`helper_command`)
+_encoded_source = None
+
+
+class DeltaError(ValueError):
+    """A signature or delta is invalid, or the result has the wrong digest."""
+
+
+def block_size_for(size):
+    """Return the block size for a file of `size` bytes."""
+    return max(MIN_BLOCKSIZE, min(MAX_BLOCKSIZE, int(size**0.5) // 64 * 64))
+
+
+def _strong_digest(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def _file_digest(data):
+    return hashlib.blake2b(data, digest_size=32).digest()
+
+
+def _map(fp):
+    """Return a read-only memory map of file `fp` (None for empty files)."""
+    if not os.fstat(fp.fileno()).st_size:
+        return None
+    return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _read_exactly(fp, size):
+    data = fp.read(size)
+    if len(data) != size:
+        raise DeltaError("Unexpected end of stream")
+    return data
+
+
+def write_signature(path, block_size, fp_out):
+    """Write the signature of the complete blocks of file `path` to `fp_out`."""
+    with open(path, "rb") as fp:
+        count = os.fstat(fp.fileno()).st_size // block_size
+        fp_out.write(_SIGNATURE_HEADER.pack(SIGNATURE_MAGIC, block_size, count))
+        for _ in range(count):
+            block = fp.read(block_size)
+            fp_out.write(_BLOCK.pack(zlib.adler32(block), _strong_digest(block)))
+
+
+def read_signature(fp):
+    """Read a signature from stream `fp`.
+
+    Returns:
+        (block_size, blocks) tuple, where `blocks` maps weak checksums to
+        `{strong digest: offset}` dicts
+    """
+    magic, block_size, count = _SIGNATURE_HEADER.unpack(
+        _read_exactly(fp, _SIGNATURE_HEADER.size)
+    )
+    if magic != SIGNATURE_MAGIC:
+        raise DeltaError("Invalid signature")
+    blocks = {}
+    for i in range(count):
+        weak, strong = _BLOCK.unpack(_read_exactly(fp, _BLOCK.size))
+        blocks.setdefault(weak, {}).setdefault(strong, i * block_size)
+    return block_size, blocks
+
+
+class _DeltaWriter:
+    """Write delta records, merging adjacent block references."""
+
+    def __init__(self, fp_out):
+        self.fp_out = fp_out
+        self.copy_ofs = self.copy_len = 0
+        #: Number of bytes that were sent as data
+        self.literal_bytes = 0
+        fp_out.write(DELTA_MAGIC)
+
+    def copy(self, ofs, length):
+        if self.copy_len and self.copy_ofs + self.copy_len == ofs:
+            self.copy_len += length
+            return
+        self.flush()
+        self.copy_ofs, self.copy_len = ofs, length
+
+    def data(self, data):
+        if not data:
+            return
+        self.flush()
+        self.literal_bytes += len(data)
+        self.fp_out.write(b"D" + _DATA.pack(len(data)))
+        self.fp_out.write(data)
+
+    def flush(self):
+        if self.copy_len:
+            self.fp_out.write(b"C" + _COPY.pack(self.copy_ofs, self.copy_len))
+            self.copy_len = 0
+
+    def end(self, size, digest):
+        self.flush()
+        self.fp_out.write(b"E" + _END.pack(size, digest))
+
+
+def write_delta(path, signature, fp_out):
+    """Write the delta of file `path` against `signature` to `fp_out`.
+
+    Args:
+        path (str): the new version of the file
+        signature (tuple): the receiver's version (see :func:`read_signature`)
+        fp_out (file-like):
+    Returns:
+        int: number of bytes that are sent as data (not as block references)
+    """
+    block_size, blocks = signature
+    writer = _DeltaWriter(fp_out)
+    with open(path, "rb") as fp:
+        mm = _map(fp)
+        if mm is None:
+            writer.end(0, _file_digest(b""))
+            return 0
+        with mm:
+            size = len(mm)
+            pos = lit = 0  # Start of the window and of the pending data
+            last_match = 0
+            weak = None
+            while pos + block_size <= size:
+                if weak is None:
+                    weak = zlib.adler32(mm[pos : pos + block_size])
+                candidates = blocks.get(weak)
+                if candidates:
+                    ofs = candidates.get(_strong_digest(mm[pos : pos + block_size]))
+                    if ofs is not None:
+                        writer.data(mm[lit:pos])
+                        writer.copy(ofs, block_size)
+                        pos = lit = last_match = pos + block_size
+                        weak = None
+                        continue
+                if pos - lit >= LITERAL_CHUNK:
+                    writer.data(mm[lit:pos])
+                    lit = pos
+                since = pos - last_match
+                if since >= SEARCH_WINDOW and since % SEARCH_WINDOW >= block_size:
+                    # Probably new data: only check block boundaries
+                    pos += block_size
+                    weak = None
+                    continue
+                if pos + block_size < size:
+                    # Roll the checksum by one byte
+                    x_out, x_in = mm[pos], mm[pos + block_size]
+                    a = ((weak & 0xFFFF) - x_out + x_in) % _ADLER_MOD
+                    b = ((weak >> 16) - block_size * x_out + a - 1) % _ADLER_MOD
+                    weak = (b << 16) | a
+                pos += 1
+            while lit < size:
+                writer.data(mm[lit : lit + LITERAL_CHUNK])
+                lit += LITERAL_CHUNK
+            writer.end(size, _file_digest(mm))
+    return writer.literal_bytes
+
+
+def apply_delta(path, fp_delta, temp_path):
+    """Replace file `path` by its new version, built from a delta.
+
+    The new version is written to `temp_path` (in the same folder) and
+    renamed when its digest was verified, so `path` is replaced atomically.
+
+    Raises:
+        DeltaError: the delta is invalid or the result has the wrong digest
+    """
+    try:
+        with open(path, "rb") as fp_old, open(temp_path, "wb") as fp_new:
+            _apply_records(fp_old, fp_delta, fp_new)
+        os.chmod(temp_path, os.stat(path).st_mode & 0o7777)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def _apply_records(fp_old, fp_delta, fp_new):
+    if _read_exactly(fp_delta, len(DELTA_MAGIC)) != DELTA_MAGIC:
+        raise DeltaError("Invalid delta")
+    digest = hashlib.blake2b(digest_size=32)
+    size = 0
+    while True:
+        kind = _read_exactly(fp_delta, 1)
+        if kind == b"C":
+            ofs, length = _COPY.unpack(_read_exactly(fp_delta, _COPY.size))
+            fp_old.seek(ofs)
+            while length:
+                data = _read_exactly(fp_old, min(length, LITERAL_CHUNK))
+                fp_new.write(data)
+                digest.update(data)
+                size += len(data)
+                length -= len(data)
+        elif kind == b"D":
+            (length,) = _DATA.unpack(_read_exactly(fp_delta, _DATA.size))
+            data = _read_exactly(fp_delta, length)
+            fp_new.write(data)
+            digest.update(data)
+            size += length
+        elif kind == b"E":
+            expected_size, expected_digest = _END.unpack(
+                _read_exactly(fp_delta, _END.size)
+            )
+            if size != expected_size or digest.digest() != expected_digest:
+                raise DeltaError("The patched file has the wrong digest")
+            return
+        else:
+            raise DeltaError(f"Invalid delta record {kind!r}")
+
+
+def helper_command(*args):
+    """Return a shell command that runs this module with `args` (see `main()`).
+
+    The module source is passed compressed on the command line, so nothing
+    needs to be installed on the server besides Python 3.
+    """
+    global _encoded_source
+    if _encoded_source is None:
+        with open(__file__, "rb") as fp:
+            source = fp.read()
+        _encoded_source = base64.b64encode(zlib.compress(source, 9)).decode("ascii")
+    code = (
+        "import base64,zlib;"
+        f"exec(zlib.decompress(base64.b64decode('{_encoded_source}')))"
+    )
+    args = " ".join(shlex.quote(str(arg)) for arg in args)
+    return f"python3 -c {shlex.quote(code)} {args}"
+
+
+def main(argv):
+    """Run as helper (see module docstring).
+
+    Returns:
+        int: exit status (2: the file does not exist, 3: invalid input)
+    """
+    command, path = argv[0], argv[1]
+    if not os.path.isfile(path):
+        return 2
+    try:
+        if command == "signature":
+            write_signature(path, int(argv[2]), sys.stdout.buffer)
+            sys.stdout.buffer.flush()
+        elif command == "delta":
+            signature = read_signature(sys.stdin.buffer)
+            write_delta(path, signature, sys.stdout.buffer)
+            sys.stdout.buffer.flush()
+        elif command == "patch":
+            apply_delta(path, sys.stdin.buffer, argv[2])
+        else:
+            return 3
+    except DeltaError:
+        return 3
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
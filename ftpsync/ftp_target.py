@@ -3,20 +3,28 @@
 Licensed under the MIT license: https://www.opensource.org/licenses/mit-license.php
 """
 
-import calendar
 import codecs
+import contextlib
 import ftplib
+import hashlib
 import json
 import os
+import socket
 import time
 from posixpath import join as join_url
 from posixpath import normpath as normpath_url
 from posixpath import relpath as relpath_url
 from tempfile import SpooledTemporaryFile
 
-from ftpsync.metadata import DirMetadata, IncompatibleMetadataVersionError
+from ftpsync.metadata import (
+    DirMetadata,
+    IncompatibleMetadataVersionError,
+    Manifest,
+)
+from ftpsync.mlsd import parse_lines as parse_mlsd_lines
 from ftpsync.resources import DirectoryEntry, FileEntry
-from ftpsync.targets import _get_encoding_opt, _Target
+from ftpsync.targets import HASH_ALGORITHMS, _get_encoding_opt, _Target
+from ftpsync.tree_listing import TreeSnapshot, estimate_time_offset
 from ftpsync.util import (
     CliSilentRuntimeError,
     get_credentials_for_url,
@@ -27,6 +35,71 @@ from ftpsync.util import (
     write_error,
 )
 
+#: SYST and FEAT responses per server, so additional connections (e.g. clones
+#: and reconnects) can skip these round trips {(host, port, tls): (syst, feat)}
+_server_features = {}
+
+
+def iter_decoded_lines(chunks, encoding, on_fallback=None):
+    """Split and decode a stream of byte chunks into lines (generator).
+
+    The data is collected in a `bytearray` and every batch of complete lines
+    is decoded with one call, so the cost is linear in the size of the
+    listing. Only if a batch cannot be decoded, its lines are decoded one by
+    one. If `encoding` is 'utf-8', Cp1252 is used as fallback for these lines.
+    CR, LF and CR/LF line endings are accepted and empty lines are skipped.
+
+    Args:
+        chunks (iterable of bytes):
+        encoding (str):
+        on_fallback (callable, optional):
+            Called as `on_fallback(status, line)` for lines that could not be
+            decoded using `encoding`, where status is 1 (the fallback encoding
+            was used) or 2 (invalid characters were replaced).
+    Yields:
+        str
+    """
+    fallback_enc = "cp1252" if encoding == "utf-8" else None
+
+    def _decode_batch(data):
+        try:
+            text = str(data, encoding)
+        except UnicodeDecodeError:
+            pass
+        else:
+            return text.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+        lines = []
+        data = bytes(data).replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+        for line in data.split(b"\n"):
+            try:
+                lines.append(line.decode(encoding))
+                continue
+            except UnicodeDecodeError:
+                if fallback_enc:
+                    line = line.decode(fallback_enc)
+                    status = 1  # used fallback encoding
+                else:
+                    line = line.decode(encoding, "replace")
+                    status = 2  # fault
+            if on_fallback:
+                on_fallback(status, line)
+            lines.append(line)
+        return lines
+
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        # A CR at the end of the buffer stays there, in case a LF follows
+        end = buffer.rfind(b"\n") + 1
+        if not end:
+            continue
+        with memoryview(buffer)[:end] as data:
+            lines = _decode_batch(data)
+        del buffer[:end]
+        yield from filter(None, lines)
+    if buffer:
+        yield from filter(None, _decode_batch(buffer))
+
 
 # ===============================================================================
 # FTPTarget
@@ -44,6 +117,14 @@ class FTPTarget(_Target):
     """
 
     DEFAULT_BLOCKSIZE = 8 * 1024  # ftplib uses 8k chunks by default
+    #: Chunk size when receiving directory listings
+    LISTING_BLOCKSIZE = 64 * 1024
+    #: Commands that are tried to list the whole tree (`--list-tree`)
+    TREE_LIST_COMMANDS = ("LIST -R", "STAT -R")
+    #: Algorithm names of the `HASH` command (FEAT, OPTS HASH), see get_hash()
+    HASH_NAMES = {"sha256": "SHA-256", "sha1": "SHA-1", "md5": "MD5"}
+    #: Non-standard commands that return a digest, see get_hash()
+    X_HASH_COMMANDS = {"sha256": "XSHA256", "sha1": "XSHA1", "md5": "XMD5"}
     MAX_SPOOL_MEM = (
         100 * 1024
     )  # keep open_readable() buffer in memory if smaller than 100kB
@@ -106,6 +187,10 @@ class FTPTarget(_Target):
         self.server_time_ofs = None
         self.ftp_socket_connected = False
         self.support_set_time = False
+        #: Hash commands that the server refused (see get_hash())
+        self.refused_hash_commands = set()
+        #: Algorithm that was selected with `OPTS HASH`
+        self.hash_selected = None
         # #: Optionally define an encoding for this server
         # encoding = self.get_option("encoding", "utf-8")
         # self.encoding = codecs.lookup(encoding).name
@@ -120,14 +205,94 @@ class FTPTarget(_Target):
         scheme = "ftps" if self.tls else "ftp"
         return f"{scheme}://{self.host}{self.root_dir}"
 
+    def _make_clone(self, extra_opts):
+        return FTPTarget(
+            self.root_dir,
+            self.host,
+            self.port,
+            username=self.username,
+            password=self.password,
+            tls=self.tls,
+            timeout=self.timeout,
+            extra_opts=extra_opts,
+        )
+
     def open(self):
         assert not self.ftp_socket_connected
 
         super().open()
 
+        store_password = self.get_option("store_password", False)
+
+        self._connect()
+
+        try:
+            self.ftp.cwd(self.root_dir)
+        except ftplib.error_perm as e:
+            if not e.args[0].startswith("550"):
+                raise  # error other then 550 No such directory'
+
+            # Implement --create-folder option for remote targets:
+            if self.is_unbound():
+                # E.g. 'tree' command
+                write_error(
+                    f"Could not change directory to {self.root_dir} ({e}): missing permissions?"
+                )
+            elif self.is_local():
+                write_error(
+                    f"Could not change local directory to {self.root_dir} ({e}): missing permissions?"
+                )
+            else:
+                parent = os.path.dirname(self.root_dir)
+                subfolder = os.path.basename(self.root_dir)
+                if not self.get_option("create_folder", False):
+                    msg = (
+                        f"Could not change remote directory to {self.root_dir!r} ({e!r}). "
+                        "This may be due to missing permissions or because the folder does not exist. "
+                        f"Pass `--create-folder` if you want to create {subfolder!r} within {parent!r}."
+                    )
+                    raise CliSilentRuntimeError(msg, min_verbosity=4)
+
+                write_error(
+                    f"Could not change remote directory to {self.root_dir!r} ({e!r}). "
+                    f"`--create-folder` was passed: creating {subfolder!r} within {parent!r}..."
+                )
+                self.ftp.cwd(parent)
+                self.mkdir(subfolder)
+                # Must work now:
+                self.ftp.cwd(self.root_dir)
+
+        pwd = self.pwd()
+        if pwd != self.root_dir:
+            raise RuntimeError(
+                "Unable to navigate to working directory {!r} (now at {!r})".format(
+                    self.root_dir, pwd
+                )
+            )
+
+        self.cur_dir = pwd
+
+        # Successfully authenticated: store password
+        if store_password:
+            save_password(self.host, self.username, self.password)
+
+        self._open_listing_cache()
+        self._open_manifest()
+
+        # Clones are opened by worker threads and share the primary's lock
+        if not self.primary:
+            self._lock()
+
+        # After the lock file was written, so the tree listing contains at
+        # least one recent file (see _read_tree_listing())
+        self._open_tree_snapshot(self._read_tree_listing)
+
+        return
+
+    def _connect(self):
+        """Connect and login, then negotiate encoding and server features."""
         options = self.get_options_dict()
         no_prompt = self.get_option("no_prompt", True)
-        store_password = self.get_option("store_password", False)
         verbose = self.get_option("verbose", 3)
 
         self.ftp.set_debuglevel(self.get_option("ftp_debug", 0))
@@ -179,22 +344,15 @@ class FTPTarget(_Target):
             # Upgrade data connection to TLS.
             self.ftp.prot_p()
 
-        try:
-            self.syst_response = self.ftp.sendcmd("SYST")
-            if verbose >= 5:
-                write("SYST: '{}'.".format(self.syst_response.replace("\n", " ")))
-            # self.is_unix = "unix" in resp.lower() # not necessarily true, better check with r/w tests
-            # TODO: case sensitivity?
-        except Exception as e:
-            write(f"SYST command failed: '{e}'")
-
-        try:
-            self.feat_response = self.ftp.sendcmd("FEAT")
-            self.support_utf8 = "UTF8" in self.feat_response
-            if verbose >= 5:
-                write("FEAT: '{}'.".format(self.feat_response.replace("\n", " ")))
-        except Exception as e:
-            write(f"FEAT command failed: '{e}'")
+        cache_key = (self.host, self.port, self.tls)
+        cached = _server_features.get(cache_key)
+        if cached:
+            # Another connection to this server already asked
+            self.syst_response, self.feat_response = cached
+            self.support_utf8 = "UTF8" in (self.feat_response or "")
+        else:
+            self._query_server_features(verbose)
+            _server_features[cache_key] = (self.syst_response, self.feat_response)
 
         if self.encoding == "utf-8":
             if not self.support_utf8 and verbose >= 4:
@@ -236,61 +394,52 @@ class FTPTarget(_Target):
                 )
                 self.ftp.encoding = self.encoding
 
+    def _query_server_features(self, verbose):
         try:
-            self.ftp.cwd(self.root_dir)
-        except ftplib.error_perm as e:
-            if not e.args[0].startswith("550"):
-                raise  # error other then 550 No such directory'
-
-            # Implement --create-folder option for remote targets:
-            if self.is_unbound():
-                # E.g. 'tree' command
-                write_error(
-                    f"Could not change directory to {self.root_dir} ({e}): missing permissions?"
-                )
-            elif self.is_local():
-                write_error(
-                    f"Could not change local directory to {self.root_dir} ({e}): missing permissions?"
-                )
-            else:
-                parent = os.path.dirname(self.root_dir)
-                subfolder = os.path.basename(self.root_dir)
-                if not self.get_option("create_folder", False):
-                    msg = (
-                        f"Could not change remote directory to {self.root_dir!r} ({e!r}). "
-                        "This may be due to missing permissions or because the folder does not exist. "
-                        f"Pass `--create-folder` if you want to create {subfolder!r} within {parent!r}."
-                    )
-                    raise CliSilentRuntimeError(msg, min_verbosity=4)
-
-                write_error(
-                    f"Could not change remote directory to {self.root_dir!r} ({e!r}). "
-                    f"`--create-folder` was passed: creating {subfolder!r} within {parent!r}..."
-                )
-                self.ftp.cwd(parent)
-                self.mkdir(subfolder)
-                # Must work now:
-                self.ftp.cwd(self.root_dir)
-
-        pwd = self.pwd()
-        if pwd != self.root_dir:
-            raise RuntimeError(
-                "Unable to navigate to working directory {!r} (now at {!r})".format(
-                    self.root_dir, pwd
-                )
-            )
-
-        self.cur_dir = pwd
+            self.syst_response = self.ftp.sendcmd("SYST")
+            if verbose >= 5:
+                write("SYST: '{}'.".format(self.syst_response.replace("\n", " ")))
+            # self.is_unix = "unix" in resp.lower() # not necessarily true, better check with r/w tests
+            # TODO: case sensitivity?
+        except Exception as e:
+            write(f"SYST command failed: '{e}'")
 
-        # Successfully authenticated: store password
-        if store_password:
-            save_password(self.host, self.username, self.password)
+        try:
+            self.feat_response = self.ftp.sendcmd("FEAT")
+            self.support_utf8 = "UTF8" in self.feat_response
+            if verbose >= 5:
+                write("FEAT: '{}'.".format(self.feat_response.replace("\n", " ")))
+        except Exception as e:
+            write(f"FEAT command failed: '{e}'")
 
-        self._lock()
+    def keepalive(self):
+        """Send NOOP to prevent a timeout of the control connection.
 
-        return
+        If the connection was dropped, reconnect.
+        """
+        try:
+            self.ftp.voidcmd("NOOP")
+        except (OSError, EOFError, ftplib.error_temp) as e:
+            write(f"Lost connection to {self.host} ({e!r}): reconnecting...")
+            self.reconnect()
+
+    def reconnect(self):
+        """Open a new control connection and restore the working directory."""
+        cur_dir = self.cur_dir
+        try:
+            self.ftp.close()
+        except Exception:
+            pass
+        self.ftp_socket_connected = False
+        self.ftp = ftplib.FTP_TLS() if self.tls else ftplib.FTP()
+        self._connect()
+        self.ftp.cwd(cur_dir)
+        self.cur_dir = cur_dir
 
     def close(self):
+        if self.ftp_socket_connected:
+            self._close_manifest()
+
         if self.lock_data:
             self._unlock(closing=True)
 
@@ -301,6 +450,8 @@ class FTPTarget(_Target):
                 write_error(f"ftp.quit() failed: {e}")
             self.ftp_socket_connected = False
 
+        self._close_listing_cache()
+        self.tree_snapshot = None
         super().close()
 
     def _lock(self, break_existing=False):
@@ -374,6 +525,8 @@ class FTPTarget(_Target):
 
     def _probe_lock_file(self, reported_mtime):
         """Called by get_dir"""
+        if not self.lock_data:
+            return  # We did not write the lock file (e.g. a clone)
         delta = reported_mtime - self.lock_data["lock_time"]
         # delta2 = reported_mtime - self.lock_write_time
         self.server_time_ofs = delta
@@ -441,7 +594,7 @@ class FTPTarget(_Target):
                             )
                         )
                         # assume <name> is a folder
-                        self.rmdir(name)
+                        self._rmdir_impl(name)
             finally:
                 if dir_name != ".":
                     self.ftp.cwd("..")
@@ -451,23 +604,23 @@ class FTPTarget(_Target):
         return
 
     def rmdir(self, dir_name):
+        if self.manifest:
+            self.manifest.remove_tree(join_url(self.cur_dir, dir_name))
         return self._rmdir_impl(dir_name)
 
     def get_dir(self):
+        return self._get_dir_cached(self._get_dir_impl)
+
+    def _get_dir_impl(self):
         entry_list = []
         entry_map = {}
-        local_var = {"has_meta": False}  # pass local variables outside func scope
+        # pass local variables outside func scope
+        local_var = {"has_meta": False, "meta_files": []}
 
         encoding = self.encoding
 
-        def _addline(status, line):
-            # _ftp_retrlines_native() made sure that we always get `str` type  lines
-            assert status in (0, 1, 2)
-            assert is_native(line)
-
-            data, _, name = line.partition("; ")
-
-            # print(status, name, u_name)
+        def _on_fallback(status, line):
+            _, _, name = line.partition("; ")
             if status == 1:
                 write(
                     "WARNING: File name seems not to be {}; re-encoded from CP-1252:".format(
@@ -478,39 +631,17 @@ class FTPTarget(_Target):
             elif status == 2:
                 write_error("File name is neither UTF-8 nor CP-1252 encoded:", name)
 
-            res_type = size = mtime = unique = None
-            fields = data.split(";")
-            # https://tools.ietf.org/html/rfc3659#page-23
-            # "Size" / "Modify" / "Create" / "Type" / "Unique" / "Perm" / "Lang"
-            #   / "Media-Type" / "CharSet" / os-depend-fact / local-fact
-            for field in fields:
-                field_name, _, field_value = field.partition("=")
-                field_name = field_name.lower()
-                if field_name == "type":
-                    res_type = field_value
-                elif field_name in ("sizd", "size"):
-                    size = int(field_value)
-                elif field_name == "modify":
-                    # Use calendar.timegm() instead of time.mktime(), because
-                    # the date was returned as UTC
-                    if "." in field_value:
-                        mtime = calendar.timegm(
-                            time.strptime(field_value, "%Y%m%d%H%M%S.%f")
-                        )
-                    else:
-                        mtime = calendar.timegm(
-                            time.strptime(field_value, "%Y%m%d%H%M%S")
-                        )
-                elif field_name == "unique":
-                    unique = field_value
-
+        def _add_entry(name, res_type, size, mtime, unique):
             entry = None
             if res_type == "dir":
                 entry = DirectoryEntry(self, self.cur_dir, name, size, mtime, unique)
             elif res_type == "file":
-                if name == DirMetadata.META_FILE_NAME:
+                if name in DirMetadata.META_FILE_NAMES:
                     # the meta-data file is silently ignored
                     local_var["has_meta"] = True
+                    local_var["meta_files"].append(name)
+                elif name in (Manifest.FILE_NAME, Manifest.TEMP_FILE_NAME):
+                    pass  # the manifest is read by open()
                 elif (
                     name == DirMetadata.LOCK_FILE_NAME and self.cur_dir == self.root_dir
                 ):
@@ -522,7 +653,7 @@ class FTPTarget(_Target):
             elif res_type in ("cdir", "pdir"):
                 pass
             else:
-                write_error(f"Could not parse '{line}'")
+                write_error(f"Could not parse MLSD entry {name!r}")
                 raise NotImplementedError(
                     f"MLSD returned unsupported type: {res_type!r}"
                 )
@@ -531,10 +662,18 @@ class FTPTarget(_Target):
                 entry_map[name] = entry
                 entry_list.append(entry)
 
+        snapshot_entries = self._pop_tree_listing()
         try:
-            # We use a custom wrapper here, so we can implement a codding fall back:
-            self._ftp_retrlines_native("MLSD", _addline, encoding)
-            # self.ftp.retrlines("MLSD", _addline)
+            if snapshot_entries is not None:
+                for info in snapshot_entries:
+                    _add_entry(*info)
+            else:
+                # We use a custom reader here, so we can implement a coding fall
+                # back:
+                lines = self._ftp_iter_lines_native("MLSD", encoding, _on_fallback)
+                with contextlib.closing(lines):
+                    for info in parse_mlsd_lines(lines):
+                        _add_entry(*info)
         except ftplib.error_perm as e:
             # write_error("The FTP server responded with {}".format(e))
             # raises error_perm "500 Unknown command" if command is not supported
@@ -544,12 +683,15 @@ class FTPTarget(_Target):
                 )
             raise
 
+        if self.manifest and self.manifest.get(self.cur_dir) is not None:
+            local_var["has_meta"] = True
+
         # load stored meta data if present
         self.cur_dir_meta = DirMetadata(self)
 
         if local_var["has_meta"]:
             try:
-                self.cur_dir_meta.read()
+                self.cur_dir_meta.read(local_var["meta_files"])
             except IncompatibleMetadataVersionError:
                 raise  # this should end the script (user should pass --migrate)
             except Exception as e:
@@ -621,7 +763,32 @@ class FTPTarget(_Target):
         out.seek(0)
         return out
 
-    def write_file(self, name, fp_src, blocksize=DEFAULT_BLOCKSIZE, callback=None):
+    def read_range(self, name, offset, size):
+        """Return up to `size` bytes of cur_dir/name, starting at `offset`.
+
+        The download is started at `offset` (REST) and the data connection is
+        closed after `size` bytes, so the server may report an aborted
+        transfer.
+        """
+        assert is_native(name)
+        ftp = self.ftp
+        ftp.voidcmd("TYPE I")
+        res = bytearray()
+        with ftp.transfercmd(f"RETR {name}", rest=offset or None) as conn:
+            while len(res) < size:
+                chunk = conn.recv(min(size - len(res), FTPTarget.DEFAULT_BLOCKSIZE))
+                if not chunk:
+                    break
+                res += chunk
+        try:
+            ftp.voidresp()
+        except ftplib.error_temp:
+            pass  # 426 Transfer aborted
+        return bytes(res)
+
+    def write_file(
+        self, name, fp_src, blocksize=DEFAULT_BLOCKSIZE, callback=None, offset=0
+    ):
         """Write file-like `fp_src` to cur_dir/name.
 
         Args:
@@ -630,14 +797,21 @@ class FTPTarget(_Target):
             blocksize (int, optional):
             callback (function, optional):
                 Called like `func(buf)` for every written chunk
+            offset (int, optional):
+                Append to the existing file (`fp_src` must be positioned at
+                `offset`)
         """
         # print("FTP write_file({})".format(name), blocksize)
         assert is_native(name)
         self.check_write(name)
-        self.ftp.storbinary(f"STOR {name}", fp_src, blocksize, callback)
+        if offset:
+            # APPE is more widely supported than REST + STOR
+            self.ftp.storbinary(f"APPE {name}", fp_src, blocksize, callback)
+        else:
+            self.ftp.storbinary(f"STOR {name}", fp_src, blocksize, callback)
         # TODO: check result
 
-    def copy_to_file(self, name, fp_dest, callback=None):
+    def copy_to_file(self, name, fp_dest, callback=None, offset=0):
         """Write cur_dir/name to file-like `fp_dest`.
 
         Args:
@@ -645,6 +819,8 @@ class FTPTarget(_Target):
             fp_dest (file-like): must support write() method
             callback (function, optional):
                 Called like `func(buf)` for every written chunk
+            offset (int, optional):
+                Start at this position (sends REST before RETR)
         """
         assert is_native(name)
 
@@ -654,7 +830,160 @@ class FTPTarget(_Target):
             if callback:
                 callback(data)
 
-        self.ftp.retrbinary(f"RETR {name}", _write_to_file, FTPTarget.DEFAULT_BLOCKSIZE)
+        # Like ftp.retrbinary(), but the reply is also read if `fp_dest` raises
+        # (e.g. the pipe of a remote-to-remote copy, when the upload failed)
+        ftp = self.ftp
+        ftp.voidcmd("TYPE I")
+        conn = ftp.transfercmd(f"RETR {name}", offset or None)
+        completed = False
+        try:
+            with conn:
+                while True:
+                    data = conn.recv(FTPTarget.DEFAULT_BLOCKSIZE)
+                    if not data:
+                        break
+                    _write_to_file(data)
+                # Shutdown the TLS layer (like ftplib.retrbinary())
+                if hasattr(conn, "unwrap"):
+                    conn.unwrap()
+            completed = True
+        finally:
+            if not completed:
+                # The data connection was closed early: read the reply (e.g.
+                # '426 Transfer aborted') before the next command is sent
+                with contextlib.suppress(*ftplib.all_errors):
+                    ftp.voidresp()
+        ftp.voidresp()
+
+    def supports_fxp(self, dest):
+        """Return True if :meth:`fxp_copy` may be tried with target `dest`.
+
+        FXP needs plain FTP (TLS data connections would require the server
+        specific CPSV or SSCN commands) over IPv4 (PASV / PORT) on both ends.
+        """
+        return (
+            isinstance(dest, FTPTarget)
+            and not self.tls
+            and not dest.tls
+            and self.ftp.af == socket.AF_INET
+            and dest.ftp.af == socket.AF_INET
+        )
+
+    def fxp_copy(self, name, dest, dest_name, offset=0):
+        """Let the servers copy cur_dir/name to `dest.cur_dir/dest_name` (FXP).
+
+        The source server is put in passive mode and the destination server
+        connects to it (`PORT`), so the data does not pass this machine.
+
+        Args:
+            name (str): file name, located in self.curdir
+            dest (:class:`FTPTarget`):
+            dest_name (str): file name, located in dest.curdir
+            offset (int, optional):
+                Append to the existing destination file, starting at this
+                position of the source (sends REST before RETR)
+        Returns:
+            None if the file was copied, or the error if one of the servers
+            refused the setup (nothing was transferred; relay the data instead)
+        Raises:
+            ftplib.Error or OSError if the transfer failed (both connections are
+            re-established)
+        """
+        assert is_native(name) and is_native(dest_name)
+        dest.check_write(dest_name)
+        src_ftp, dest_ftp = self.ftp, dest.ftp
+        try:
+            src_ftp.voidcmd("TYPE I")
+            dest_ftp.voidcmd("TYPE I")
+            host, port = ftplib.parse227(src_ftp.sendcmd("PASV"))
+            address = host.split(".") + [str(port >> 8), str(port & 0xFF)]
+            dest_ftp.voidcmd("PORT " + ",".join(address))
+            if offset:
+                src_ftp.sendcmd(f"REST {offset}")
+                dest_ftp.sendcmd(f"APPE {dest_name}")
+            else:
+                dest_ftp.sendcmd(f"STOR {dest_name}")
+        except (ftplib.error_perm, ftplib.error_temp, ftplib.error_reply) as e:
+            return e
+        try:
+            src_ftp.sendcmd(f"RETR {name}")
+            src_ftp.voidresp()
+            dest_ftp.voidresp()
+        except Exception:
+            # The destination may still wait for data: reset both servers
+            self.reconnect()
+            dest.reconnect()
+            raise
+        return None
+
+    def _get_hash_feature(self):
+        """Return the algorithms of the FEAT `HASH` line, e.g. {'SHA-256', 'MD5'}."""
+        for line in (self.feat_response or "").splitlines():
+            fields = line.split()
+            if len(fields) == 2 and fields[0].upper() == "HASH":
+                return {s.rstrip("*").upper() for s in fields[1].split(";")}
+        return set()
+
+    def _send_hash_command(self, algorithm, name):
+        """Return the hex digest of cur_dir/name or None if it is not supported.
+
+        Raises:
+            ftplib.error_perm: '550' if the server refused the file
+        """
+        refused = self.refused_hash_commands
+        hash_name = self.HASH_NAMES.get(algorithm)
+        if "HASH" not in refused and hash_name in self._get_hash_feature():
+            command = "HASH"
+        else:
+            command = self.X_HASH_COMMANDS.get(algorithm)
+            if not command or command in refused:
+                return None
+        try:
+            if command != "HASH":
+                # '250 169cd22282da7f147cb491e559e9dd01' (some servers append the
+                # file name)
+                res = self.ftp.sendcmd(f"{command} {name}").split()
+                digest = res[1] if len(res) > 1 else ""
+            else:
+                if self.hash_selected != hash_name:
+                    self.ftp.sendcmd(f"OPTS HASH {hash_name}")
+                    self.hash_selected = hash_name
+                # '213 SHA-256 0-49 169cd22282da7f147cb491e559e9dd01 file name.txt'
+                res = self.ftp.sendcmd(f"HASH {name}").split(" ", 4)
+                digest = res[3] if len(res) > 3 else ""
+        except ftplib.error_perm as e:
+            if str(e).startswith("550"):
+                raise
+            # '500 Unknown command', '502 Command not implemented', ...
+            refused.add(command)
+            return None
+        digest = digest.lower()
+        try:
+            if len(bytes.fromhex(digest)) == hashlib.new(algorithm).digest_size:
+                return digest
+        except ValueError:
+            pass
+        write(f"Unexpected {command} response: {res}", warning=True)
+        refused.add(command)
+        return None
+
+    def get_hash(self, name, algorithms=HASH_ALGORITHMS):
+        """Return a content digest of cur_dir/name (see :meth:`_Target.get_hash`).
+
+        The `HASH` command is used if the server lists it in the FEAT response,
+        otherwise the non-standard `XSHA256`, `XSHA1`, or `XMD5` commands are
+        tried.
+        Commands that the server refuses are not sent again.
+        """
+        assert is_native(name)
+        for algorithm in algorithms:
+            try:
+                digest = self._send_hash_command(algorithm, name)
+            except (ftplib.error_perm, ftplib.error_temp, ftplib.error_reply):
+                return None  # The command is supported, but not for this file
+            if digest:
+                return algorithm, digest
+        return None
 
     def remove_file(self, name):
         """Remove cur_dir/name."""
@@ -664,6 +993,16 @@ class FTPTarget(_Target):
         self.ftp.delete(name)
         self.remove_sync_info(name)
 
+    def rename(self, name, new_name):
+        assert is_native(name) and is_native(new_name)
+        self.check_write(new_name)
+        try:
+            self.ftp.rename(name, new_name)
+        except ftplib.error_perm:
+            # Some servers refuse to replace existing files
+            self.ftp.delete(new_name)
+            self.ftp.rename(name, new_name)
+
     def set_mtime(self, name, mtime, size):
         assert is_native(name)
         self.check_write(name)
@@ -692,101 +1031,125 @@ class FTPTarget(_Target):
             finally:
                 self.ftp.encoding = prev_encoding
 
+    def _read_tree_listing(self):
+        """Return a :class:`ftpsync.tree_listing.TreeSnapshot` of cur_dir.
+
+        The commands in :attr:`TREE_LIST_COMMANDS` are tried in order.
+        Note that the `ls -l` style listings only report modification times with
+        a resolution of one minute (one day for files older than six months).
+        They are usually in the server's local time: the offset to UTC is
+        derived from the MLSD listing of cur_dir (see
+        :func:`ftpsync.tree_listing.estimate_time_offset`). If this is not
+        possible, the tree listing is not used.
+
+        Returns:
+            :class:`ftpsync.tree_listing.TreeSnapshot` or None if the server does
+            not support recursive listings.
+        """
+        for cmd in self.TREE_LIST_COMMANDS:
+            try:
+                if cmd.startswith("STAT"):
+                    # The listing is sent over the control connection, between
+                    # '213-Status of ...' and '213 End of status'
+                    lines = self.ftp.sendcmd(cmd).splitlines()[1:-1]
+                    snapshot = TreeSnapshot.from_ls_lines(lines, self.cur_dir)
+                else:
+                    lines = self._ftp_iter_lines_native(cmd, self.encoding)
+                    with contextlib.closing(lines):
+                        snapshot = TreeSnapshot.from_ls_lines(lines, self.cur_dir)
+            except (ftplib.error_perm, ftplib.error_temp, UnicodeDecodeError) as e:
+                write(f"{cmd} failed: {e}", debug=True)
+                continue
+            if snapshot:
+                offset = self._get_ls_time_offset(snapshot)
+                if offset is None:
+                    write(
+                        f"Could not determine the time zone of {cmd!r} listings: "
+                        "using MLSD for every directory.",
+                        warning=True,
+                    )
+                    return None
+                if offset:
+                    snapshot.shift_times(offset)
+                if self.get_option("verbose", 3) >= 4:
+                    write(
+                        f"Listed {len(snapshot)} directories using {cmd!r} "
+                        f"(time offset: {offset} sec)."
+                    )
+                return snapshot
+        write(
+            "The FTP server does not support recursive listings: "
+            "using MLSD for every directory.",
+            warning=True,
+        )
+        return None
+
     def _ftp_nlst(self, dir_name):
         """Variant of `self.ftp.nlst()` that supports encoding-fallback."""
         assert is_native(dir_name)
-        lines = []
-
-        def _add_line(status, line):
-            lines.append(line)
-
         cmd = "NLST " + dir_name
-        self._ftp_retrlines_native(cmd, _add_line, self.encoding)
-        # print(cmd, lines)
-        return lines
+        return list(self._ftp_iter_lines_native(cmd, self.encoding))
 
-    def _ftp_retrlines_native(self, command, callback, encoding):
-        """A re-implementation of ftp.retrlines that returns lines as native `str`.
+    def _get_ls_time_offset(self, snapshot):
+        """Return the offset of `snapshot`'s times to UTC (None if unknown)."""
+        lines = self._ftp_iter_lines_native("MLSD", self.encoding)
+        with contextlib.closing(lines):
+            mlsd_entries = list(parse_mlsd_lines(lines))
+        return estimate_time_offset(snapshot.root_entries, mlsd_entries, time.time())
 
-        This is needed on Python 3, where `ftp.retrlines()` returns unicode `str`
-        by decoding the incoming command response using `ftp.encoding`.
-        This would fail for the whole request if a single line of the MLSD listing
-        cannot be decoded.
+    def _ftp_iter_lines_native(self, command, encoding, on_fallback=None):
+        """A re-implementation of ftp.retrlines that yields lines as native `str`.
+
+        `ftp.retrlines()` decodes the incoming command response using
+        `ftp.encoding`. This would fail for the whole request if a single line
+        of the MLSD listing cannot be decoded.
         FTPTarget wants to fall back to Cp1252 if UTF-8 fails for a single line,
-        so we need to process the raw original binary input lines.
+        so we need to process the raw original binary input lines
+        (see :func:`iter_decoded_lines`).
 
-        On Python 2, the response is already bytes, but we try to decode in
-        order to check validity and optionally re-encode from Cp1252.
+        The lines are yielded while the response is received, so the listing
+        is never held in memory as a whole.
+        If the consumer stops early (or raises), the generator should be closed
+        (e.g. using `contextlib.closing()`): the data connection is closed and
+        the reply to the aborted transfer is read, so the control connection
+        stays in sync.
 
         Args:
             command (str):
                 A valid FTP command like 'NLST', 'MLSD', ...
-            callback (function):
-                Called for every line with these args:
-                    status (int): 0:ok 1:fallback used, 2:decode failed
-                    line (str): result line decoded using `encoding`.
-                        If `encoding` is 'utf-8', a fallback to cp1252
-                        is accepted.
             encoding (str):
                 Coding that is used to convert the FTP response to `str`.
-        Returns:
-            None
+                If `encoding` is 'utf-8', a fallback to cp1252 is accepted.
+            on_fallback (callable, optional):
+                Called as `on_fallback(status, line)` for lines that could not
+                be decoded using `encoding` (status 1: fallback used, 2: decode
+                failed).
+        Yields:
+            str
         """
-        LF = b"\n"  # noqa N806
-        buffer = b""
-
-        # needed to access buffer accross function scope
-        local_var = {"buffer": buffer}
-
-        fallback_enc = "cp1252" if encoding == "utf-8" else None
-
-        def _on_read_line(line):
-            # Line is a byte string
-            # print("  line ", line)
-            status = 2  # fault
-            line_decoded = None
-            try:
-                line_decoded = line.decode(encoding)
-                status = 0  # successfully decoded
-            except UnicodeDecodeError:
-                if fallback_enc:
-                    try:
-                        line_decoded = line.decode(fallback_enc)
-                        status = 1  # used fallback encoding
-                    except UnicodeDecodeError:
-                        raise
-
-            # if compat.PY2:
-            #     # line is a native binary `str`.
-            #     if status == 1:
-            #         # We used a fallback: re-encode
-            #         callback(status, line_decoded.encode(encoding))
-            #     else:
-            #         callback(status, line)
-            # else:
-            # line_decoded is a native text `str`.
-            callback(status, line_decoded)
-
-        # on_read_line = _on_read_line_py2 if compat.PY2 else _on_read_line_py3
-
-        def _on_read_chunk(chunk):
-            buffer = local_var["buffer"]
-            # Normalize line endings
-            chunk = chunk.replace(b"\r\n", LF)
-            chunk = chunk.replace(b"\r", LF)
-            chunk = buffer + chunk
-            try:
-                # print("Add chunk ", chunk, "to buffer", buffer)
-                while True:
-                    item, chunk = chunk.split(LF, 1)
-                    _on_read_line(item)  # + LF)
-            except ValueError:
-                pass
-            # print("Rest chunk", chunk)
-            local_var["buffer"] = chunk
-
-        self.ftp.retrbinary(command, _on_read_chunk)
-
-        if buffer:
-            _on_read_line(buffer)
-        return
+        ftp = self.ftp
+        ftp.voidcmd("TYPE I")
+        conn = ftp.transfercmd(command)
+        completed = False
+        try:
+            with conn:
+
+                def _recv_chunks():
+                    while True:
+                        chunk = conn.recv(self.LISTING_BLOCKSIZE)
+                        if not chunk:
+                            return
+                        yield chunk
+
+                yield from iter_decoded_lines(_recv_chunks(), encoding, on_fallback)
+                # Shutdown the TLS layer (like ftplib.retrbinary())
+                if hasattr(conn, "unwrap"):
+                    conn.unwrap()
+            completed = True
+        finally:
+            if not completed:
+                # The data connection was closed early: read the reply (e.g.
+                # '426 Transfer aborted') before the next command is sent
+                with contextlib.suppress(*ftplib.all_errors):
+                    ftp.voidresp()
+        ftp.voidresp()
@@ -0,0 +1,156 @@
+"""
+(c) 2012-2024 Martin Wendt; see https://github.com/mar10/pyftpsync
+Licensed under the MIT license: https://www.opensource.org/licenses/mit-license.php
+
+Persistent content digests of file system targets (`--hash-cache`).
+"""
+
+import hashlib
+import time
+
+from ftpsync.stat_index import SqliteCache
+
+#: Bytes per read() when hashing a file
+HASH_BLOCKSIZE = 1024 * 1024
+
+
+def hash_file(path, algorithm):
+    """Return the hex digest of the file at `path`.
+
+    Args:
+        path (str):
+        algorithm (str): hashlib algorithm name
+    Returns:
+        str
+    """
+    digest = hashlib.new(algorithm)
+    with open(path, "rb") as fp:
+        while True:
+            data = fp.read(HASH_BLOCKSIZE)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+# ===============================================================================
+# HashCache
+# ===============================================================================
+class HashCache(SqliteCache):
+    """SQLite database that stores content digests of a file system target.
+
+    A digest is keyed by the file path and algorithm, and is only returned as
+    long as the file's inode, size, and mtime are unchanged.
+
+    Also the digest of every file's content at the time it was last
+    synchronized with a peer is stored, so files that were only touched
+    (i.e. the mtime changed, but not the content) are recognized without
+    asking the peer.
+
+    Instances are shared by the target's clones (thread safe).
+
+    Args:
+        path (str): location of the database file
+    """
+
+    #: Name of the database file in the target's root folder
+    FILE_NAME = ".pyftpsync-hashes.sqlite"
+    #: Digests of files that were modified this short before they were hashed
+    #: are not trusted, since the mtime granularity may hide changes
+    RACY_NS = 2 * 10**9
+
+    def _create_tables(self, db):
+        db.execute("DROP TABLE IF EXISTS hashes")
+        db.execute("DROP TABLE IF EXISTS synced")
+        db.execute(
+            "CREATE TABLE hashes (path TEXT, algorithm TEXT, ino INTEGER, "
+            "size INTEGER, mtime_ns INTEGER, hashed_ns INTEGER, digest TEXT, "
+            "PRIMARY KEY (path, algorithm))"
+        )
+        db.execute(
+            "CREATE TABLE synced (peer TEXT, path TEXT, synced REAL, "
+            "algorithm TEXT, digest TEXT, PRIMARY KEY (peer, path))"
+        )
+
+    def get(self, path, algorithm, file_stat):
+        """Return the stored digest of `path`, if the file is unchanged.
+
+        Args:
+            path (str): file path (relative to the target's root)
+            algorithm (str): hashlib algorithm name
+            file_stat (os.stat_result): current stat of the file
+        Returns:
+            str or None
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT ino, size, mtime_ns, hashed_ns, digest FROM hashes "
+                "WHERE path = ? AND algorithm = ?",
+                (path, algorithm),
+            ).fetchone()
+        if not row:
+            return None
+        ino, size, mtime_ns, hashed_ns, digest = row
+        if (
+            ino != file_stat.st_ino
+            or size != file_stat.st_size
+            or mtime_ns != file_stat.st_mtime_ns
+            or mtime_ns >= hashed_ns - self.RACY_NS
+        ):
+            return None
+        return digest
+
+    def put(self, path, algorithm, file_stat, digest):
+        """Store the digest of `path` (`file_stat` was taken before hashing)."""
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    path,
+                    algorithm,
+                    file_stat.st_ino,
+                    file_stat.st_size,
+                    file_stat.st_mtime_ns,
+                    time.time_ns(),
+                    digest,
+                ),
+            )
+            self._changed()
+
+    def get_synced(self, peer, path):
+        """Return the digest of `path` when it was synchronized with `peer`.
+
+        The caller must check that `synced` matches the time of the last
+        synchronization (files may have been synchronized while the cache was
+        not used).
+
+        Args:
+            peer (str): the peer target's id
+            path (str): file path (relative to the target's root)
+        Returns:
+            (synced, algorithm, hexdigest) tuple or None
+        """
+        with self._lock:
+            return self._db.execute(
+                "SELECT synced, algorithm, digest FROM synced "
+                "WHERE peer = ? AND path = ?",
+                (peer, path),
+            ).fetchone()
+
+    def set_synced(self, peer, path, synced, algorithm, digest):
+        """Store the digest of `path` after it was synchronized with `peer`.
+
+        Args:
+            peer (str): the peer target's id
+            path (str): file path (relative to the target's root)
+            synced (float): time stamp of the synchronization (the 'u' value
+                of the sync info)
+            algorithm (str): hashlib algorithm name
+            digest (str):
+        """
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO synced VALUES (?, ?, ?, ?, ?)",
+                (peer, path, synced, algorithm, digest),
+            )
+            self._changed()
@@ -0,0 +1,176 @@
+"""
+(c) 2012-2024 Martin Wendt; see https://github.com/mar10/pyftpsync
+Licensed under the MIT license: https://www.opensource.org/licenses/mit-license.php
+
+Persistent directory listing cache for remote targets (`--trust-cache`).
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from posixpath import join as join_url
+
+from ftpsync.metadata import DirMetadata
+from ftpsync.resources import DirectoryEntry, FileEntry
+from ftpsync.stat_index import SqliteCache
+
+
+def get_cache_dir():
+    """Return the folder that holds the per-user cache files (may not exist)."""
+    if os.name == "nt":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "pyftpsync")
+
+
+# ===============================================================================
+# RemoteListingCache
+# ===============================================================================
+class RemoteListingCache(SqliteCache):
+    """SQLite database that stores directory listings of a remote target.
+
+    The listing of a directory is stored together with its metadata and the
+    `modify` fact that the parent listing reported for the directory.
+    It is re-used as long as the parent listing reports the same value, i.e.
+    no entries were added, removed or renamed. This saves the MLSD (or
+    `listdir_attr`) request and the download of `.pyftpsync-meta.json`.
+
+    The root folder is always listed, but listings of sub folders may
+    themselves be taken from the cache. So changes that other clients made
+    below an unchanged folder, or files that were modified in place, are not
+    detected (hence `--trust-cache`). Pass `--refresh-cache` to list all
+    folders again and rewrite the cache.
+    Folders that the target writes to itself are always listed again.
+
+    Instances are shared by the target's clones (thread safe).
+
+    Args:
+        path (str): location of the database file
+    """
+
+    #: v2: store the names of the metadata files
+    VERSION = 2
+    #: Folder for the database files (default: :func:`get_cache_dir`)
+    CACHE_DIR = None
+    #: Listings of directories that were modified this short before they were
+    #: listed (in server time) are not trusted, since the `modify` fact may
+    #: not change for subsequent modifications
+    RACY_SECS = 2.0
+
+    def __init__(self, path):
+        super().__init__(path)
+        #: {path: mtime} of the sub folders that were listed in this session
+        self._dir_mtimes = {}
+        self._dir_mtimes_lock = threading.Lock()
+
+    @classmethod
+    def for_target(cls, target):
+        """Open the cache file that belongs to `target.get_id()`."""
+        cache_dir = cls.CACHE_DIR or get_cache_dir()
+        os.makedirs(cache_dir, exist_ok=True)
+        key = hashlib.sha1(target.get_id().encode("utf-8")).hexdigest()
+        return cls(os.path.join(cache_dir, f"listing-{key}.sqlite"))
+
+    def _create_tables(self, db):
+        db.execute("DROP TABLE IF EXISTS dirs")
+        db.execute(
+            "CREATE TABLE dirs (path TEXT PRIMARY KEY, mtime REAL, "
+            "listed REAL, entries TEXT, meta TEXT)"
+        )
+
+    def _add_dir_mtimes(self, path, entries):
+        with self._dir_mtimes_lock:
+            for name, is_dir, _size, mtime, _unique in entries:
+                if is_dir:
+                    self._dir_mtimes[join_url(path, name)] = mtime
+
+    def get(self, target):
+        """Return the stored listing of `target.cur_dir`, if it is unchanged.
+
+        `target.cur_dir_meta` is restored on success.
+
+        Args:
+            target (:class:`ftpsync.targets._Target`):
+        Returns:
+            list of :class:`ftpsync.resources._Resource` or None
+        """
+        path = target.cur_dir
+        with self._dir_mtimes_lock:
+            dir_mtime = self._dir_mtimes.get(path)
+        if dir_mtime is None:
+            return None  # The root folder, or a folder that was not listed
+        with self._lock:
+            row = self._db.execute(
+                "SELECT mtime, listed, entries, meta FROM dirs WHERE path = ?",
+                (path,),
+            ).fetchone()
+        if not row:
+            return None
+        mtime, listed, entries, meta = row
+        if mtime != dir_mtime or mtime >= listed - self.RACY_SECS:
+            return None
+
+        entries = json.loads(entries)
+        self._add_dir_mtimes(path, entries)
+
+        dir_meta = DirMetadata(target)
+        if meta is not None:
+            dir_meta.found, dir_meta.dir = json.loads(meta)
+            dir_meta.list = dir_meta.dir["mtimes"]
+            dir_meta.peer_sync = dir_meta.dir["peer_sync"]
+            dir_meta.was_read = True
+            # Let flush() convert the file to the target's format
+            dir_meta.modified_list = dir_meta.filename not in dir_meta.found
+        target.cur_dir_meta = dir_meta
+
+        entry_list = []
+        for name, is_dir, size, mtime, unique in entries:
+            if is_dir:
+                entry = DirectoryEntry(target, path, name, size, mtime, unique)
+            else:
+                entry = FileEntry(target, path, name, size, mtime, unique)
+                entry.meta = dir_meta.list.get(name)
+            entry_list.append(entry)
+        return entry_list
+
+    def put(self, target, entry_list):
+        """Store the listing of `target.cur_dir` (see :meth:`get`)."""
+        path = target.cur_dir
+        entries = [(e.name, e.is_dir(), e.size, e.mtime, e.unique) for e in entry_list]
+        self._add_dir_mtimes(path, entries)
+        with self._dir_mtimes_lock:
+            dir_mtime = self._dir_mtimes.get(path)
+        if dir_mtime is None:
+            return  # Cannot be validated
+        dir_meta = target.cur_dir_meta
+        meta = None
+        if dir_meta and dir_meta.was_read:
+            meta = json.dumps(
+                [dir_meta.found, dir_meta.dir],
+                ensure_ascii=False,
+                separators=(",", ":"),
+            )
+        # The server's clock, when the listing was received
+        listed = time.time() + (target.server_time_ofs or 0)
+        data = json.dumps(entries, ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?, ?)",
+                (path, dir_mtime, listed, data, meta),
+            )
+            self._changed()
+
+    def invalidate(self, path, name=None):
+        """Forget the listing of `path` (and the sub tree `name`, if any)."""
+        with self._lock:
+            self._db.execute("DELETE FROM dirs WHERE path = ?", (path,))
+            if name:
+                sub_path = join_url(path, name)
+                self._db.execute(
+                    "DELETE FROM dirs WHERE path = ? OR substr(path, 1, ?) = ?",
+                    (sub_path, len(sub_path) + 1, sub_path + "/"),
+                )
+            self._changed()
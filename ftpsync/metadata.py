@@ -3,10 +3,16 @@
 Licensed under the MIT license: https://www.opensource.org/licenses/mit-license.php
 """
 
+import copy
+import io
 import json
+import threading
 import time
+from posixpath import join as join_url
+from posixpath import normpath as normpath_url
+from posixpath import relpath as relpath_url
 
-from ftpsync import __version__
+from ftpsync import __version__, binary_meta
 from ftpsync.util import (
     get_option,
     make_native_dict_keys,
@@ -32,6 +38,14 @@ class DirMetadata:
     """"""
 
     META_FILE_NAME = ".pyftpsync-meta.json"
+    #: Name of the metadata file in compact binary format (`--meta-format`)
+    BINARY_META_FILE_NAME = ".pyftpsync-meta.bin"
+    #: Name of the file that changes are appended to (`--meta-journal`)
+    JOURNAL_FILE_NAME = ".pyftpsync-meta.journal"
+    META_FILE_NAMES = (META_FILE_NAME, BINARY_META_FILE_NAME, JOURNAL_FILE_NAME)
+    #: The journal is merged into the metadata file when it grows larger than
+    #: the metadata file (and this minimum size)
+    JOURNAL_COMPACT_SIZE = 64 * 1024
     LOCK_FILE_NAME = ".pyftpsync-lock.json"
     # False: Reduce file size to 35% (like 3759 -> 1375 bytes)
     PRETTY = PYFTPSYNC_VERBOSE_META
@@ -47,8 +61,21 @@ class DirMetadata:
         self.list = {}
         self.peer_sync = {}
         self.dir = {"mtimes": self.list, "peer_sync": self.peer_sync}
-        #: str: ".pyftpsync-meta.json"
-        self.filename = self.META_FILE_NAME
+        #: str: ".pyftpsync-meta.json" or ".pyftpsync-meta.bin" (`--meta-format`)
+        if target.get_option("meta_format") == "binary":
+            self.filename = self.BINARY_META_FILE_NAME
+        else:
+            self.filename = self.META_FILE_NAME
+        #: list: Names of the metadata files that exist (set by read())
+        self.found = []
+        #: bool: Append changes to the journal instead of rewriting the file
+        self.use_journal = bool(target.get_option("meta_journal"))
+        #: list: Changes since the last read/write (`--meta-journal`)
+        self.journal = []
+        #: int: Size of the journal file (None: unknown, i.e. do not append)
+        self.journal_size = None
+        #: int: Size of the metadata file that was read or written
+        self.file_size = 0
         #: bool: True if a least one FTP file entry time was changed since last read/write
         self.modified_list = False
         #: bool: True if a least one peer data entry was changed since last read/write
@@ -83,6 +110,8 @@ class DirMetadata:
             )
         # print("set_mtime", self.list[filename])
         self.modified_list = True
+        if self.use_journal:
+            self.journal.append(["m", filename, self.list[filename]])
 
     def set_sync_info(self, filename, mtime, size):
         """Store mtime/size when local and remote file was last synchronized.
@@ -104,43 +133,130 @@ class DirMetadata:
             pse["mtime_str"] = pretty_stamp(mtime) if mtime else "(directory)"
             pse["uploaded_str"] = pretty_stamp(ut)
         self.modified_sync = True
+        if self.use_journal:
+            self.journal.append(["p", remote_target.get_id(), filename, pse])
 
     def remove(self, filename):
         """Remove any data for the given file name."""
         if self.list.pop(filename, None):
             self.modified_list = True
+            if self.use_journal:
+                self.journal.append(["-m", filename])
         if self.target.peer:  # otherwise `scan` command
             if self.target.is_local():
                 remote_target = self.target.peer
                 if remote_target.get_id() in self.dir["peer_sync"]:
                     rid = remote_target.get_id()
-                    self.modified_sync = bool(
-                        self.dir["peer_sync"][rid].pop(filename, None)
-                    )
+                    # Don't reset the flag if the entry was already removed
+                    # (FTP and SFTP targets also call this in remove_file())
+                    if self.dir["peer_sync"][rid].pop(filename, None):
+                        self.modified_sync = True
+                        if self.use_journal:
+                            self.journal.append(["-p", rid, filename])
         return
 
-    def read(self):
-        """Initialize self from .pyftpsync-meta.json file."""
+    def _apply_journal_record(self, rec):
+        op = rec[0]
+        if op == "m":
+            self.list[rec[1]] = rec[2]
+        elif op == "-m":
+            self.list.pop(rec[1], None)
+        elif op == "p":
+            ps = self.peer_sync.setdefault(rec[1], {})
+            ps[rec[2]] = rec[3]
+            ps[":last_sync"] = rec[3]["u"]
+            if self.PRETTY:
+                ps[":last_sync_str"] = pretty_stamp(rec[3]["u"])
+        elif op == "-p":
+            self.peer_sync.get(rec[1], {}).pop(rec[2], None)
+        else:
+            raise ValueError(f"Invalid journal record: {rec!r}")
+
+    def _read_journal(self):
+        """Apply the changes from the journal file; return its size."""
+        with self.target.open_readable(self.JOURNAL_FILE_NAME) as fp:
+            data = fp.read()
+        self.journal_size = len(data)
+        for line in data.decode("utf-8").splitlines():
+            try:
+                self._apply_journal_record(json.loads(line))
+            except Exception as e:
+                # E.g. an interrupted append: rewrite the file
+                write_error(f"Skipping invalid journal record in {self}: {e!r}")
+                self.journal_size = None
+                self.modified_list = True
+        return len(data)
+
+    def read(self, found=None):
+        """Initialize self from .pyftpsync-meta.json file (or the manifest).
+
+        Args:
+            found (list, optional): names of the metadata files that exist in
+                this directory (default: [META_FILE_NAME]). The file in the
+                target's format is preferred; other formats are migrated by
+                the next flush().
+        """
         assert self.path == self.target.cur_dir
+        manifest = self.target.manifest
+        dir_data = manifest.get(self.path) if manifest else None
+        if dir_data is not None:
+            self.was_read = True
+            self.dir = dir_data
+            self.list = self.dir["mtimes"]
+            self.peer_sync = self.dir["peer_sync"]
+            if found:
+                # Left over from an interrupted migration
+                manifest.discard_files(self.path, found)
+            return
+        self.found = list(found or [self.META_FILE_NAME])
+        base_names = [n for n in self.found if n != self.JOURNAL_FILE_NAME]
+        if self.filename in base_names or not base_names:
+            filename = self.filename
+        else:
+            filename = base_names[0]
         try:
             self.modified_list = False
             self.modified_sync = False
             is_valid_file = False
 
-            s = self.target.read_text(self.filename)
-            # print("s", s)
-            if self.target.synchronizer:
-                self.target.synchronizer._inc_stat("meta_bytes_read", len(s))
-            self.was_read = True  # True if a file exists (even invalid)
-            self.dir = json.loads(s)
-            # import pprint
-            # print("dir")
-            # print(pprint.pformat(self.dir))
-            self.dir = make_native_dict_keys(self.dir)
-            # print(pprint.pformat(self.dir))
+            # Prefetched listings are read by a clone of the bound target
+            synchronizer = self.target.synchronizer or (
+                self.target.primary and self.target.primary.synchronizer
+            )
+            if not base_names:
+                # Only a journal exists
+                self.was_read = True
+                self.dir["_file_version"] = self.VERSION
+                size = 0
+            elif filename == self.BINARY_META_FILE_NAME:
+                self.was_read = True  # True if a file exists (even invalid)
+                with self.target.open_readable(filename) as fp:
+                    self.dir, size = binary_meta.load(fp)
+                self.dir["_file_version"] = self.VERSION
+            else:
+                s = self.target.read_text(filename)
+                # print("s", s)
+                size = len(s)
+                self.was_read = True  # True if a file exists (even invalid)
+                self.dir = json.loads(s)
+                # import pprint
+                # print("dir")
+                # print(pprint.pformat(self.dir))
+                self.dir = make_native_dict_keys(self.dir)
+                # print(pprint.pformat(self.dir))
+            self.file_size = size
             self.list = self.dir["mtimes"]
             self.peer_sync = self.dir["peer_sync"]
+            self.journal_size = 0
+            if self.JOURNAL_FILE_NAME in self.found:
+                size += self._read_journal()
+            if synchronizer:
+                synchronizer._inc_stat("meta_bytes_read", size)
             is_valid_file = True
+            if manifest or (base_names and filename != self.filename):
+                # Let flush() convert the file to the target's format (or move
+                # it to the manifest)
+                self.modified_list = True
             # write"DirMetadata: read(%s)" % (self.filename, ), self.dir)
         # except IncompatibleMetadataVersionError:
         #     raise  # We want version errors to terminate the app
@@ -182,44 +298,300 @@ class DirMetadata:
             # write("DirMetadata.flush(%s): dry-run; nothing to do" % self.target)
             pass
 
+        elif self.target.manifest:
+            # The manifest is written periodically and when the target is closed
+            manifest = self.target.manifest
+            if self.modified_list or self.modified_sync:
+                manifest.put(self.path, self.list, self.peer_sync)
+                if self.found:
+                    manifest.discard_files(self.path, self.found)
+                    self.found = []
+            manifest.flush_if_due(self.target)
+
         elif self.was_read and len(self.list) == 0 and len(self.peer_sync) == 0:
             write(f"Remove empty meta data file: {self.target}")
-            self.target.remove_file(self.filename)
+            for name in self.found:
+                self.target.remove_file(name)
+            self.found = []
 
         elif not self.modified_list and not self.modified_sync:
             # write("DirMetadata.flush(%s): unmodified; nothing to do" % self.target)
             pass
 
-        else:
-            self.dir["_disclaimer"] = "Generated by https://github.com/mar10/pyftpsync"
-            self.dir["_time_str"] = pretty_stamp(time.time())
-            self.dir["_file_version"] = self.VERSION
-            self.dir["_version"] = __version__
-            self.dir["_time"] = time.mktime(time.gmtime())
-
-            # We always save utf-8 encoded.
-            # `ensure_ascii` would escape all bytes >127 as `\x12` or `\u1234`,
-            # which makes it hard to read, so we set it to false.
-            # `sort_keys` converts binary keys to unicode using utf-8, so we
-            # must make sure that we don't pass cp1225 or other encoded data.
-            data = self.dir
-            opts = {"indent": 4, "sort_keys": True, "ensure_ascii": False}
-
-            # if compat.PY2:
-            #     # The `encoding` arg defaults to utf-8 on Py2 and was removed in Py3
-            #     # opts["encoding"] = "utf-8"
-            #     # Python 2 has problems with mixed keys (str/unicode)
-            #     data = decode_dict_keys(data, "utf-8")
-
-            if not self.PRETTY:
-                opts["indent"] = None
-                opts["separators"] = (",", ":")
-
-            s = json.dumps(data, **opts)
+        elif self._can_append_journal():
+            self._append_journal()
 
-            self.target.write_text(self.filename, s)
-            if self.target.synchronizer:
-                self.target.synchronizer._inc_stat("meta_bytes_written", len(s))
+        else:
+            self._write_file()
+            for name in self.found:
+                if name != self.filename:
+                    # Migrated to the target's format, or merged journal
+                    self.target.remove_file(name)
+            self.found = [self.filename]
+            self.journal_size = 0
 
         self.modified_list = False
         self.modified_sync = False
+        self.journal = []
+
+    def _can_append_journal(self):
+        return (
+            self.use_journal
+            and self.journal
+            and self.filename in self.found
+            and self.journal_size is not None
+            and self.journal_size < max(self.JOURNAL_COMPACT_SIZE, self.file_size)
+        )
+
+    def _append_journal(self):
+        """Append the changes to the journal file."""
+        s = "".join(
+            json.dumps(rec, ensure_ascii=False, separators=(",", ":")) + "\n"
+            for rec in self.journal
+        ).encode("utf-8")
+        self.target.write_file(
+            self.JOURNAL_FILE_NAME, io.BytesIO(s), offset=self.journal_size
+        )
+        self.journal_size += len(s)
+        if self.JOURNAL_FILE_NAME not in self.found:
+            self.found.append(self.JOURNAL_FILE_NAME)
+        if self.target.synchronizer:
+            self.target.synchronizer._inc_stat("meta_bytes_written", len(s))
+
+    @classmethod
+    def _dumps(cls, data):
+        # We always save utf-8 encoded.
+        # `ensure_ascii` would escape all bytes >127 as `\x12` or `\u1234`,
+        # which makes it hard to read, so we set it to false.
+        # `sort_keys` converts binary keys to unicode using utf-8, so we
+        # must make sure that we don't pass cp1225 or other encoded data.
+        opts = {"indent": 4, "sort_keys": True, "ensure_ascii": False}
+
+        # if compat.PY2:
+        #     # The `encoding` arg defaults to utf-8 on Py2 and was removed in Py3
+        #     # opts["encoding"] = "utf-8"
+        #     # Python 2 has problems with mixed keys (str/unicode)
+        #     data = decode_dict_keys(data, "utf-8")
+
+        if not cls.PRETTY:
+            opts["indent"] = None
+            opts["separators"] = (",", ":")
+
+        return json.dumps(data, **opts)
+
+    def _write_file(self):
+        """Write self.dir to .pyftpsync-meta.json."""
+        self.dir["_disclaimer"] = "Generated by https://github.com/mar10/pyftpsync"
+        self.dir["_time_str"] = pretty_stamp(time.time())
+        self.dir["_file_version"] = self.VERSION
+        self.dir["_version"] = __version__
+        self.dir["_time"] = time.mktime(time.gmtime())
+
+        if self.filename == self.BINARY_META_FILE_NAME:
+            s = binary_meta.dumps(self.dir)
+            self.target.write_file(self.filename, io.BytesIO(s))
+        else:
+            s = self._dumps(self.dir)
+            self.target.write_text(self.filename, s)
+        self.file_size = len(s)
+        if self.target.synchronizer:
+            self.target.synchronizer._inc_stat("meta_bytes_written", len(s))
+
+
+# ===============================================================================
+# Manifest
+# ===============================================================================
+class Manifest:
+    """Metadata of all directories of a remote target in one file (`--manifest`).
+
+    The file is read once when the target is opened, instead of one
+    `.pyftpsync-meta.json` per directory. It is written when the target is
+    closed, and also during a run if it was modified and not written for
+    :attr:`FLUSH_INTERVAL` seconds, so an interrupted run loses little.
+    It is written to a temporary file first and then renamed, so readers
+    never see a partial file.
+
+    Directories that are not part of the manifest fall back to their
+    `.pyftpsync-meta.json` file (e.g. trees that were synchronized before).
+    They are moved to the manifest, and the per-directory files are removed
+    once the manifest was written.
+    If the manifest cannot be written, the modified directories are written
+    in the per-directory format instead.
+
+    Instances are shared by the target's clones (thread safe).
+
+    Args:
+        target (:class:`ftpsync.targets._Target`): the (primary) remote target
+    """
+
+    FILE_NAME = ".pyftpsync-manifest.json"
+    TEMP_FILE_NAME = FILE_NAME + ".new"
+    # Increment file version if format changes. Old files will be discarded then!
+    VERSION = 1
+    #: Write a modified manifest during a run after this number of seconds
+    FLUSH_INTERVAL = 60
+
+    def __init__(self, target):
+        self.target = target
+        #: {rel_path: {"mtimes": {...}, "peer_sync": {...}}}
+        self.dirs = {}
+        #: Paths that were modified since the manifest was written
+        self.modified = set()
+        #: {rel_path: [names]} of per-directory metadata files that are removed
+        #: after the manifest was written
+        self.obsolete = {}
+        #: Time of the last write (or of the read)
+        self.flushed = time.monotonic()
+        self._lock = threading.RLock()
+
+    def __str__(self):
+        return f"Manifest<{self.target}>"
+
+    def _get_key(self, path):
+        return relpath_url(path, self.target.root_dir)
+
+    def get(self, path):
+        """Return a copy of the metadata dict of the directory `path` (or None).
+
+        The manifest is written by other threads, so callers never get
+        references to its dicts (see also :meth:`put`).
+        """
+        with self._lock:
+            return copy.deepcopy(self.dirs.get(self._get_key(path)))
+
+    def put(self, path, mtimes, peer_sync):
+        """Store a copy of the metadata of the directory `path`."""
+        key = self._get_key(path)
+        with self._lock:
+            if mtimes or peer_sync:
+                self.dirs[key] = copy.deepcopy(
+                    {"mtimes": mtimes, "peer_sync": peer_sync}
+                )
+            else:
+                self.dirs.pop(key, None)
+            self.modified.add(key)
+        if self.target.listing_cache:
+            # Cached listings contain the metadata as well
+            self.target.listing_cache.invalidate(path)
+
+    def discard_files(self, path, names):
+        """Remove the metadata files `names` of `path` after the next write."""
+        with self._lock:
+            self.obsolete.setdefault(self._get_key(path), []).extend(names)
+
+    def remove_tree(self, path):
+        """Forget the metadata of the directory `path` and its sub directories."""
+        key = self._get_key(path)
+        prefix = key + "/"
+        with self._lock:
+            for k in list(self.dirs):
+                if k == key or k.startswith(prefix):
+                    del self.dirs[k]
+                    self.modified.add(k)
+            for k in list(self.obsolete):
+                if k == key or k.startswith(prefix):
+                    del self.obsolete[k]
+
+    def read(self):
+        """Read the manifest from the target's root folder (if it exists)."""
+        target = self.target
+        assert target.cur_dir == target.root_dir
+        try:
+            s = target.read_text(self.FILE_NAME)
+        except Exception as e:
+            # FTP reports missing files as '550 ...'
+            if isinstance(e, FileNotFoundError) or str(e).startswith("550"):
+                return
+            raise
+        if target.synchronizer:
+            target.synchronizer._inc_stat("meta_bytes_read", len(s))
+        data = json.loads(s)
+        if data.get("_file_version", 0) != self.VERSION:
+            if not target.get_option("migrate"):
+                raise IncompatibleMetadataVersionError(
+                    "Invalid manifest version: {} (expected {}).\n"
+                    "Consider passing --migrate to discard old data.".format(
+                        data.get("_file_version"), self.VERSION
+                    )
+                )
+            write(f"Discarding manifest version {data.get('_file_version')}")
+            self.modified.add(".")
+            return
+        self.dirs = make_native_dict_keys(data["dirs"])
+
+    def flush_if_due(self, target):
+        """Call :meth:`flush` if the last write is :attr:`FLUSH_INTERVAL` ago."""
+        if time.monotonic() - self.flushed >= self.FLUSH_INTERVAL:
+            self.flush(target)
+
+    def flush(self, target=None):
+        """Write the manifest if it was modified and remove obsolete files.
+
+        Args:
+            target (:class:`ftpsync.targets._Target`, optional): the connection
+                that is used (default: the primary target). Its current
+                directory is restored.
+        """
+        target = target or self.target
+        with self._lock:
+            if not (self.modified or self.obsolete) or target.dry_run:
+                return
+            cur_dir, cur_dir_meta = target.cur_dir, target.cur_dir_meta
+            try:
+                if self.modified and not self._write(target):
+                    self.obsolete = {}
+                self._remove_obsolete(target)
+            finally:
+                target.cwd(cur_dir)
+                target.cur_dir_meta = cur_dir_meta
+            self.flushed = time.monotonic()
+
+    def _write(self, target):
+        """Write the manifest (False: the directories were written instead)."""
+        data = {
+            "_disclaimer": "Generated by https://github.com/mar10/pyftpsync",
+            "_time_str": pretty_stamp(time.time()),
+            "_file_version": self.VERSION,
+            "_version": __version__,
+            "_time": time.mktime(time.gmtime()),
+            "dirs": self.dirs,
+        }
+        try:
+            s = DirMetadata._dumps(data)
+            target.cwd(target.root_dir)
+            target.write_text(self.TEMP_FILE_NAME, s)
+            target.rename(self.TEMP_FILE_NAME, self.FILE_NAME)
+        except Exception as e:
+            write_error(f"Could not write {self}: {e!r}")
+            self._flush_dirs(target)
+            self.modified = set()
+            return False
+        if target.synchronizer:
+            target.synchronizer._inc_stat("meta_bytes_written", len(s))
+        self.modified = set()
+        return True
+
+    def _flush_dirs(self, target):
+        """Write the modified directories in the per-directory format."""
+        for key in sorted(self.modified):
+            path = normpath_url(join_url(target.root_dir, key))
+            dir_data = self.dirs.get(key)
+            if not dir_data:
+                continue
+            target.cwd(path)
+            dir_meta = DirMetadata(target)
+            dir_meta.list = dir_data["mtimes"]
+            dir_meta.peer_sync = dir_data["peer_sync"]
+            dir_meta.dir = dict(dir_data)
+            dir_meta._write_file()
+
+    def _remove_obsolete(self, target):
+        """Remove per-directory metadata files that are part of the manifest."""
+        for key, names in sorted(self.obsolete.items()):
+            try:
+                target.cwd(normpath_url(join_url(target.root_dir, key)))
+                for name in set(names):
+                    target.remove_file(name)
+            except Exception as e:
+                write_error(f"Could not remove metadata files in {key!r}: {e!r}")
+        self.obsolete = {}
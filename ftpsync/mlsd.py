@@ -0,0 +1,105 @@
+"""
+(c) 2012-2024 Martin Wendt; see https://github.com/mar10/pyftpsync
+Licensed under the MIT license: https://www.opensource.org/licenses/mit-license.php
+
+Fast parser for MLSD listings (RFC 3659).
+
+An MLSD line consists of `fact=value;` pairs, followed by a space and the
+file name::
+
+    type=file;size=1234;modify=20240101120000.123;unique=801g3c; file.txt
+
+See https://tools.ietf.org/html/rfc3659#section-7
+"""
+
+import sys
+from calendar import monthrange, timegm
+
+#: Lowercased and interned fact names by their spelling in the listing
+_fact_names = {}
+#: Epoch seconds of the day by "YYYYMMDD" prefix (listings share few dates)
+_day_stamps = {}
+#: The date cache is cleared when it grows larger than this
+MAX_CACHED_DAYS = 10000
+
+
+def _fact_name(name):
+    """Return the interned, lowercased version of `name` (cached)."""
+    res = _fact_names.get(name)
+    if res is None:
+        res = _fact_names[name] = sys.intern(name.lower())
+    return res
+
+
+def parse_time(value):
+    """Return the epoch time of a `modify` fact value (UTC).
+
+    The value has the fixed-width form 'YYYYMMDDHHMMSS[.sss]'. Fractions of a
+    second are ignored.
+
+    Returns:
+        int
+    Raises:
+        ValueError: if the value is malformed
+    """
+    day = _day_stamps.get(value[:8])
+    if day is None:
+        if len(value) < 14 or not value[:14].isdigit():
+            raise ValueError(f"Invalid MLSD time value: {value!r}")
+        year, month, mday = int(value[:4]), int(value[4:6]), int(value[6:8])
+        if not 1 <= month <= 12 or not 1 <= mday <= monthrange(year, month)[1]:
+            raise ValueError(f"Invalid MLSD time value: {value!r}")
+        if len(_day_stamps) >= MAX_CACHED_DAYS:
+            _day_stamps.clear()
+        day = _day_stamps[value[:8]] = timegm((year, month, mday, 0, 0, 0))
+    elif len(value) < 14 or not value[8:14].isdigit():
+        raise ValueError(f"Invalid MLSD time value: {value!r}")
+    hour, minute, sec = int(value[8:10]), int(value[10:12]), int(value[12:14])
+    if hour > 23 or minute > 59 or sec > 61:
+        raise ValueError(f"Invalid MLSD time value: {value!r}")
+    return day + hour * 3600 + minute * 60 + sec
+
+
+def parse_line(line):
+    """Parse one MLSD line.
+
+    Returns:
+        (name, type, size, mtime, unique) tuple. `type` is the lowercase
+        value of the `type` fact ('file', 'dir', 'cdir', 'pdir', ...), the
+        other values are None if the fact is missing.
+    Raises:
+        ValueError: if a `size` or `modify` fact is malformed
+    """
+    facts, _, name = line.partition("; ")
+    res_type = size = mtime = unique = None
+    for fact in facts.split(";"):
+        fact_name, _, value = fact.partition("=")
+        fact_name = _fact_names.get(fact_name) or _fact_name(fact_name)
+        if fact_name == "type":
+            res_type = value.lower()
+        elif fact_name == "size" or fact_name == "sizd":
+            size = int(value)
+        elif fact_name == "modify":
+            mtime = parse_time(value)
+        elif fact_name == "unique":
+            unique = value
+    return name, res_type, size, mtime, unique
+
+
+def parse_lines(lines):
+    """Parse an MLSD listing in one pass.
+
+    Args:
+        lines (iterable of str): the listing lines (empty lines are skipped)
+    Yields:
+        (name, type, size, mtime, unique) tuples (see :func:`parse_line`)
+    """
+    parse = parse_line
+    for line in lines:
+        if line:
+            yield parse(line)
+
+
+def parse_listing(text):
+    """Parse a complete MLSD listing (str), as received from the server."""
+    return list(parse_lines(text.splitlines()))
@@ -0,0 +1,197 @@
+"""
+(c) 2012-2024 Martin Wendt; see https://github.com/mar10/pyftpsync
+Licensed under the MIT license: https://www.opensource.org/licenses/mit-license.php
+
+Serializable synchronization plans.
+
+A plan is written as JSON lines, so it can be streamed while the trees are
+traversed and reviewed (or filtered) with standard tools::
+
+    {"type": "header", "version": 1, "synchronizer": "UploadSynchronizer", ...}
+    {"type": "op", "dir": "folder1", "name": "file1_1.txt", "op": "copy_local",
+     "local": [8, 1700000000.0], "remote": null, "is_dir": false, "bytes": 8}
+    ...
+    {"type": "summary", "ops": {"copy_local": 12, ...}, "bytes": {...}}
+
+Records of one directory are always contiguous.
+"""
+
+import json
+
+from ftpsync.util import eps_compare
+
+#: Plan file format version
+PLAN_VERSION = 1
+
+#: Operations that copy the local or remote entry
+_COPY_SOURCE = {"copy_local": "local", "copy_remote": "remote"}
+
+
+def entry_state(entry):
+    """Return a JSON compatible snapshot of `entry` (None if missing)."""
+    if entry is None:
+        return None
+    elif entry.is_dir():
+        return True
+    return [entry.size, entry.mtime]
+
+
+def entry_state_matches(entry, state, eps=0):
+    """Return True if `entry` still matches a snapshot from :func:`entry_state`."""
+    if entry is None or state is None or state is True:
+        return entry_state(entry) == state
+    elif entry.is_dir():
+        return False
+    size, mtime = state
+    return entry.size == size and eps_compare(entry.mtime, mtime, eps) == 0
+
+
+# ===============================================================================
+# SyncPlanWriter
+# ===============================================================================
+class SyncPlanWriter:
+    """Write a synchronization plan to a text file, one JSON record per line.
+
+    Args:
+        fp (file-like): opened for writing text
+        synchronizer (:class:`ftpsync.synchronizers.BaseSynchronizer`):
+    """
+
+    def __init__(self, fp, synchronizer):
+        self.fp = fp
+        #: {operation: count}
+        self.op_counts = {}
+        #: {operation: bytes}
+        self.op_bytes = {}
+        self._write(
+            {
+                "type": "header",
+                "version": PLAN_VERSION,
+                "synchronizer": synchronizer.__class__.__name__,
+                "local": synchronizer.local.get_base_name(),
+                "remote": synchronizer.remote.get_base_name(),
+            }
+        )
+
+    def _write(self, record):
+        self.fp.write(json.dumps(record, ensure_ascii=False))
+        self.fp.write("\n")
+
+    def add(self, rel_dir, pair, action, tree=None):
+        """Append an operation for `pair` in directory `rel_dir`.
+
+        Args:
+            rel_dir (str): directory path relative to the targets' root
+            pair (:class:`ftpsync.resources.EntryPair`):
+            action (str): result of `BaseSynchronizer._get_pair_action()`
+            tree (tuple, optional): (files, bytes) of a directory that is copied
+        """
+        source = _COPY_SOURCE.get(action)
+        if tree:
+            size = tree[1]
+        elif source:
+            size = getattr(pair, source).size
+        elif action in ("conflict", "need_compare") and not pair.is_dir:
+            # Upper bound: either side may be copied
+            size = max(e.size for e in (pair.local, pair.remote) if e)
+        else:
+            size = 0
+
+        record = {
+            "type": "op",
+            "dir": rel_dir,
+            "name": pair.name,
+            "op": action,
+            "local": entry_state(pair.local),
+            "remote": entry_state(pair.remote),
+            "is_dir": pair.is_dir,
+            "bytes": size,
+        }
+        if tree:
+            record["tree"] = list(tree)
+        self._write(record)
+
+        self.op_counts[action] = self.op_counts.get(action, 0) + 1
+        self.op_bytes[action] = self.op_bytes.get(action, 0) + size
+
+    def close(self):
+        """Write the summary record."""
+        self._write({"type": "summary", "ops": self.op_counts, "bytes": self.op_bytes})
+
+
+# ===============================================================================
+# SyncPlanReader
+# ===============================================================================
+class SyncPlanReader:
+    """Read a plan that was written by :class:`SyncPlanWriter`.
+
+    Args:
+        fp (file-like): opened for reading text
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.header = self._read_record()
+        if not self.header or self.header.get("type") != "header":
+            raise RuntimeError("Invalid plan file: missing header")
+        elif self.header.get("version") != PLAN_VERSION:
+            raise RuntimeError(
+                "Unsupported plan version: {}".format(self.header.get("version"))
+            )
+        #: The summary record (available after :meth:`iter_dirs` completed)
+        self.summary = None
+
+    def _read_record(self):
+        while True:
+            line = self.fp.readline()
+            if not line:
+                return None
+            line = line.strip()
+            if line:
+                return json.loads(line)
+
+    def read_summary(self):
+        """Return the summary record, without moving the read position."""
+        pos = self.fp.tell()
+        try:
+            for _ in self.iter_dirs():
+                pass
+            return self.summary
+        finally:
+            self.fp.seek(pos)
+
+    def check_synchronizer(self, synchronizer):
+        """Raise RuntimeError if the plan was written for other targets."""
+        header = self.header
+        expected = {
+            "synchronizer": synchronizer.__class__.__name__,
+            "local": synchronizer.local.get_base_name(),
+            "remote": synchronizer.remote.get_base_name(),
+        }
+        for key, value in expected.items():
+            if header.get(key) != value:
+                raise RuntimeError(
+                    "Plan was written for {} {!r}, not {!r}".format(
+                        key, header.get(key), value
+                    )
+                )
+
+    def iter_dirs(self):
+        """Yield (rel_dir, [op_record, ...]) tuples in plan order."""
+        rel_dir = ops = None
+        while True:
+            record = self._read_record()
+            if record is None:
+                raise RuntimeError("Incomplete plan file: missing summary")
+            elif record["type"] == "summary":
+                self.summary = record
+                break
+            elif record["type"] != "op":
+                raise RuntimeError(f"Invalid plan record: {record}")
+            if record["dir"] != rel_dir:
+                if ops:
+                    yield rel_dir, ops
+                rel_dir, ops = record["dir"], []
+            ops.append(record)
+        if ops:
+            yield rel_dir, ops
@@ -94,6 +94,8 @@ class EntryPair:
         self.operation = None
         #: str:
         self.re_class_reason = None
+        #: bool: `--compare-content` found different contents
+        self.content_differs = False
         # #: bool:
         # self.was_skipped = None
 
@@ -17,18 +17,31 @@ KNOWN_RUN_COMMANDS = {"upload", "download", "sync", "tree"}
 
 KNOWN_TASK_ARGS = {
     "case",
+    "compare_content",
     "create_folder",
     "debug",
     "delete_unmatched",
     "delete",
+    "delta",
     "dry_run",
     "exclude",
+    "execute_plan",
     "files",  # tree command
     "force",
     "ftp_active",
+    "fxp",
+    "hash_cache",
     "here",
+    "keepalive",
+    "large_file_size",
+    "large_file_workers",
+    "list_tree",
     "local",
+    "manifest",
     "match",
+    "max_connections",
+    "meta_format",
+    "meta_journal",
     "migrate",
     "no_color",
     "no_dry_run",  # alias: execute
@@ -36,13 +49,23 @@ KNOWN_TASK_ARGS = {
     "no_netrc",
     "no_prompt",
     "no_verify_host_keys",
+    "prefetch",
     "progress",
     "prompt",
+    "refresh_cache",
     "report_problems",
     "resolve",
+    "resume",
     "root",
+    "sftp_block_size",
+    "sftp_window_size",
     "sort",  # tree command
+    "stat_index",
+    "transfer_order",
+    "trust_cache",
     "verbose",
+    "workers",
+    "write_plan",
 }
 
 #: Boolean task options that can be overridden by passing an argument to the
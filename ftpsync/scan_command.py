@@ -43,7 +43,9 @@ def add_scan_parser(subparsers):
     parser.add_argument(
         "--remove-meta",
         action="store_true",
-        help=f"delete all {DirMetadata.META_FILE_NAME} files",
+        help="delete all {} and {} files".format(
+            DirMetadata.META_FILE_NAME, DirMetadata.BINARY_META_FILE_NAME
+        ),
     )
     parser.add_argument(
         "--remove-locks",
@@ -118,10 +120,11 @@ def scan_handler(parser, args):
                 and target.cur_dir_meta
                 and target.cur_dir_meta.was_read
             ):
-                fspec = target.cur_dir_meta.get_full_path()
-                if fspec not in processed_files:
-                    processed_files.add(fspec)
-                    print(f"DELETE {fspec}")
+                for name in target.cur_dir_meta.found:
+                    fspec = "/".join((target.cur_dir_meta.path, name))
+                    if fspec not in processed_files:
+                        processed_files.add(fspec)
+                        print(f"DELETE {fspec}")
 
             if (
                 args.remove_locks
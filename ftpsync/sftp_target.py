@@ -3,9 +3,12 @@
 Licensed under the MIT license: https://www.opensource.org/licenses/mit-license.php
 """
 
+import hashlib
+import io
 import json
 import logging
 import os
+import shlex
 import stat
 import time
 from posixpath import join as join_url
@@ -17,9 +20,15 @@ from unittest.mock import patch
 import paramiko
 import pysftp
 
-from ftpsync.metadata import DirMetadata, IncompatibleMetadataVersionError
+from ftpsync import delta
+from ftpsync.metadata import (
+    DirMetadata,
+    IncompatibleMetadataVersionError,
+    Manifest,
+)
 from ftpsync.resources import DirectoryEntry, FileEntry
-from ftpsync.targets import _get_encoding_opt, _Target
+from ftpsync.targets import HASH_ALGORITHMS, _get_encoding_opt, _Target
+from ftpsync.tree_listing import TreeSnapshot
 from ftpsync.util import (
     CliSilentRuntimeError,
     get_credentials_for_url,
@@ -38,11 +47,22 @@ class PatchedPysftpConnection(pysftp.Connection):
     https://stackoverflow.com/a/65060184
     """
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, window_size=None, **kwargs):
         self._sftp_live = False
         self._transport = None
+        self._window_size = window_size
         super().__init__(*args, **kwargs)
 
+    def _sftp_connect(self):
+        """Establish the SFTP connection (using a custom SSH window size)."""
+        if not self._sftp_live:
+            self._sftp = paramiko.SFTPClient.from_transport(
+                self._transport, window_size=self._window_size
+            )
+            if self._default_path is not None:
+                self._sftp.chdir(self._default_path)
+            self._sftp_live = True
+
 
 # ===============================================================================
 # SFTPTarget
@@ -62,6 +82,19 @@ class SFTPTarget(_Target):
     DEFAULT_BLOCKSIZE = 8 * 1024  # ftplib uses 8k chunks by default
     # keep open_readable() buffer in memory if smaller than 100kB
     MAX_SPOOL_MEM = 100 * 1024
+    #: Bytes per SFTP read or write request (`--sftp-block-size`)
+    SFTP_BLOCKSIZE = 32 * 1024
+    #: Shell command that lists the whole tree (`--list-tree`), see
+    #: :meth:`ftpsync.tree_listing.TreeSnapshot.from_find_output`
+    TREE_LIST_COMMAND = "find {root} -mindepth 1 -printf '%y %s %T@ %P\\0' 2>/dev/null"
+    #: Chunk size when receiving the output of TREE_LIST_COMMAND
+    LISTING_BLOCKSIZE = 64 * 1024
+    #: Shell command that prints a digest, if the server does not support the
+    #: `check-file` extension (see get_hash())
+    HASH_COMMAND = "{algorithm}sum -b -- {path} 2>/dev/null"
+    #: Algorithms that are requested from the server (`check-file` and
+    #: HASH_COMMAND, i.e. coreutils `sha256sum`, ...)
+    SERVER_HASH_ALGORITHMS = ("sha256", "sha1", "md5")
 
     def __init__(
         self,
@@ -106,6 +139,11 @@ class SFTPTarget(_Target):
         #: (This is only a rough estimation, derived from the lock-file.)
         self.server_time_ofs = None
         self.ftp_socket_connected = False
+        #: (method, algorithm) pairs of get_hash() that the server refused,
+        #: method is 'check-file' or 'exec'
+        self.refused_hash_methods = set()
+        #: True if the server cannot run the `--delta` helper
+        self.delta_refused = False
         # self.support_set_time = False
         # #: Optionally define an encoding for this server
         # encoding = self.get_option("encoding", "utf-8")
@@ -121,14 +159,89 @@ class SFTPTarget(_Target):
         scheme = "sftp"
         return f"{scheme}://{self.host}{self.root_dir}"
 
+    def _make_clone(self, extra_opts):
+        return SFTPTarget(
+            self.root_dir,
+            self.host,
+            self.port,
+            username=self.username,
+            password=self.password,
+            timeout=self.timeout,
+            extra_opts=extra_opts,
+        )
+
     def open(self):
         assert not self.ftp_socket_connected
 
         super().open()
 
+        store_password = self.get_option("store_password", False)
+
+        self._connect()
+
+        try:
+            self.sftp.cwd(self.root_dir)
+        except OSError as e:
+            # '550 No such directory' is not reliably detectable with SFTP?
+
+            # Implement --create-folder option for remote targets:
+            if self.is_unbound():
+                # E.g. 'tree' command
+                write_error(
+                    f"Could not change directory to {self.root_dir} ({e}): missing permissions?"
+                )
+            elif self.is_local():
+                write_error(
+                    f"Could not change local directory to {self.root_dir} ({e}): missing permissions?"
+                )
+            else:
+                parent = os.path.dirname(self.root_dir)
+                subfolder = os.path.basename(self.root_dir)
+                if not self.get_option("create_folder", False):
+                    msg = (
+                        f"Could not change remote directory to {self.root_dir!r} ({e!r}). "
+                        "This may be due to missing permissions or because the folder does not exist. "
+                        f"Pass `--create-folder` if you want to create {subfolder!r} within {parent!r}."
+                    )
+                    raise CliSilentRuntimeError(msg, min_verbosity=4)
+
+                write_error(
+                    f"Could not change remote directory to {self.root_dir!r} ({e!r}). "
+                    f"`--create-folder` was passed: creating {subfolder!r} within {parent!r}..."
+                )
+                self.sftp.cwd(parent)
+                self.mkdir(subfolder)
+                # Must work now:
+                self.sftp.cwd(self.root_dir)
+
+        pwd = self.pwd()
+        if pwd != self.root_dir:
+            raise RuntimeError(
+                "Unable to navigate to working directory {!r} (now at {!r})".format(
+                    self.root_dir, pwd
+                )
+            )
+
+        self.cur_dir = pwd
+
+        # Successfully authenticated: store password
+        if store_password:
+            save_password(self.host, self.username, self.password)
+
+        self._open_listing_cache()
+        self._open_manifest()
+        self._open_tree_snapshot(self._read_tree_listing)
+
+        # Clones are opened by worker threads and share the primary's lock
+        if not self.primary:
+            self._lock()
+
+        return
+
+    def _connect(self):
+        """Open the SSH connection and login."""
         options = self.get_options_dict()
         no_prompt = self.get_option("no_prompt", True)
-        store_password = self.get_option("store_password", False)
         verbose = self.get_option("verbose", 3)
         verify_host_keys = not self.get_option("no_verify_host_keys", False)
         if self.get_option("ftp_active", False):
@@ -160,6 +273,7 @@ class SFTPTarget(_Target):
                     password=self.password,
                     port=self.port,
                     cnopts=cnopts,
+                    window_size=self.get_option("sftp_window_size"),
                 )
                 break
             except paramiko.ssh_exception.AuthenticationException as e:
@@ -185,60 +299,34 @@ class SFTPTarget(_Target):
         self.sftp.timeout = self.timeout
         self.ftp_socket_connected = True
 
-        try:
-            self.sftp.cwd(self.root_dir)
-        except OSError as e:
-            # '550 No such directory' is not reliably detectable with SFTP?
-
-            # Implement --create-folder option for remote targets:
-            if self.is_unbound():
-                # E.g. 'tree' command
-                write_error(
-                    f"Could not change directory to {self.root_dir} ({e}): missing permissions?"
-                )
-            elif self.is_local():
-                write_error(
-                    f"Could not change local directory to {self.root_dir} ({e}): missing permissions?"
-                )
-            else:
-                parent = os.path.dirname(self.root_dir)
-                subfolder = os.path.basename(self.root_dir)
-                if not self.get_option("create_folder", False):
-                    msg = (
-                        f"Could not change remote directory to {self.root_dir!r} ({e!r}). "
-                        "This may be due to missing permissions or because the folder does not exist. "
-                        f"Pass `--create-folder` if you want to create {subfolder!r} within {parent!r}."
-                    )
-                    raise CliSilentRuntimeError(msg, min_verbosity=4)
-
-                write_error(
-                    f"Could not change remote directory to {self.root_dir!r} ({e!r}). "
-                    f"`--create-folder` was passed: creating {subfolder!r} within {parent!r}..."
-                )
-                self.sftp.cwd(parent)
-                self.mkdir(subfolder)
-                # Must work now:
-                self.sftp.cwd(self.root_dir)
-
-        pwd = self.pwd()
-        if pwd != self.root_dir:
-            raise RuntimeError(
-                "Unable to navigate to working directory {!r} (now at {!r})".format(
-                    self.root_dir, pwd
-                )
-            )
-
-        self.cur_dir = pwd
-
-        # Successfully authenticated: store password
-        if store_password:
-            save_password(self.host, self.username, self.password)
+    def keepalive(self):
+        """Send a request to prevent a timeout of the connection.
 
-        self._lock()
-
-        return
+        If the connection was dropped, reconnect.
+        """
+        try:
+            self.sftp.normalize(".")
+        except (OSError, EOFError, paramiko.ssh_exception.SSHException) as e:
+            write(f"Lost connection to {self.host} ({e!r}): reconnecting...")
+            self.reconnect()
+
+    def reconnect(self):
+        """Open a new connection and restore the working directory."""
+        cur_dir = self.cur_dir
+        try:
+            self.sftp.close()
+        except Exception:
+            pass
+        self.sftp = None
+        self.ftp_socket_connected = False
+        self._connect()
+        self.sftp.cwd(cur_dir)
+        self.cur_dir = cur_dir
 
     def close(self):
+        if self.ftp_socket_connected:
+            self._close_manifest()
+
         if self.lock_data:
             self._unlock(closing=True)
 
@@ -249,6 +337,8 @@ class SFTPTarget(_Target):
                 write_error(f"sftp.close() failed: {e}")
             self.ftp_socket_connected = False
 
+        self._close_listing_cache()
+        self.tree_snapshot = None
         super().close()
 
     def _lock(self, break_existing=False):
@@ -301,6 +391,8 @@ class SFTPTarget(_Target):
 
     def _probe_lock_file(self, reported_mtime):
         """Called by get_dir"""
+        if not self.lock_data:
+            return  # We did not write the lock file (e.g. a clone)
         delta = reported_mtime - self.lock_data["lock_time"]
         # delta2 = reported_mtime - self.lock_write_time
         self.server_time_ofs = delta
@@ -366,7 +458,7 @@ class SFTPTarget(_Target):
                     except OSError:  # ftplib.all_errors as _e:
                         # write(f"    sftp.remove({name}) failed (not empty?), trying recursive...", debug=True)
                         # assume <name> is a folder
-                        self.rmdir(name)
+                        self._rmdir_impl(name)
             finally:
                 if dir_name != ".":
                     self.sftp.cwd("..")
@@ -378,6 +470,8 @@ class SFTPTarget(_Target):
     def rmdir(self, dir_name):
         # self.check_write(dir_name)
         # return self.sftp.rmdir(dir_name)
+        if self.manifest:
+            self.manifest.remove_tree(join_url(self.cur_dir, dir_name))
         return self._rmdir_impl(dir_name)
 
     try:
@@ -397,48 +491,62 @@ class SFTPTarget(_Target):
     def get_dir(self):
         # Fallback to cp1252 if utf8 fails
         with patch("paramiko.message.u", SFTPTarget._paramiko_py3compat_u_wrapper):
-            res = self._get_dir_impl()
+            res = self._get_dir_cached(self._get_dir_impl)
         return res
 
     def _get_dir_impl(self):
         entry_list = []
         entry_map = {}
         has_meta = False
+        meta_files = []
+
+        infos = self._pop_tree_listing()
+        if infos is None:
+            infos = [
+                (
+                    de.filename,
+                    "dir" if stat.S_ISDIR(de.st_mode) else "file",
+                    de.st_size,
+                    de.st_mtime,
+                    None,
+                )
+                for de in self.sftp.listdir_attr()
+            ]
 
-        attr_list = self.sftp.listdir_attr()
-
-        for de in attr_list:
-            is_dir = stat.S_ISDIR(de.st_mode)
-            name = de.filename
+        for name, res_type, size, mtime, _unique in infos:
             entry = None
             if name in (".", ".."):
                 continue  # #74: some servers may send those
-            elif is_dir:
+            elif res_type == "dir":
                 entry = DirectoryEntry(
-                    self, self.cur_dir, name, de.st_size, de.st_mtime, unique=None
+                    self, self.cur_dir, name, size, mtime, unique=None
                 )
-            elif name == DirMetadata.META_FILE_NAME:
+            elif name in DirMetadata.META_FILE_NAMES:
                 # the meta-data file is silently ignored
                 has_meta = True
+                meta_files.append(name)
+            elif name in (Manifest.FILE_NAME, Manifest.TEMP_FILE_NAME):
+                pass  # the manifest is read by open()
             elif name == DirMetadata.LOCK_FILE_NAME and self.cur_dir == self.root_dir:
                 # this is the root lock file. Compare reported mtime with
                 # local upload time
-                self._probe_lock_file(de.st_mtime)
+                self._probe_lock_file(mtime)
             else:
-                entry = FileEntry(
-                    self, self.cur_dir, name, de.st_size, de.st_mtime, unique=None
-                )
+                entry = FileEntry(self, self.cur_dir, name, size, mtime, unique=None)
 
             if entry:
                 entry_map[name] = entry
                 entry_list.append(entry)
 
+        if self.manifest and self.manifest.get(self.cur_dir) is not None:
+            has_meta = True
+
         # load stored meta data if present
         self.cur_dir_meta = DirMetadata(self)
 
         if has_meta:
             try:
-                self.cur_dir_meta.read()
+                self.cur_dir_meta.read(meta_files)
             except IncompatibleMetadataVersionError:
                 raise  # this should end the script (user should pass --migrate)
             except Exception as e:
@@ -493,6 +601,78 @@ class SFTPTarget(_Target):
         # print("entry_list", entry_list)
         return entry_list
 
+    def _read_tree_listing(self):
+        """Return a :class:`ftpsync.tree_listing.TreeSnapshot` of cur_dir.
+
+        :attr:`TREE_LIST_COMMAND` is run over an SSH exec channel and its output
+        is parsed while it is received.
+
+        Returns:
+            :class:`ftpsync.tree_listing.TreeSnapshot` or None if the account
+            is not allowed to execute commands, or the command failed.
+        """
+        cmd = self.TREE_LIST_COMMAND.format(root=shlex.quote(self.cur_dir))
+        transport = self.sftp.sftp_client.get_channel().get_transport()
+        try:
+            with transport.open_session(timeout=self.timeout) as channel:
+                channel.exec_command(cmd)
+
+                def _recv_chunks():
+                    while True:
+                        chunk = channel.recv(self.LISTING_BLOCKSIZE)
+                        if not chunk:
+                            return
+                        yield chunk
+
+                snapshot = TreeSnapshot.from_find_output(
+                    _recv_chunks(), self.cur_dir, self.encoding
+                )
+                status = channel.recv_exit_status()
+        except (paramiko.ssh_exception.SSHException, ValueError) as e:
+            status = e
+        if status == 0:
+            if self.get_option("verbose", 3) >= 4:
+                write(f"Listed {len(snapshot)} directories using `find`.")
+            return snapshot
+        write(
+            f"Could not list the tree using `find` ({status}): "
+            "using SFTP for every directory.",
+            warning=True,
+        )
+        return None
+
+    def _open_pipelined(self, name, mode):
+        """Open cur_dir/name for pipelined transfers.
+
+        Writes are not acknowledged one by one and reads are prefetched by
+        :meth:`_read_pipelined`, so many requests of `--sftp-block-size` bytes
+        are in flight (limited by the SSH window, see `--sftp-window-size`).
+
+        Returns:
+            (paramiko.SFTPFile, block_size) tuple
+        """
+        block_size = self.get_option("sftp_block_size") or self.SFTP_BLOCKSIZE
+        fp = self.sftp.open(name, mode, bufsize=block_size)
+        # Size of the prefetch and write requests
+        fp.MAX_REQUEST_SIZE = block_size
+        fp.set_pipelined(True)
+        return fp, block_size
+
+    def _read_pipelined(self, name, fp_dest, callback=None, offset=0):
+        """Write cur_dir/name to `fp_dest`, using prefetched read requests."""
+        fp_src, block_size = self._open_pipelined(name, "rb")
+        with fp_src:
+            if offset:
+                fp_src.seek(offset)
+            fp_src.prefetch()
+            while True:
+                data = fp_src.read(block_size)
+                if not data:
+                    break
+                fp_dest.write(data)
+                if callback:
+                    callback(data)
+
     def open_readable(self, name):
         """Open cur_dir/name for reading.
 
@@ -505,29 +685,52 @@ class SFTPTarget(_Target):
         """
         # print("SFTP open_readable({})".format(name))
         assert is_native(name)
-        # TODO: use sftp.open() instead?
         out = SpooledTemporaryFile(max_size=self.MAX_SPOOL_MEM, mode="w+b")
-        self.sftp.getfo(name, out)
+        self._read_pipelined(name, out)
         out.seek(0)
         return out
 
-    def write_file(self, name, fp_src, blocksize=DEFAULT_BLOCKSIZE, callback=None):
+    def read_range(self, name, offset, size):
+        """Return up to `size` bytes of cur_dir/name, starting at `offset`."""
+        assert is_native(name)
+        with self.sftp.open(name, "rb") as fp:
+            fp.seek(offset)
+            return fp.read(size)
+
+    def write_file(
+        self, name, fp_src, blocksize=DEFAULT_BLOCKSIZE, callback=None, offset=0
+    ):
         """Write file-like `fp_src` to cur_dir/name.
 
         Args:
             name (str): file name, located in self.curdir
             fp_src (file-like): must support read() method
             blocksize (int, optional):
+                ignored (`--sftp-block-size` is used)
             callback (function, optional):
                 Called like `func(buf)` for every written chunk
+            offset (int, optional):
+                Write at this position of the existing file (`fp_src` must be
+                positioned at `offset`)
         """
         # print("SFTP write_file({})".format(name), blocksize)
         assert is_native(name)
         self.check_write(name)
-        self.sftp.putfo(fp_src, name)  # , callback)
-        # TODO: check result
-
-    def copy_to_file(self, name, fp_dest, callback=None):
+        # Pending write requests are acknowledged (or raise) on close
+        fp_dest, blocksize = self._open_pipelined(name, "r+b" if offset else "wb")
+        with fp_dest:
+            if offset:
+                fp_dest.truncate(offset)
+                fp_dest.seek(offset)
+            while True:
+                data = fp_src.read(blocksize)
+                if not data:
+                    break
+                fp_dest.write(data)
+                if callback:
+                    callback(data)
+
+    def copy_to_file(self, name, fp_dest, callback=None, offset=0):
         """Write cur_dir/name to file-like `fp_dest`.
 
         Args:
@@ -535,9 +738,138 @@ class SFTPTarget(_Target):
             fp_dest (file-like): must support write() method
             callback (function, optional):
                 Called like `func(buf)` for every written chunk
+            offset (int, optional):
+                Start at this position of the remote file
         """
         assert is_native(name)
-        self.sftp.getfo(name, fp_dest)
+        self._read_pipelined(name, fp_dest, callback, offset)
+
+    def _check_file(self, name, algorithm):
+        """Return the hex digest from the `check-file` extension or None."""
+        with self.sftp.open(name, "rb") as fp:
+            try:
+                return fp.check(algorithm).hex()
+            except OSError:
+                # 'Operation unsupported'
+                self.refused_hash_methods.add(("check-file", algorithm))
+                return None
+
+    def _exec_hash_command(self, name, algorithm):
+        """Return the hex digest from :attr:`HASH_COMMAND` or None."""
+        cmd = self.HASH_COMMAND.format(
+            algorithm=algorithm, path=shlex.quote(join_url(self.cur_dir, name))
+        )
+        transport = self.sftp.sftp_client.get_channel().get_transport()
+        try:
+            with transport.open_session(timeout=self.timeout) as channel:
+                channel.exec_command(cmd)
+                output = channel.makefile("rb").read()
+                status = channel.recv_exit_status()
+        except paramiko.ssh_exception.SSHException:
+            # The account is not allowed to execute commands
+            self.refused_hash_methods.update(
+                ("exec", alg) for alg in self.SERVER_HASH_ALGORITHMS
+            )
+            return None
+        # '<hex digest> *<path>'
+        digest = output.split(b" ", 1)[0].decode("ascii", "replace").lower()
+        if status != 0 or len(digest) != 2 * hashlib.new(algorithm).digest_size:
+            self.refused_hash_methods.add(("exec", algorithm))
+            return None
+        return digest
+
+    def get_hash(self, name, algorithms=HASH_ALGORITHMS):
+        """Return a content digest of cur_dir/name (see :meth:`_Target.get_hash`).
+
+        The `check-file` extension of the SFTP protocol is used if the server
+        supports it, otherwise :attr:`HASH_COMMAND` is run over an SSH exec
+        channel.
+        Methods that the server refuses are not tried again.
+        """
+        assert is_native(name)
+        refused = self.refused_hash_methods
+        algorithms = [a for a in algorithms if a in self.SERVER_HASH_ALGORITHMS]
+        for algorithm in algorithms:
+            if ("check-file", algorithm) not in refused:
+                digest = self._check_file(name, algorithm)
+                if digest:
+                    return algorithm, digest
+        for algorithm in algorithms:
+            if ("exec", algorithm) not in refused:
+                digest = self._exec_hash_command(name, algorithm)
+                if digest:
+                    return algorithm, digest
+        return None
+
+    def _run_delta_helper(self, args, fp_in=None, fp_out=None):
+        """Run :mod:`ftpsync.delta` on the server (over an SSH exec channel).
+
+        Args:
+            args (tuple): arguments of :func:`ftpsync.delta.main`
+            fp_in (file-like, optional): sent to the helper's stdin
+            fp_out (file-like, optional): receives the helper's stdout
+        Returns:
+            int: exit status of the helper (-1 if it could not be started)
+        """
+        if self.delta_refused:
+            return -1
+        cmd = delta.helper_command(*args)
+        transport = self.sftp.sftp_client.get_channel().get_transport()
+        try:
+            with transport.open_session(timeout=self.timeout) as channel:
+                channel.exec_command(cmd)
+                # The helper reads stdin completely, before it writes stdout
+                while fp_in:
+                    data = fp_in.read(self.LISTING_BLOCKSIZE)
+                    if not data:
+                        break
+                    channel.sendall(data)
+                channel.shutdown_write()
+                while True:
+                    chunk = channel.recv(self.LISTING_BLOCKSIZE)
+                    if not chunk:
+                        break
+                    if fp_out:
+                        fp_out.write(chunk)
+                status = channel.recv_exit_status()
+        except paramiko.ssh_exception.SSHException:
+            status = -1
+        if status in (-1, 126, 127):
+            # Not allowed to execute commands, or `python3` was not found
+            self.delta_refused = True
+            write(
+                f"Could not run `python3` on {self.host} ({status}): "
+                "copying complete files.",
+                warning=True,
+            )
+        return status
+
+    def supports_delta(self):
+        """Return True unless the server could not run the `--delta` helper."""
+        return not self.delta_refused
+
+    def get_signature(self, name, block_size):
+        assert is_native(name)
+        path = join_url(self.cur_dir, name)
+        out = io.BytesIO()
+        if self._run_delta_helper(("signature", path, block_size), fp_out=out):
+            return None
+        return out.getvalue()
+
+    def write_delta(self, name, signature, fp_out):
+        assert is_native(name)
+        path = join_url(self.cur_dir, name)
+        return not self._run_delta_helper(
+            ("delta", path), io.BytesIO(signature), fp_out
+        )
+
+    def apply_delta(self, name, fp_delta):
+        assert is_native(name)
+        self.check_write(name)
+        path = join_url(self.cur_dir, name)
+        return not self._run_delta_helper(
+            ("patch", path, path + delta.TEMP_SUFFIX), fp_delta
+        )
 
     def remove_file(self, name):
         """Remove cur_dir/name."""
@@ -547,6 +879,17 @@ class SFTPTarget(_Target):
         self.sftp.remove(name)
         self.remove_sync_info(name)
 
+    def rename(self, name, new_name):
+        assert is_native(name) and is_native(new_name)
+        self.check_write(new_name)
+        try:
+            # Unlike rename(), this replaces an existing file
+            self.sftp.sftp_client.posix_rename(name, new_name)
+        except OSError:
+            if self.sftp.exists(new_name):
+                self.sftp.remove(new_name)
+            self.sftp.rename(name, new_name)
+
     def set_mtime(self, name, mtime, size):
         assert is_native(name)
         self.check_write(name)
@@ -0,0 +1,158 @@
+"""
+(c) 2012-2024 Martin Wendt; see https://github.com/mar10/pyftpsync
+Licensed under the MIT license: https://www.opensource.org/licenses/mit-license.php
+
+Persistent directory listing cache for file system targets (`--stat-index`).
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from ftpsync.util import write_error
+
+
+# ===============================================================================
+# SqliteCache
+# ===============================================================================
+class SqliteCache:
+    """Base class for caches that are stored in an SQLite database file.
+
+    The database is only a cache: it is re-created if it is invalid or was
+    written by another version (see :attr:`VERSION`).
+    Instances may be shared by multiple threads.
+
+    Args:
+        path (str): location of the database file
+    """
+
+    #: Incremented when the schema changes (old databases are discarded)
+    VERSION = 1
+    #: Commit after this number of changes
+    COMMIT_INTERVAL = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._changes = 0
+        try:
+            self._db = self._connect()
+        except sqlite3.DatabaseError as e:
+            write_error(f"Discarding invalid cache {path}: {e!r}")
+            os.remove(path)
+            self._db = self._connect()
+
+    def __str__(self):
+        return f"{self.__class__.__name__}<{self.path}>"
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        # Avoid the additional journal file
+        db.execute("PRAGMA journal_mode = MEMORY")
+        db.execute("PRAGMA synchronous = OFF")
+        (version,) = db.execute("PRAGMA user_version").fetchone()
+        if version != self.VERSION:
+            self._create_tables(db)
+            db.execute(f"PRAGMA user_version = {self.VERSION}")
+            db.commit()
+        return db
+
+    def _create_tables(self, db):
+        """(Re-)create the database schema."""
+        raise NotImplementedError
+
+    def _changed(self):
+        self._changes += 1
+        if self._changes >= self.COMMIT_INTERVAL:
+            self._db.commit()
+            self._changes = 0
+
+    def close(self):
+        with self._lock:
+            if self._db:
+                self._db.commit()
+                self._db.close()
+                self._db = None
+
+
+# ===============================================================================
+# StatIndex
+# ===============================================================================
+class StatIndex(SqliteCache):
+    """SQLite database that stores directory listings of a file system target.
+
+    A listing is keyed by the directory path and is only returned as long as
+    the directory's own mtime and inode are unchanged, i.e. no entries were
+    added, removed or renamed. This saves the per-file stat calls for
+    unchanged directories.
+
+    This is a deliberate trade-off: the mtime of a directory does not change
+    when a file is modified in place, so such modifications are missed.
+    (Checking the mtime of every entry would cost as many system calls as
+    scanning the directory.) The option is therefore only safe if other
+    applications replace files (e.g. editors that write a temporary file and
+    rename it).
+    :class:`ftpsync.targets.FsTarget` invalidates the listing whenever it
+    writes to a directory itself.
+
+    Instances are shared by the target's clones (thread safe).
+
+    Args:
+        path (str): location of the database file
+    """
+
+    #: Name of the database file in the target's root folder
+    FILE_NAME = ".pyftpsync-index.sqlite"
+    #: Listings of directories that were modified this short before they were
+    #: scanned are not trusted, since the mtime granularity may hide changes
+    RACY_NS = 2 * 10**9
+
+    def _create_tables(self, db):
+        db.execute("DROP TABLE IF EXISTS dirs")
+        db.execute(
+            "CREATE TABLE dirs (path TEXT PRIMARY KEY, mtime_ns INTEGER, "
+            "ino INTEGER, scanned_ns INTEGER, entries TEXT)"
+        )
+
+    def get(self, path, dir_stat):
+        """Return the stored listing of `path`, if the directory is unchanged.
+
+        Args:
+            path (str): directory path (relative to the target's root)
+            dir_stat (os.stat_result): current stat of the directory
+        Returns:
+            list of (name, is_dir, size, mtime, ino) tuples or None
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT mtime_ns, ino, scanned_ns, entries FROM dirs WHERE path = ?",
+                (path,),
+            ).fetchone()
+        if not row:
+            return None
+        mtime_ns, ino, scanned_ns, entries = row
+        if (
+            mtime_ns != dir_stat.st_mtime_ns
+            or ino != dir_stat.st_ino
+            or mtime_ns >= scanned_ns - self.RACY_NS
+        ):
+            return None
+        return [tuple(e) for e in json.loads(entries)]
+
+    def put(self, path, dir_stat, entries):
+        """Store the listing of `path` (see :meth:`get`)."""
+        data = json.dumps(entries, ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?, ?)",
+                (path, dir_stat.st_mtime_ns, dir_stat.st_ino, time.time_ns(), data),
+            )
+            self._changed()
+
+    def invalidate(self, path):
+        """Forget the listing of `path`."""
+        with self._lock:
+            self._db.execute("DELETE FROM dirs WHERE path = ?", (path,))
+            self._changed()
@@ -4,12 +4,23 @@ Licensed under the MIT license: https://www.opensource.org/licenses/mit-license.
 """
 
 import fnmatch
+import ftplib
+import os
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from posixpath import join as join_url
+from posixpath import normpath as normpath_url
+from tempfile import SpooledTemporaryFile
 
+from ftpsync.connection_pool import DEFAULT_KEEPALIVE, ConnectionPool
+from ftpsync.delta import block_size_for
 from ftpsync.ftp_target import FTPTarget
-from ftpsync.metadata import DirMetadata
+from ftpsync.metadata import DirMetadata, Manifest
+from ftpsync.plan import SyncPlanReader, SyncPlanWriter, entry_state_matches
 from ftpsync.resources import DirectoryEntry, EntryPair, FileEntry, operation_map
+from ftpsync.targets import HASH_ALGORITHMS, FsTarget
 from ftpsync.util import (
     DRY_RUN_PREFIX,
     IS_REDIRECTED,
@@ -18,17 +29,50 @@ from ftpsync.util import (
     byte_compare,
     colorama,
     eps_compare,
+    find_mismatch,
+    format_duration,
     pretty_stamp,
+    sample_offsets,
     write,
     write_error,
 )
+from ftpsync.workers import ListingPrefetcher, StreamPipe, TransferWorkerPool
 
 CONFIG_FILE_NAME = "pyftpsync.yaml"
 
 #: Default for --exclude CLI option
 #: Note: DirMetadata.META_FILE_NAME and LOCK_FILE_NAME are always ignored
 DEFAULT_OMIT = [".DS_Store", ".git", ".hg", ".svn", "#recycle"]
-ALWAYS_OMIT = (CONFIG_FILE_NAME, DirMetadata.META_FILE_NAME, DirMetadata.LOCK_FILE_NAME)
+ALWAYS_OMIT = (
+    CONFIG_FILE_NAME,
+    DirMetadata.META_FILE_NAME,
+    DirMetadata.BINARY_META_FILE_NAME,
+    DirMetadata.JOURNAL_FILE_NAME,
+    DirMetadata.LOCK_FILE_NAME,
+    Manifest.FILE_NAME,
+    Manifest.TEMP_FILE_NAME,
+)
+
+#: Suffix of partially transferred files (`--resume`), which are always ignored
+PART_SUFFIX = ".pyftpsync-part"
+#: Smaller files are not transferred via a part file (`--resume`)
+RESUME_MIN_SIZE = 1024 * 1024
+#: Smaller files are byte compared, because reading them takes about as long as
+#: a checksum request
+HASH_COMPARE_MIN_SIZE = 4 * 1024
+#: Number of threads that hash local files (`--compare-content`)
+HASH_WORKERS = 4
+#: Larger files are first compared by sampling a few blocks, unless both are
+#: local
+SAMPLE_COMPARE_MIN_SIZE = 4 * 1024 * 1024
+#: Size of the sampled blocks
+SAMPLE_BLOCKSIZE = 64 * 1024
+#: Number of random blocks that are sampled (besides the first and last one)
+SAMPLE_BLOCKS = 4
+#: Smaller files are always copied completely (`--delta`)
+DELTA_MIN_SIZE = 1024 * 1024
+#: Deltas are buffered in memory up to this size, then on disk
+DELTA_SPOOL_MEM = 10 * 1024 * 1024
 
 # ===============================================================================
 # Helpers
@@ -59,9 +103,36 @@ def process_options(opts):
     # print(match, exclude, opts)
 
 
+def _remove_file_job(target, name):
+    """Worker job that removes target.cur_dir/name."""
+    target.remove_file(name)
+
+
+def _remove_dir_job(target, name):
+    """Worker job that removes target.cur_dir/name recursively."""
+    target.rmdir(name)
+
+
+def make_part_name(entry):
+    """Return the name of the part file that is used while `entry` is copied.
+
+    Size and mtime of the source file are part of the name, so a partial copy
+    of an outdated version is never resumed.
+    """
+    return f"{entry.name}.{entry.size}-{int(entry.mtime)}{PART_SUFFIX}"
+
+
+def parse_part_name(name):
+    """Return the name of the copied file for a part file name (None otherwise)."""
+    if not name.endswith(PART_SUFFIX):
+        return None
+    base, sep, _guard = name[: -len(PART_SUFFIX)].rpartition(".")
+    return base if sep else None
+
+
 def match_path(entry, opts):
     """Return True if `path` matches `match` and `exclude` options."""
-    if entry.name in ALWAYS_OMIT:
+    if entry.name in ALWAYS_OMIT or entry.name.endswith(PART_SUFFIX):
         return False
     # TODO: currently we use fnmatch syntax and match against names.
     # We also might allow glob syntax and match against the whole relative path instead
@@ -110,6 +181,42 @@ class BaseSynchronizer:
         self.is_script = None
         #: str: Conflict resolution strategy
         self.resolve_all = None
+        #: int: Number of parallel transfer workers (`--workers`)
+        self.workers = int(self.options.get("workers") or 1)
+        #: bool: Let FTP servers copy files directly (`--fxp`), until a server
+        #: refuses it
+        self.use_fxp = bool(self.options.get("fxp"))
+        #: bool: Transfer only the changed blocks of modified files (`--delta`)
+        self.use_delta = bool(self.options.get("delta"))
+        #: bool: Compare the content of files that look modified on both sides
+        #: (`--compare-content`)
+        self.compare_content = bool(self.options.get("compare_content"))
+        #: :class:`ftpsync.workers.TransferWorkerPool`: Set by run() if workers > 1
+        #: (or `transfer_order` is set)
+        self._pool = None
+        self._transfer_start = None
+        #: int: Total bytes to transfer, if known in advance (`--execute-plan`)
+        self._expected_bytes = None
+        #: dict: Part files of the current directory (`--resume`)
+        #: {(target, cur_dir, name): [FileEntry, ...]}
+        self._part_files = {}
+        #: dict: {target: :class:`ftpsync.connection_pool.ConnectionPool`}
+        self._connection_pools = {}
+        self._pools_lock = threading.Lock()
+        #: dict: {target: :class:`ftpsync.workers.ListingPrefetcher`} (`--prefetch`)
+        self._prefetchers = {}
+        #: :class:`ThreadPoolExecutor`: Lists the local target, while the main
+        #: thread lists the remote target (set by run())
+        self._list_executor = None
+        #: :class:`ThreadPoolExecutor`: Hashes local files (set by run() if
+        #: `--compare-content` is passed)
+        self._hash_executor = None
+        #: dict: Digests of the current directory that are computed in advance
+        #: {(target, path, algorithm): Future}
+        self._hash_futures = {}
+        #: str: The algorithm of the last successful digest comparison
+        self._hash_algorithm = None
+        self._stats_lock = threading.Lock()
 
         self._stats = {
             "bytes_written": 0,
@@ -131,10 +238,12 @@ class BaseSynchronizer:
             "interactive_ask": 0,
             "local_dirs": 0,
             "local_files": 0,
+            "local_list_time": 0,
             "meta_bytes_read": 0,
             "meta_bytes_written": 0,
             "remote_dirs": 0,
             "remote_files": 0,
+            "remote_list_time": 0,
             "result_code": None,
             "upload_bytes_written": 0,
             "upload_files_written": 0,
@@ -163,7 +272,109 @@ class BaseSynchronizer:
         return n
 
     def _inc_stat(self, name, ofs=1):
-        self._stats[name] = self._stats.get(name, 0) + ofs
+        # Stats are also updated by worker threads
+        with self._stats_lock:
+            self._stats[name] = self._stats.get(name, 0) + ofs
+
+    def _get_worker_count(self):
+        """Return the number of transfer workers, respecting `max_connections`."""
+        workers = self.workers
+        for target in (self.local, self.remote):
+            max_connections = target.get_option("max_connections")
+            if target.host and max_connections:
+                # The primary connection also counts
+                workers = min(workers, int(max_connections) - 1)
+        return workers
+
+    def _join_workers(self):
+        """Wait for pending transfers and apply their metadata updates."""
+        if self._pool:
+            self._pool.join()
+
+    def _get_keepalive(self):
+        return float(self.options.get("keepalive", DEFAULT_KEEPALIVE) or 0)
+
+    def _get_connection_pool(self, target):
+        """Return the pool of additional connections for `target` (thread safe)."""
+        with self._pools_lock:
+            pool = self._connection_pools.get(target)
+            if pool is None:
+                max_size = None
+                max_connections = target.get_option("max_connections")
+                if target.host and max_connections:
+                    max_size = max(1, int(max_connections) - 1)
+                # Local file system targets don't need keepalive requests
+                keepalive = self._get_keepalive() if target.host else 0
+                pool = ConnectionPool(target, max_size, keepalive)
+                self._connection_pools[target] = pool
+        return pool
+
+    def _keepalive_targets(self):
+        """Prevent time outs of the primary connections (called while we wait)."""
+        self.local.keepalive()
+        self.remote.keepalive()
+
+    def _get_dir(self, target):
+        """Return the entries of the target's current directory.
+
+        Uses a listing that was fetched in the background if `--prefetch`
+        is enabled.
+        """
+        prefetcher = self._prefetchers.get(target)
+        if prefetcher:
+            entries = prefetcher.get(target.cur_dir)
+            if entries is not None:
+                return entries
+        return target.get_dir()
+
+    def _get_dir_timed(self, target, stat_name):
+        start = time.time()
+        entries = self._get_dir(target)
+        self._inc_stat(stat_name, time.time() - start)
+        return entries
+
+    def _get_dir_pair(self):
+        """Return (local_entries, remote_entries) of the current directories.
+
+        Both targets are listed concurrently (including their metadata), so
+        we wait for the slower one instead of the sum of both.
+        """
+        if not self._list_executor:
+            return (
+                self._get_dir_timed(self.local, "local_list_time"),
+                self._get_dir_timed(self.remote, "remote_list_time"),
+            )
+        local_future = self._list_executor.submit(
+            self._get_dir_timed, self.local, "local_list_time"
+        )
+        try:
+            remote_entries = self._get_dir_timed(self.remote, "remote_list_time")
+        finally:
+            # Make sure the local target is idle again, even if we raise
+            local_entries = local_future.result()
+        return local_entries, remote_entries
+
+    def _prefetch_dirs(self, names):
+        """Start fetching listings of sub directories that we will visit later."""
+        for target, prefetcher in self._prefetchers.items():
+            cur_dir = target.cur_dir
+            for name in names:
+                prefetcher.submit(normpath_url(join_url(cur_dir, name)))
+
+    def _prefetch_pairs(self, entry_pair_list):
+        """Prefetch listings of sub-directories that exist on both targets."""
+        self._prefetch_dirs(
+            [
+                pair.local.name
+                for pair in entry_pair_list
+                if pair.local and pair.local.is_dir() and pair.remote
+            ]
+        )
+
+    def _prefetch_discard(self):
+        """Forget prefetched listings of sub directories that were skipped."""
+        for target, prefetcher in self._prefetchers.items():
+            prefetcher.discard_children(target.cur_dir)
 
     def _match(self, entry):
         return match_path(entry, self.options)
@@ -188,27 +399,94 @@ class BaseSynchronizer:
             )
 
         try:
-            self.local.synchronizer = self.remote.synchronizer = self
-            self.local.peer = self.remote
-            self.remote.peer = self.local
-
-            if self.dry_run:
-                self.local.readonly = True
-                self.local.dry_run = True
-                self.remote.readonly = True
-                self.remote.dry_run = True
+            self._bind_targets()
 
             if not self.local.connected:
                 self.local.open()
             if not self.remote.connected:
                 self.remote.open()
 
-            res = self._sync_dir()
+            workers = self._get_worker_count()
+            order = self.options.get("transfer_order")
+            if order == "listing":
+                order = None
+            if (workers > 1 or (workers and order)) and not self.dry_run:
+                if self.verbose >= 4:
+                    write(f"Using {workers} parallel transfer workers.")
+                self._pool = TransferWorkerPool(
+                    self,
+                    workers,
+                    order=order,
+                    large_file_size=int(self.options.get("large_file_size") or 0),
+                    large_workers=int(self.options.get("large_file_workers") or 0),
+                )
+                self._transfer_start = time.monotonic()
+
+            if self.options.get("prefetch"):
+                for target in (self.local, self.remote):
+                    self._prefetchers[target] = ListingPrefetcher(self, target)
+
+            self._list_executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="pyftpsync-list"
+            )
+            if self.compare_content:
+                self._hash_executor = ThreadPoolExecutor(
+                    max_workers=HASH_WORKERS, thread_name_prefix="pyftpsync-hash"
+                )
+                if isinstance(self.local, FsTarget) and isinstance(
+                    self.remote, FsTarget
+                ):
+                    self._hash_algorithm = HASH_ALGORITHMS[0]
+
+            if self.options.get("write_plan"):
+                with open(self.options["write_plan"], "w", encoding="utf-8") as fp:
+                    res = self._write_plan(fp)
+            elif self.options.get("execute_plan"):
+                with open(self.options["execute_plan"], encoding="utf-8") as fp:
+                    res = self._execute_plan(fp)
+            else:
+                res = self._sync_dir()
         finally:
-            self.local.synchronizer = self.remote.synchronizer = None
-            self.local.peer = self.remote.peer = None
+            if self._list_executor:
+                self._list_executor.shutdown()
+                self._list_executor = None
+            if self._hash_executor:
+                # Wait for _record_synced_hash()
+                self._hash_executor.shutdown()
+                self._hash_executor = None
+            if self._pool:
+                self._pool.close()
+                self._pool = None
+            for prefetcher in self._prefetchers.values():
+                prefetcher.close()
+            self._prefetchers = {}
+            for pool in self._connection_pools.values():
+                pool.close()
+            self._connection_pools = {}
+            self._unbind_targets()
             self.close()
 
+        self._finalize_stats(start)
+        return res
+
+    def _bind_targets(self):
+        """Connect both targets to this synchronizer (called by run())."""
+        self.local.synchronizer = self.remote.synchronizer = self
+        self.local.peer = self.remote
+        self.remote.peer = self.local
+
+        if self.dry_run:
+            self.local.readonly = True
+            self.local.dry_run = True
+            self.remote.readonly = True
+            self.remote.dry_run = True
+
+    def _unbind_targets(self):
+        self.local.synchronizer = self.remote.synchronizer = None
+        self.local.peer = self.remote.peer = None
+
+    def _finalize_stats(self, start):
+        """Add elapsed time and transfer rates to the stats."""
         stats = self._stats
         stats["elap_secs"] = time.time() - start
         stats["elap_str"] = "{:0.2f} sec".format(stats["elap_secs"])
@@ -219,7 +497,9 @@ class BaseSynchronizer:
 
         _add("upload_rate_str", "upload_bytes_written", "upload_write_time")
         _add("download_rate_str", "download_bytes_written", "download_write_time")
-        return res
+        for name in ("min_file_rate", "max_file_rate"):
+            if stats.get(name):
+                stats[name + "_str"] = f"{0.001 * stats[name]:0.2f} kB/sec"
 
     def _compare_file(self, local, remote):
         """Byte compare two files (early out on first difference)."""
@@ -236,17 +516,223 @@ class BaseSynchronizer:
             )
             return False
 
+        res, info = self._compare_content(local, remote)
+        if not res:
+            write(f"    Files are different ({info}).")
+        else:
+            write(f"    Files are equal ({info}).")
+        return res
+
+    def _compare_content(self, local, remote):
+        """Compare the content of two files of equal size.
+
+        The targets are asked for digests (e.g. FTP `HASH` or the SFTP
+        `check-file` extension), so both files are only read if the targets
+        have no algorithm in common.
+
+        Returns:
+            (bool, str): True if the files are equal, and a description of the
+            method (and the mismatch)
+        """
+        assert local.size == remote.size
+        # Ask the remote target first: if it supports no algorithm, the file
+        # has to be read anyway
+        remote_hash = None
+        if local.size >= HASH_COMPARE_MIN_SIZE:
+            remote_hash = self._get_hash(remote)
+        if remote_hash:
+            algorithm, remote_digest = remote_hash
+            local_hash = self._get_hash(local, (algorithm,))
+            if local_hash:
+                self._inc_stat("hash_compares")
+                self._hash_algorithm = algorithm
+                if local_hash[1] == remote_digest:
+                    return True, f"{algorithm} {remote_digest}"
+                return False, f"{algorithm} {local_hash[1]} != {remote_digest}"
+
+        if local.size >= SAMPLE_COMPARE_MIN_SIZE and not (
+            isinstance(local.target, FsTarget) and isinstance(remote.target, FsTarget)
+        ):
+            ofs = self._sample_compare(local, remote)
+            if ofs is not None:
+                return False, f"sampled, at offset {ofs:,d}"
+
+        self._inc_stat("byte_compares")
         with local.target.open_readable(
             local.name
         ) as fp_src, remote.target.open_readable(remote.name) as fp_dest:
             res, ofs = byte_compare(fp_src, fp_dest)
+        if res:
+            return True, "byte compare"
+        return False, f"at offset {ofs:,d}"
 
-        if not res:
-            write(f"    Files are different at offset {ofs:,d}.")
+    def _sample_compare(self, local, remote):
+        """Compare the first, the last, and some random blocks of two files.
+
+        This is a quick check before both files are read completely.
+
+        Returns:
+            int: offset of the first mismatch or None if the blocks are equal
+        """
+        self._inc_stat("sample_compares")
+        for ofs in sample_offsets(local.size, SAMPLE_BLOCKSIZE, SAMPLE_BLOCKS):
+            data_a = local.target.read_range(local.name, ofs, SAMPLE_BLOCKSIZE)
+            data_b = remote.target.read_range(remote.name, ofs, SAMPLE_BLOCKSIZE)
+            if data_a != data_b:
+                self._inc_stat("sample_mismatches")
+                return ofs + find_mismatch(data_a, data_b)
+        return None
+
+    def _is_same_content(self, pair):
+        """Return True if `--compare-content` found equal file contents.
+
+        The pair is then recorded as synchronized (like after a copy), so the
+        files are not compared again by the next run.
+        """
+        local, remote = pair.local, pair.remote
+        if (
+            not self.compare_content
+            or pair.is_dir
+            or pair.content_differs
+            or local.size != remote.size
+        ):
+            return False
+        res, info = self._compare_content(local, remote)
+        if self.verbose >= 5:
+            write(f"    Compared {local.name}: {info}.")
+        if res:
+            self._record_equal(pair)
         else:
-            write("    Files are equal.")
+            # Don't compare again when on_need_compare() calls on_conflict()
+            pair.content_differs = True
         return res
 
+    def _is_touched(self, pair):
+        """Return True if the local file was only touched since the last sync.
+
+        The content is compared to the digest that the `--hash-cache` stored
+        when the file was last synchronized (see :meth:`_record_synced_hash`).
+        This is only meaningful if the remote file is unmodified.
+        """
+        local, remote = pair.local, pair.remote
+        cache = getattr(self.local, "hash_cache", None)
+        if (
+            not self.compare_content
+            or not cache
+            or pair.is_dir
+            or not remote
+            or local.size != remote.size
+        ):
+            return False
+        synced = cache.get_synced(self.remote.get_id(), self._get_hash_key(local.name))
+        synced_at = self.local.get_sync_info(local.name, "u")
+        if not synced or synced_at is None or synced[0] != synced_at:
+            return False  # Not stored by the last sync
+        _synced_at, algorithm, digest = synced
+        local_hash = self._get_hash(local, (algorithm,))
+        if not local_hash or local_hash[1] != digest:
+            return False
+        self._inc_stat("touched_files")
+        if self.verbose >= 5:
+            write(f"    {local.name} was only touched: {algorithm} {digest}.")
+        self._record_equal(pair)
+        return True
+
+    def _record_equal(self, pair):
+        """Record a pair of equal files as synchronized (like after a copy).
+
+        So the files are not compared again by the next run.
+        """
+        local = pair.local
+        if self.dry_run or self.remote.readonly:
+            return
+        self.remote.set_mtime(local.name, local.mtime, local.size)
+        self.remote.set_sync_info(local.name, local.mtime, local.size)
+        self._record_synced_hash(local.name)
+
+    def _record_synced_hash(self, name):
+        """Store the digest of the local file cur_dir/name as synchronized content.
+
+        The digest is computed by the hash pool (see :meth:`_is_touched`).
+        """
+        local = self.local
+        cache = getattr(local, "hash_cache", None)
+        if not cache or not self._hash_executor:
+            return
+        peer_id = self.remote.get_id()
+        path = os.path.join(local.cur_dir, name)
+        key = self._get_hash_key(name)
+        synced_at = local.get_sync_info(name, "u")
+        if synced_at is None:
+            return
+        algorithm = HASH_ALGORITHMS[0]
+
+        def _store():
+            digest = local.hash_file(path, algorithm)
+            cache.set_synced(peer_id, key, synced_at, algorithm, digest)
+
+        self._hash_executor.submit(_store)
+
+    def _get_hash_key(self, name):
+        """Return the path of the local file cur_dir/name in the `--hash-cache`."""
+        path = os.path.join(self.local.cur_dir, name)
+        return os.path.relpath(path, self.local.root_dir)
+
+    def _get_hash_path(self, entry):
+        """Return the absolute path of a FsTarget entry in the target's cur_dir."""
+        return os.path.join(entry.target.cur_dir, entry.name)
+
+    def _get_hash(self, entry, algorithms=HASH_ALGORITHMS):
+        """Return `entry.target.get_hash()`, preferring prefetched digests."""
+        for algorithm in algorithms:
+            future = self._hash_futures.pop(
+                (entry.target, self._get_hash_path(entry), algorithm), None
+            )
+            if future:
+                try:
+                    return algorithm, future.result()
+                except OSError:
+                    break
+        return entry.target.get_hash(entry.name, algorithms)
+
+    def _prefetch_hashes(self, entry_pair_list):
+        """Start hashing the local files that will be compared (`--compare-content`).
+
+        The digests are computed by the hash pool, while the pairs of the current
+        directory are handled.
+        """
+        if not self._hash_executor:
+            return
+        local_cache = getattr(self.local, "hash_cache", None)
+        for pair in entry_pair_list:
+            local, remote = pair.local, pair.remote
+            if pair.is_dir or not local or not remote or local.size != remote.size:
+                continue
+            if pair.operation in ("need_compare", "conflict"):
+                if local.size < HASH_COMPARE_MIN_SIZE or not self._hash_algorithm:
+                    continue
+                entries = (local, remote)
+                algorithm = self._hash_algorithm
+            elif pair.operation == "copy_local" and local_cache:
+                entries = (local,)  # See _is_touched()
+                algorithm = HASH_ALGORITHMS[0]
+            else:
+                continue
+            for entry in entries:
+                if isinstance(entry.target, FsTarget):
+                    path = self._get_hash_path(entry)
+                    self._hash_futures[(entry.target, path, algorithm)] = (
+                        self._hash_executor.submit(
+                            entry.target.hash_file, path, algorithm
+                        )
+                    )
+
+    def _discard_hashes(self):
+        """Cancel the prefetched digests that were not used."""
+        for future in self._hash_futures.values():
+            future.cancel()
+        self._hash_futures = {}
+
     def _copy_file(self, src, dest, file_entry):
         # TODO: safe replace:
         # 1. remove temp file
@@ -268,7 +754,76 @@ class BaseSynchronizer:
         elif dest.readonly:
             raise RuntimeError(f"target is read-only: {dest}")
 
+        part_name = None
+        offset = 0
+        if self.options.get("resume") and file_entry.size >= RESUME_MIN_SIZE:
+            part_name, offset = self._prepare_part_file(dest, file_entry)
+
+        if self._pool:
+            self._pool.submit(
+                self._transfer_file,
+                src,
+                dest,
+                file_entry,
+                is_upload,
+                part_name,
+                offset,
+                callback=lambda elap: self._copy_file_done(
+                    dest, file_entry, is_upload, elap
+                ),
+                entry=file_entry,
+            )
+            return
+
+        elap = self._transfer_file(src, dest, file_entry, is_upload, part_name, offset)
+        self._copy_file_done(dest, file_entry, is_upload, elap)
+        return
+
+    def _split_part_files(self, entries):
+        """Remove part files from `entries` and store them in `_part_files`."""
+        res = []
+        for entry in entries:
+            name = parse_part_name(entry.name) if entry.is_file() else None
+            if name is None:
+                res.append(entry)
+            else:
+                target = entry.target
+                key = (target, target.cur_dir, name)
+                self._part_files.setdefault(key, []).append(entry)
+        return res
+
+    def _prepare_part_file(self, dest, file_entry):
+        """Return (part_name, offset) for a resumable copy of `file_entry`.
+
+        Part files of other versions of the source file are removed.
+        """
+        part_name = make_part_name(file_entry)
+        offset = 0
+        for part in self._part_files.pop((dest, dest.cur_dir, file_entry.name), ()):
+            if part.name == part_name and part.size <= file_entry.size:
+                offset = part.size
+            else:
+                dest.remove_file(part.name)
+        return part_name, offset
+
+    def _transfer_file(
+        self, src, dest, file_entry, is_upload, part_name=None, offset=0
+    ):
+        """Copy the file content from src to dest (called by _copy_file()).
+
+        This may be called by a worker thread, so it must not modify metadata.
+        If `part_name` is passed, the content is written to this file first
+        (starting at `offset` if a previous copy was interrupted) and renamed
+        when complete.
+
+        Returns:
+            elapsed seconds or None if an error was ignored
+        """
         start = time.time()
+        dest_name = part_name or file_entry.name
+        if offset:
+            self._inc_stat("resumed_files")
+            self._inc_stat("resumed_bytes", offset)
 
         def _show_error(msg, exc):
             write_error(
@@ -283,25 +838,60 @@ class BaseSynchronizer:
             else:
                 self._inc_stat("download_bytes_written", len(data))
 
-        if isinstance(src, FTPTarget) and not isinstance(dest, FTPTarget):
-            # Copy FTP to File:
-            # FTPTarget.open_readable() would read everything into a temporary buffer
-            # before we can start writing.
-            # It is more efficient to let FTPTarget write in the retrbinary() callbacks.
-            # (Note that copying FTP to FTP would require a temp buffer anyway,
-            # so we handle this in the default branch below.)
+        if (
+            self.use_delta
+            and not offset
+            and file_entry.size >= DELTA_MIN_SIZE
+            and self._delta_copy(src, dest, file_entry, is_upload)
+        ):
+            return time.time() - start
+
+        if src.host and not dest.host:
+            # Copy FTP or SFTP to File:
+            # open_readable() of remote targets would read everything into a
+            # temporary buffer (spilling to disk for large files) before we can
+            # start writing.
+            # It is more efficient to let the source write in the retrbinary()
+            # callbacks, or while the SFTP read requests are received.
+            # Resumed downloads use this branch as well, so only the missing
+            # part is transferred.
             try:
-                writer = dest.open_writable(file_entry.name)
+                writer = dest.open_writable(dest_name, offset)
             except Exception as e:
                 self._inc_stat("errors")
                 self._inc_stat("copy_errors")
                 if self.ignore_copy_errors:
                     _show_error(f"Could not copy {file_entry.name}", e)
-                    return
+                    return None
                 raise
 
             with writer as fp_dest:
-                src.copy_to_file(file_entry.name, fp_dest, callback=__block_written)
+                src.copy_to_file(
+                    file_entry.name, fp_dest, callback=__block_written, offset=offset
+                )
+
+        elif src.host and dest.host:
+            # Copy remote to remote (e.g. FTP to SFTP):
+            # FTP servers may copy the file directly (`--fxp`). Otherwise download
+            # in a background thread and upload while the data arrives, instead
+            # of spooling the whole file first.
+            try:
+                if not self._fxp_copy(src, dest, file_entry, dest_name, offset):
+                    StreamPipe.copy(
+                        src,
+                        file_entry.name,
+                        dest,
+                        dest_name,
+                        callback=__block_written,
+                        offset=offset,
+                    )
+            except Exception as e:
+                self._inc_stat("errors")
+                self._inc_stat("copy_errors")
+                if self.ignore_copy_errors:
+                    _show_error(f"Could not copy {file_entry.name}", e)
+                    return None
+                raise
 
         else:
             try:
@@ -311,21 +901,107 @@ class BaseSynchronizer:
                 self._inc_stat("copy_errors")
                 if self.ignore_copy_errors:
                     _show_error(f"Could not copy {file_entry.name}", e)
-                    return
+                    return None
                 raise
 
             with reader as fp_src:
-                dest.write_file(file_entry.name, fp_src, callback=__block_written)
+                if offset:
+                    fp_src.seek(offset)
+                dest.write_file(
+                    dest_name, fp_src, callback=__block_written, offset=offset
+                )
+
+        if part_name:
+            dest.rename(part_name, file_entry.name)
+        return time.time() - start
+
+    def _delta_copy(self, src, dest, file_entry, is_upload):
+        """Transfer only the blocks that differ from dest's version (`--delta`).
+
+        The destination sends block checksums of its version, the source
+        answers with a delta that dest applies (see :mod:`ftpsync.delta`).
+
+        Returns:
+            False if a target does not support delta transfers, or dest has no
+            previous version (the caller copies the complete file)
+        """
+        if not (src.supports_delta() and dest.supports_delta()):
+            return False
+        name = file_entry.name
+        signature = dest.get_signature(name, block_size_for(file_entry.size))
+        if signature is None:
+            return False
+        with SpooledTemporaryFile(max_size=DELTA_SPOOL_MEM, mode="w+b") as fp_delta:
+            if not src.write_delta(name, signature, fp_delta):
+                return False
+            size = fp_delta.tell()
+            fp_delta.seek(0)
+            if not dest.apply_delta(name, fp_delta):
+                return False
+        self._inc_stat("delta_files_written")
+        self._inc_stat("delta_bytes_saved", max(file_entry.size - size, 0))
+        self._inc_stat("bytes_written", size)
+        if is_upload:
+            self._inc_stat("upload_bytes_written", size)
+        else:
+            self._inc_stat("download_bytes_written", size)
+        return True
+
+    def _fxp_copy(self, src, dest, file_entry, dest_name, offset):
+        """Let two FTP servers copy a file directly, if `--fxp` is enabled.
+
+        Returns:
+            False if FXP is disabled or refused (the caller relays the data)
+        """
+        if not (
+            self.use_fxp and isinstance(src, FTPTarget) and src.supports_fxp(dest)
+        ):
+            return False
+        error = src.fxp_copy(file_entry.name, dest, dest_name, offset)
+        if error:
+            # Don't try again for the following files
+            self.use_fxp = False
+            write(
+                f"FXP from {src.host} to {dest.host} was refused ({error}): "
+                "relaying the data instead.",
+                warning=True,
+            )
+            return False
+        size = file_entry.size - offset
+        self._inc_stat("fxp_files_written")
+        self._inc_stat("bytes_written", size)
+        if dest is self.remote:
+            self._inc_stat("upload_bytes_written", size)
+        else:
+            self._inc_stat("download_bytes_written", size)
+        return True
 
+    def _copy_file_done(self, dest, file_entry, is_upload, elap):
+        """Update metadata and stats after a file was copied (main thread only)."""
+        if elap is None:
+            return  # Copy error was ignored
         dest.set_mtime(file_entry.name, file_entry.mtime, file_entry.size)
         dest.set_sync_info(file_entry.name, file_entry.mtime, file_entry.size)
+        self._record_synced_hash(file_entry.name)
 
-        elap = time.time() - start
         self._inc_stat("write_time", elap)
         if is_upload:
             self._inc_stat("upload_write_time", elap)
         else:
             self._inc_stat("download_write_time", elap)
+        if elap > 0 and file_entry.size:
+            # Throughput of the slowest and fastest file transfer (bytes/sec)
+            rate = file_entry.size / elap
+            with self._stats_lock:
+                stats = self._stats
+                stats["min_file_rate"] = min(stats.get("min_file_rate", rate), rate)
+                stats["max_file_rate"] = max(stats.get("max_file_rate", rate), rate)
+            if self.verbose >= 5:
+                write(
+                    "    {} bytes in {:0.2f} sec ({:0.2f} kB/sec): {}".format(
+                        file_entry.size, elap, 0.001 * rate, file_entry.name
+                    )
+                )
         return
 
     def _copy_recursive(self, src, dest, dir_entry):
@@ -341,6 +1017,9 @@ class BaseSynchronizer:
         elif dest.readonly:
             raise RuntimeError(f"target is read-only: {dest}")
 
+        # Pending transfers must complete before we change the directory
+        self._join_workers()
+
         dest.set_sync_info(dir_entry.name, None, None)
 
         src.push_meta()
@@ -350,7 +1029,11 @@ class BaseSynchronizer:
         dest.mkdir(dir_entry.name)
         dest.cwd(dir_entry.name)
         dest.cur_dir_meta = DirMetadata(dest)
-        for entry in src.get_dir():
+        entries = src.get_dir()
+        if self._pool:
+            # Schedule all files before we descend (and wait for the workers)
+            entries.sort(key=lambda e: e.is_dir())
+        for entry in entries:
             # the outer call was already accompanied by an increment, but not recursions
             self._inc_stat("entries_seen")
             if entry.is_dir():
@@ -358,6 +1041,7 @@ class BaseSynchronizer:
             else:
                 self._copy_file(src, dest, entry)
 
+        self._join_workers()
         src.flush_meta()
         dest.flush_meta()
 
@@ -378,6 +1062,16 @@ class BaseSynchronizer:
             return self._dry_run_action(f"delete file ({file_entry})")
         elif file_entry.target.readonly:
             raise RuntimeError(f"target is read-only: {file_entry.target}")
+        if self._pool:
+            self._pool.submit(
+                _remove_file_job,
+                file_entry.target,
+                file_entry.name,
+                callback=lambda _res: file_entry.target.remove_sync_info(
+                    file_entry.name
+                ),
+            )
+            return
         file_entry.target.remove_file(file_entry.name)
         file_entry.target.remove_sync_info(file_entry.name)
 
@@ -390,6 +1084,16 @@ class BaseSynchronizer:
             return self._dry_run_action(f"delete directory ({dir_entry})")
         elif dir_entry.target.readonly:
             raise RuntimeError(f"target is read-only: {dir_entry.target}")
+        if self._pool:
+            self._pool.submit(
+                _remove_dir_job,
+                dir_entry.target,
+                dir_entry.name,
+                callback=lambda _res: dir_entry.target.remove_sync_info(
+                    dir_entry.name
+                ),
+            )
+            return
         dir_entry.target.rmdir(dir_entry.name)
         dir_entry.target.remove_sync_info(dir_entry.name)
 
@@ -456,17 +1160,35 @@ class BaseSynchronizer:
         if (self.verbose >= 3 and not IS_REDIRECTED) or self.options.get("progress"):
             stats = self.get_stats()
             prefix = DRY_RUN_PREFIX if self.dry_run else ""
+            eta = self._get_eta()
             sys.stdout.write(
-                "{}Touched {}/{} entries in {} directories...\r".format(
+                "{}Touched {}/{} entries in {} directories{}...\r".format(
                     prefix,
                     stats["entries_touched"],
                     stats["entries_seen"],
                     stats["local_dirs"],
+                    ", ETA {}".format(format_duration(eta)) if eta else "",
                 )
             )
         sys.stdout.flush()
         return
 
+    def _get_eta(self):
+        """Return the estimated remaining transfer time in seconds (or None).
+
+        The rate is measured since the worker pool was started, the byte total
+        is taken from the plan (`--execute-plan`) or the scheduled transfers.
+        """
+        if not self._pool:
+            return None
+        stats = self._stats
+        done = stats["upload_bytes_written"] + stats["download_bytes_written"]
+        total = max(self._expected_bytes or 0, self._pool.bytes_submitted)
+        elap = time.monotonic() - self._transfer_start
+        if not done or not elap or done >= total:
+            return None
+        return (total - done) * elap / done
+
     def _dry_run_action(self, action):
         """Called in dry-run mode after call to _log_action() and before exiting function."""
         # write("dry-run", action)
@@ -495,11 +1217,65 @@ class BaseSynchronizer:
         handler methods.
         _sync_dir() is called by self.run().
         """
+        local_entries, remote_entries = self._get_dir_pair()
+
+        sub_dirs = self._sync_entries(local_entries, remote_entries)
+
+        # 6. Finally visit all local sub-directories recursively that also
+        #    exist on the remote target.
+        for name in sub_dirs:
+            self.local.cwd(name)
+            self.remote.cwd(name)
+            self._sync_dir()
+            self.local.cwd("..")
+            self.remote.cwd("..")
+
+        self._prefetch_discard()
+        return True
+
+    def _sync_entries(self, local_entries, remote_entries):
+        """Synchronize the entries of the current directory (not recursive).
+
+        This implements steps 1-5 of :meth:`_sync_dir` and is also used by the
+        asyncio engine (see :mod:`ftpsync.aio`).
+
+        Returns:
+            list of names of sub-directories that should be visited next
+        """
+        entry_pair_list = self._make_pairs(local_entries, remote_entries)
+
+        # Let the secondary connections list the sub-directories that exist on
+        # both targets while we process the current directory (`--prefetch`)
+        self._prefetch_pairs(entry_pair_list)
+        self._prefetch_hashes(entry_pair_list)
+
+        # 4. Perform (or schedule) resulting file operations
+        for pair in entry_pair_list:
+            self._handle_pair(pair, self._get_pair_action(pair))
+        self._discard_hashes()
+
+        # 5. Let the target provider write its meta data for the files in the
+        #    current directory (after pending transfers have completed).
+        self._join_workers()
+        self.local.flush_meta()
+        self.remote.flush_meta()
+
+        # 6. Collect all local sub-directories that also exist on the remote
+        #    target.
+        return self._get_sub_dirs(entry_pair_list)
+
+    def _make_pairs(self, local_entries, remote_entries):
+        """Return a list of classified :class:`EntryPair` (steps 1-3 of _sync_dir)."""
+        if self.options.get("resume"):
+            # Part files are not synchronized, but may be resumed by _copy_file()
+            self._part_files = {}
+            local_entries = self._split_part_files(local_entries)
+            remote_entries = self._split_part_files(remote_entries)
+
         # --case may be 'local', 'remote', 'strict', or None
         case_mode = self.options.get("case")
 
         # Convert into a dict {name: FileEntry, ...}
-        local_entries = self.local.get_dir()
         if case_mode == "strict":
             local_entry_map = {e.name: e for e in local_entries}
             # local_entry_map = dict(map(lambda e: (e.name, e), local_entries))
@@ -513,7 +1289,6 @@ class BaseSynchronizer:
                 )
 
         # Convert into a dict {name: FileEntry, ...}
-        remote_entries = self.remote.get_dir()
         if case_mode == "strict":
             remote_entry_map = {e.name: e for e in remote_entries}
             # remote_entry_map = dict(map(lambda e: (e.name, e), remote_entries))
@@ -595,65 +1370,203 @@ class BaseSynchronizer:
         for pair in entry_pair_list:
             pair.classify(peer_dir_meta)
 
-        # 4. Perform (or schedule) resulting file operations
-        for pair in entry_pair_list:
-            # print(pair)
-
-            # Let synchronizer modify the default operation (e.g. apply `--force` option)
-            hook_result = self.re_classify_pair(pair)
-
-            # Let synchronizer implement special handling of unmatched entries
-            # (e.g. `--delete_unmatched`)
-            if not self._match(pair.any_entry):
-                self.on_mismatch(pair)
-                # ... do not call operation handler...
-            elif hook_result is not False:
-                handler = getattr(self, "on_" + pair.operation, None)
-                # print(handler)
-                if handler:
-                    try:
-                        handler(pair)
-                    except Exception as e:
-                        if self.on_error(e, pair) is not True:
-                            raise
-                else:
-                    # write("NO HANDLER")
-                    raise NotImplementedError(f"No handler for {pair}")
+        return entry_pair_list
 
-            if pair.is_conflict():
-                self._inc_stat("conflict_files")
+    def _get_pair_action(self, pair):
+        """Return the operation that step 4 of _sync_dir will perform for `pair`.
 
-        # 5. Let the target provider write its meta data for the files in the
-        #    current directory.
-        self.local.flush_meta()
-        self.remote.flush_meta()
+        Returns:
+            `pair.operation`, 'mismatch' if on_mismatch() will be called, or None
+            if the synchronizer decided to skip the pair
+        """
+        # Let synchronizer modify the default operation (e.g. apply `--force` option)
+        hook_result = self.re_classify_pair(pair)
+
+        # Let synchronizer implement special handling of unmatched entries
+        # (e.g. `--delete_unmatched`)
+        if not self._match(pair.any_entry):
+            return "mismatch"
+        elif hook_result is False:
+            return None
+        return pair.operation
+
+    def _handle_pair(self, pair, action):
+        """Call the handler for a pair (see :meth:`_get_pair_action`)."""
+        if action == "mismatch":
+            self.on_mismatch(pair)
+            # ... do not call operation handler...
+        elif action:
+            handler = getattr(self, "on_" + action, None)
+            # print(handler)
+            if handler:
+                try:
+                    handler(pair)
+                except Exception as e:
+                    if self.on_error(e, pair) is not True:
+                        raise
+            else:
+                # write("NO HANDLER")
+                raise NotImplementedError(f"No handler for {pair}")
 
-        # 6. Finally visit all local sub-directories recursively that also
-        #    exist on the remote target.
-        for local_dir in local_entries:
+        if pair.is_conflict():
+            self._inc_stat("conflict_files")
+
+    def _get_sub_dirs(self, entry_pair_list):
+        """Return names of local directories that also exist on the remote target."""
+        sub_dirs = []
+        for pair in entry_pair_list:
+            local_dir = pair.local
             # write("local_dir(%s, %s)" % (local_dir, local_dir))
-            if not local_dir.is_dir():
+            if not local_dir or not local_dir.is_dir():
                 continue
             elif not self._before_sync(local_dir):
                 continue
 
-            if case_mode == "strict":
-                remote_dir = remote_entry_map.get(local_dir.name)
-            else:
-                remote_dir = remote_entry_map.get(local_dir.name.lower())
-
+            remote_dir = pair.remote
             if remote_dir:
                 if local_dir.was_deleted or remote_dir.was_deleted:
                     pass  # self.on_mismatch() removed an entry
                 else:
-                    self.local.cwd(local_dir.name)
-                    self.remote.cwd(local_dir.name)
-                    self._sync_dir()
-                    self.local.cwd("..")
-                    self.remote.cwd("..")
+                    sub_dirs.append(local_dir.name)
+        return sub_dirs
+
+    def _get_rel_dir(self):
+        """Return the current directory, relative to the targets' root."""
+        local = self.local
+        return local.cur_dir[len(normpath_url(local.root_dir)) :].lstrip("/")
+
+    def _write_plan(self, fp):
+        """Traverse both trees and write the resulting operations (`--write-plan`).
 
+        No handlers are called, so nothing is modified.
+        """
+        writer = SyncPlanWriter(fp, self)
+        self._plan_dir(writer)
+        writer.close()
+        for op, count in writer.op_counts.items():
+            self._stats[f"plan_{op}"] = count
+        self._stats["plan_bytes"] = sum(writer.op_bytes.values())
+        if self.verbose >= 3:
+            write(
+                "Planned {:,} operations ({:,} bytes).".format(
+                    sum(writer.op_counts.values()), self._stats["plan_bytes"]
+                )
+            )
         return True
 
+    def _plan_dir(self, writer):
+        rel_dir = self._get_rel_dir()
+        local_entries, remote_entries = self._get_dir_pair()
+        entry_pair_list = self._make_pairs(local_entries, remote_entries)
+        self._prefetch_pairs(entry_pair_list)
+
+        for pair in entry_pair_list:
+            action = self._get_pair_action(pair)
+            if action == "mismatch":
+                if not self.options.get("delete_unmatched"):
+                    continue
+                # on_mismatch() will delete it, so don't descend
+                pair.any_entry.was_deleted = True
+            elif action in (None, "equal"):
+                continue
+            tree = None
+            if pair.is_dir and action in ("copy_local", "copy_remote"):
+                if action == "copy_local":
+                    tree = self._plan_tree(self.local, pair.local)
+                else:
+                    tree = self._plan_tree(self.remote, pair.remote)
+            writer.add(rel_dir, pair, action, tree)
+
+        for name in self._get_sub_dirs(entry_pair_list):
+            self.local.cwd(name)
+            self.remote.cwd(name)
+            self._plan_dir(writer)
+            self.local.cwd("..")
+            self.remote.cwd("..")
+
+        self._prefetch_discard()
+
+    def _plan_tree(self, target, dir_entry):
+        """Return (files, bytes) of a directory that will be copied."""
+        files = size = 0
+        target.push_meta()
+        target.cwd(dir_entry.name)
+        try:
+            for entry in target.get_dir():
+                if entry.is_dir():
+                    sub_files, sub_size = self._plan_tree(target, entry)
+                    files += sub_files
+                    size += sub_size
+                else:
+                    files += 1
+                    size += entry.size
+        finally:
+            target.cwd("..")
+            target.pop_meta()
+        return files, size
+
+    def _execute_plan(self, fp):
+        """Perform the operations of a plan that was written by `--write-plan`.
+
+        Only directories that contain operations are listed again. Entries that
+        were modified after the plan was written are skipped (also all entries
+        of directories that no longer exist).
+        """
+        reader = SyncPlanReader(fp)
+        reader.check_synchronizer(self)
+        if fp.seekable():
+            # The byte total is stored at the end (used to calculate the ETA)
+            self._expected_bytes = sum(reader.read_summary()["bytes"].values())
+        for rel_dir, ops in reader.iter_dirs():
+            try:
+                for target in (self.local, self.remote):
+                    target.cwd(normpath_url(join_url(target.root_dir, rel_dir)))
+                local_entries, remote_entries = self._get_dir_pair()
+            except (OSError, ftplib.error_perm) as e:
+                write(
+                    f"Skipping {len(ops)} operation(s) in {rel_dir!r}: "
+                    f"the directory was modified after the plan was written ({e})",
+                    warning=True,
+                )
+                self._inc_stat("plan_skipped", len(ops))
+                continue
+            self._execute_plan_dir(ops, local_entries, remote_entries)
+
+        for target in (self.local, self.remote):
+            if target.cur_dir != target.root_dir:
+                target.cwd(target.root_dir)
+        return True
+
+    def _execute_plan_dir(self, ops, local_entries, remote_entries):
+        pair_map = {
+            pair.name: pair for pair in self._make_pairs(local_entries, remote_entries)
+        }
+        for op in ops:
+            pair = pair_map.get(op["name"])
+            action = self._get_pair_action(pair) if pair else None
+            if (
+                action != op["op"]
+                or not entry_state_matches(
+                    pair.local, op["local"], FileEntry.EPS_TIME
+                )
+                or not entry_state_matches(
+                    pair.remote, op["remote"], FileEntry.EPS_TIME
+                )
+            ):
+                write(
+                    "Skipping {}: modified after the plan was written".format(
+                        join_url(op["dir"], op["name"])
+                    ),
+                    warning=True,
+                )
+                self._inc_stat("plan_skipped")
+                continue
+            self._handle_pair(pair, action)
+
+        self._join_workers()
+        self.local.flush_meta()
+        self.remote.flush_meta()
+
     def re_classify_pair(self, pair):
         """Allow derrived classes to override default classification and operation.
 
@@ -871,6 +1784,9 @@ class BiDirSynchronizer(BaseSynchronizer):
     def on_copy_local(self, pair):
         local_entry = pair.local
         if self._test_match_or_print(local_entry):
+            if self._is_touched(pair):
+                self._log_action("", "equal", "=", local_entry, min_level=4)
+                return
             self._log_action("copy", pair.local_classification, ">", local_entry)
             if pair.is_dir:
                 self._copy_recursive(self.local, self.remote, local_entry)
@@ -929,12 +1845,14 @@ class BiDirSynchronizer(BaseSynchronizer):
             time_cmp = eps_compare(
                 pair.local.mtime, pair.remote.mtime, FileEntry.EPS_TIME
             )
-            if time_cmp < 0:
+            if time_cmp == 0 and pair.local.size == pair.remote.size:
+                c_pair = ("unmodified", "unmodified")  # equal
+            elif self._is_same_content(pair):
+                c_pair = ("unmodified", "unmodified")  # equal content
+            elif time_cmp < 0:
                 c_pair = ("unmodified", "modified")  # remote is newer
             elif time_cmp > 0:
                 c_pair = ("modified", "unmodified")  # local is newer
-            elif pair.local.size == pair.remote.size:
-                c_pair = ("unmodified", "unmodified")  # equal
             else:
                 c_pair = ("modified", "modified")  # conflict!
 
@@ -945,6 +1863,8 @@ class BiDirSynchronizer(BaseSynchronizer):
             )
             if time_cmp == 0 and pair.local.size == pair.remote.size:
                 c_pair = ("unmodified", "unmodified")  # equal
+            elif self._is_same_content(pair):
+                c_pair = ("unmodified", "unmodified")  # equal content
             else:
                 c_pair = ("modified", "modified")  # conflict!
 
@@ -973,6 +1893,13 @@ class BiDirSynchronizer(BaseSynchronizer):
         if not self._test_match_or_print(any_entry):
             return
 
+        if pair.local and pair.remote and self._is_same_content(pair):
+            # Both files were modified the same way
+            pair.local_classification = pair.remote_classification = "unmodified"
+            pair.operation = "equal"
+            self._log_action("", "equal", "=", pair.local, min_level=4)
+            return
+
         resolve = self._interactive_resolve(pair)
 
         if resolve == "skip":
@@ -1120,11 +2047,10 @@ class UploadSynchronizer(BiDirSynchronizer):
 
         return r
 
-    def run(self):
+    def _bind_targets(self):
         self.local.readonly = True
         self.remote.readonly = False
-        res = super().run()
-        return res
+        super()._bind_targets()
 
     def on_mismatch(self, pair):
         """Called for pairs that don't match `match` and `exclude` filters.
@@ -1271,11 +2197,10 @@ class DownloadSynchronizer(BiDirSynchronizer):
 
         return r
 
-    def run(self):
+    def _bind_targets(self):
         self.local.readonly = False
         self.remote.readonly = True
-        res = super().run()
-        return res
+        super()._bind_targets()
 
     def on_mismatch(self, pair):
         """Called for pairs that don't match `match` and `exclude` filters.
@@ -5,6 +5,7 @@ Licensed under the MIT license: https://www.opensource.org/licenses/mit-license.
 
 import codecs
 import contextlib
+import hashlib
 import io
 import os
 import shutil
@@ -14,10 +15,19 @@ from posixpath import join as join_url
 from posixpath import normpath as normpath_url
 from urllib.parse import unquote, urlparse
 
-from ftpsync.metadata import DirMetadata
+from ftpsync import delta
+from ftpsync.hash_cache import HashCache, hash_file
+from ftpsync.listing_cache import RemoteListingCache
+from ftpsync.metadata import DirMetadata, Manifest
 from ftpsync.resources import DirectoryEntry, FileEntry
+from ftpsync.stat_index import StatIndex
 from ftpsync.util import is_native, to_bytes, to_native, to_unicode, write
 
+#: Content digest algorithms (hashlib names) in order of preference, see
+#: :meth:`_Target.get_hash` (servers do not support BLAKE2, but it is the
+#: fastest choice if both targets are local)
+HASH_ALGORITHMS = ("blake2b", "sha256", "sha1", "md5")
+
 
 # ===============================================================================
 # make_target
@@ -98,8 +108,10 @@ class _Target:
         assert is_native(root_dir)
         if root_dir != "/":
             root_dir = root_dir.rstrip("/")
-        # This target is not thread safe
-        self._rlock = threading.RLock()
+        # This target is not thread safe.
+        # (Not an RLock, because pooled connections may be opened and closed
+        # by different threads.)
+        self._open_lock = threading.Lock()
         #: The target's top-level folder
         self.root_dir = root_dir
         self.extra_opts = extra_opts or {}
@@ -108,6 +120,18 @@ class _Target:
         self.host = None
         #: Set by BaseSynchronizer.__init__(). May be None for tree command, etc.
         self.synchronizer = None
+        #: The target this instance was cloned from (None for primary targets).
+        #: See :meth:`clone`.
+        self.primary = None
+        #: :class:`ftpsync.listing_cache.RemoteListingCache`: Set by open() of
+        #: remote targets (`--trust-cache`, `--refresh-cache`)
+        self.listing_cache = None
+        #: :class:`ftpsync.metadata.Manifest`: Set by open() of remote targets
+        #: (`--manifest`)
+        self.manifest = None
+        #: :class:`ftpsync.tree_listing.TreeSnapshot`: Set by open() of remote
+        #: targets (`--list-tree`)
+        self.tree_snapshot = None
         self.peer = None
         self.cur_dir = None
         self.connected = False
@@ -175,7 +199,7 @@ class _Target:
         if self.connected:
             raise RuntimeError(f"Target already open: {self}.  ")
         # Not thread safe (issue #20)
-        if not self._rlock.acquire(False):
+        if not self._open_lock.acquire(False):
             raise RuntimeError("Could not acquire _Target lock on open")
         self.connected = True
 
@@ -186,20 +210,131 @@ class _Target:
             write(f"Closing target {self}.")
         self.connected = False
         self.readonly = False  # issue #20
-        self._rlock.release()
+        self._open_lock.release()
+
+    def keepalive(self):
+        """Prevent that an idle connection times out (reconnect if it was dropped)."""
+        pass
+
+    def reconnect(self):
+        """Re-establish a dropped connection and restore the working directory."""
+        pass
 
     def check_write(self, name):
         """Raise exception if writing cur_dir/name is not allowed."""
         assert is_native(name)
         if self.readonly and name not in (
             DirMetadata.META_FILE_NAME,
+            DirMetadata.BINARY_META_FILE_NAME,
+            DirMetadata.JOURNAL_FILE_NAME,
             DirMetadata.LOCK_FILE_NAME,
+            Manifest.FILE_NAME,
+            Manifest.TEMP_FILE_NAME,
         ):
             raise RuntimeError(f"Target is read-only: {self} + {name} / ")
+        if self.listing_cache:
+            # We are about to modify cur_dir (or the sub folder `name`)
+            self.listing_cache.invalidate(self.cur_dir, name)
+        if self.tree_snapshot:
+            self.tree_snapshot.invalidate(self.cur_dir, name)
 
     def get_id(self):
         return self.root_dir
 
+    def _open_listing_cache(self):
+        """Called by open() of remote targets."""
+        if self.primary:
+            self.listing_cache = self.primary.listing_cache
+        elif self.get_option("trust_cache") or self.get_option("refresh_cache"):
+            self.listing_cache = RemoteListingCache.for_target(self)
+
+    def _close_listing_cache(self):
+        if self.listing_cache and not self.primary:
+            self.listing_cache.close()
+        self.listing_cache = None
+
+    def _open_manifest(self):
+        """Called by open() of remote targets (cur_dir is the root folder)."""
+        if self.primary:
+            self.manifest = self.primary.manifest
+        elif self.get_option("manifest"):
+            self.manifest = Manifest(self)
+            self.manifest.read()
+
+    def _close_manifest(self):
+        """Called by close() of remote targets (before the lock is removed)."""
+        if self.manifest and not self.primary:
+            self.manifest.flush()
+        self.manifest = None
+
+    def _open_tree_snapshot(self, read_tree):
+        """Called by open() of remote targets (cur_dir is the root folder).
+
+        Args:
+            read_tree (callable): return a
+                :class:`ftpsync.tree_listing.TreeSnapshot` of cur_dir (or None
+                if the server does not support this)
+        """
+        if self.primary:
+            self.tree_snapshot = self.primary.tree_snapshot
+        elif self.get_option("list_tree"):
+            self.tree_snapshot = read_tree()
+
+    def _pop_tree_listing(self):
+        """Return the entries of cur_dir from the tree snapshot (or None)."""
+        if not self.tree_snapshot:
+            return None
+        entries = self.tree_snapshot.pop(self.cur_dir)
+        if entries is not None:
+            self._inc_stat("tree_listing_hits")
+        return entries
+
+    def _get_dir_cached(self, get_dir_impl):
+        """Return `get_dir_impl()`, unless a cached listing is valid."""
+        cache = self.listing_cache
+        if not cache:
+            return get_dir_impl()
+        if not self.get_option("refresh_cache"):
+            entry_list = cache.get(self)
+            if entry_list is not None:
+                self._inc_stat("listing_cache_hits")
+                return entry_list
+        entry_list = get_dir_impl()
+        cache.put(self, entry_list)
+        self._inc_stat("listing_cache_misses")
+        return entry_list
+
+    def _inc_stat(self, name):
+        synchronizer = self.synchronizer or (
+            self.primary and self.primary.synchronizer
+        )
+        if synchronizer:
+            synchronizer._inc_stat(name)
+
+    def clone(self):
+        """Return a new, unconnected target with the same configuration.
+
+        Clones are used by worker threads that need a connection of their own.
+        They inherit the (already resolved) credentials and the effective options
+        of this target and never write a lock file. They don't maintain metadata
+        (this is left to the primary target), unless a synchronizer binds them
+        to a peer (see :mod:`ftpsync.aio`).
+        """
+        opts = dict(self.synchronizer.options) if self.synchronizer else {}
+        opts.update(self.extra_opts)
+        # Worker threads must never prompt for credentials
+        opts["no_prompt"] = True
+        target = self._make_clone(opts)
+        target.primary = self
+        target.readonly = self.readonly
+        target.dry_run = self.dry_run
+        target.server_time_ofs = self.server_time_ofs
+        return target
+
+    def _make_clone(self, extra_opts):
+        """Create an unconnected instance of this target class (see :meth:`clone`)."""
+        raise NotImplementedError
+
     def get_sync_info(self, name, key=None):
         """Get mtime/size when this target's current dir was last synchronized with remote."""
         peer_target = self.peer
@@ -354,8 +489,57 @@ class _Target:
         """Return file-like object opened in binary mode for cur_dir/name."""
         raise NotImplementedError
 
-    def open_writable(self, name):
-        """Return file-like object opened in binary mode for cur_dir/name."""
+    def read_range(self, name, offset, size):
+        """Return up to `size` bytes of cur_dir/name, starting at `offset`.
+
+        This default implementation reads the whole file, so targets should
+        implement a range request.
+        """
+        with self.open_readable(name) as fp:
+            fp.seek(offset)
+            return fp.read(size)
+
+    def supports_delta(self):
+        """Return True if delta transfers of changed blocks are possible (`--delta`).
+
+        See :mod:`ftpsync.delta`.
+        """
+        return False
+
+    def get_signature(self, name, block_size):
+        """Return the block signature of cur_dir/name (`--delta`).
+
+        Returns:
+            bytes or None if the file does not exist, or the target does not
+            support delta transfers
+        """
+        return None
+
+    def write_delta(self, name, signature, fp_out):
+        """Write the delta of cur_dir/name against `signature` to `fp_out`.
+
+        Returns:
+            bool: False if the target does not support delta transfers
+        """
+        return False
+
+    def apply_delta(self, name, fp_delta):
+        """Replace cur_dir/name by the version that `fp_delta` describes.
+
+        The new version is written to a temporary file first, so the file is
+        replaced atomically.
+
+        Returns:
+            bool: False if the delta could not be applied (the file is unchanged)
+        """
+        return False
+
+    def open_writable(self, name, offset=0):
+        """Return file-like object opened in binary mode for cur_dir/name.
+
+        If `offset` is passed, the existing file is truncated to `offset` bytes
+        and written data is appended.
+        """
         raise NotImplementedError
 
     def read_text(self, name):
@@ -369,7 +553,7 @@ class _Target:
             res = res.decode("utf-8")
             return res
 
-    def copy_to_file(self, name, fp_dest, callback=None):
+    def copy_to_file(self, name, fp_dest, callback=None, offset=0):
         """Write cur_dir/name to file-like `fp_dest`.
 
         Args:
@@ -377,11 +561,24 @@ class _Target:
             fp_dest (file-like): must support write() method
             callback (function, optional):
                 Called like `func(buf)` for every written chunk
+            offset (int, optional):
+                Skip the first `offset` bytes of the file (resume a download)
         """
         raise NotImplementedError
 
-    def write_file(self, name, fp_src, blocksize=DEFAULT_BLOCKSIZE, callback=None):
-        """Write binary data from file-like to cur_dir/name."""
+    def write_file(
+        self, name, fp_src, blocksize=DEFAULT_BLOCKSIZE, callback=None, offset=0
+    ):
+        """Write binary data from file-like to cur_dir/name.
+
+        If `offset` is passed, data is appended to the existing file, which must
+        have at least `offset` bytes (resume an upload). `fp_src` must already be
+        positioned at `offset`.
+        """
+        raise NotImplementedError
+
+    def rename(self, name, new_name):
+        """Rename cur_dir/name to cur_dir/new_name (replacing an existing file)."""
         raise NotImplementedError
 
     def write_text(self, name, s):
@@ -393,6 +590,20 @@ class _Target:
         """Remove cur_dir/name."""
         raise NotImplementedError
 
+    def get_hash(self, name, algorithms=HASH_ALGORITHMS):
+        """Return a content digest of cur_dir/name, if the target can provide it.
+
+        Remote targets ask the server, so the file is not downloaded.
+
+        Args:
+            name (str): file name, located in self.curdir
+            algorithms (tuple of str): accepted hashlib algorithm names, in
+                order of preference
+        Returns:
+            (algorithm, hexdigest) tuple or None if no digest is available
+        """
+        return None
+
     def set_mtime(self, name, mtime, size):
         raise NotImplementedError
 
@@ -403,6 +614,11 @@ class _Target:
         return self.cur_dir_meta.set_sync_info(name, mtime, size)
 
     def remove_sync_info(self, name):
+        if not self.peer:
+            # Worker clones (metadata is maintained by the primary target, see
+            # the callbacks in BaseSynchronizer._remove_file()), or a target
+            # that is no longer bound (e.g. while the manifest is written)
+            return
         if not self.is_local():
             return self.peer.remove_sync_info(name)
         if self.cur_dir_meta:
@@ -431,19 +647,51 @@ class FsTarget(_Target):
         if not os.path.isdir(root_dir):
             raise ValueError(f"{root_dir} is not a directory.")
         self.support_set_time = True
+        #: :class:`ftpsync.stat_index.StatIndex`: Set by open() (`--stat-index`)
+        self.stat_index = None
+        #: :class:`ftpsync.hash_cache.HashCache`: Set by open() (`--hash-cache`)
+        self.hash_cache = None
 
     def __str__(self):
         return "<FS:{} + {}>".format(
             self.root_dir, os.path.relpath(self.cur_dir, self.root_dir)
         )
 
+    def _make_clone(self, extra_opts):
+        return FsTarget(self.root_dir, extra_opts)
+
     def open(self):
         super().open()
         self.cur_dir = self.root_dir
+        if self.primary:
+            self.stat_index = self.primary.stat_index
+            self.hash_cache = self.primary.hash_cache
+            return
+        if self.get_option("stat_index") and not self.dry_run:
+            self.stat_index = StatIndex(
+                os.path.join(self.root_dir, StatIndex.FILE_NAME)
+            )
+        if self.get_option("hash_cache") and not self.dry_run:
+            self.hash_cache = HashCache(
+                os.path.join(self.root_dir, HashCache.FILE_NAME)
+            )
 
     def close(self):
+        if not self.primary:
+            for cache in (self.stat_index, self.hash_cache):
+                if cache:
+                    cache.close()
+        self.stat_index = self.hash_cache = None
         super().close()
 
+    def _invalidate_index(self):
+        """Called when cur_dir is modified."""
+        if self.stat_index:
+            self.stat_index.invalidate(self._get_index_key())
+
+    def _get_index_key(self):
+        return os.path.relpath(self.cur_dir, self.root_dir)
+
     def cwd(self, dir_name):
         path = normpath_url(join_url(self.cur_dir, dir_name))
         if not path.startswith(self.root_dir):
@@ -460,6 +708,7 @@ class FsTarget(_Target):
     def mkdir(self, dir_name):
         self.check_write(dir_name)
         path = normpath_url(join_url(self.cur_dir, dir_name))
+        self._invalidate_index()
         os.mkdir(path)
 
     def rmdir(self, dir_name):
@@ -467,6 +716,7 @@ class FsTarget(_Target):
         self.check_write(dir_name)
         path = normpath_url(join_url(self.cur_dir, dir_name))
         # write("REMOVE %r" % path)
+        self._invalidate_index()
         shutil.rmtree(path)
 
     def flush_meta(self):
@@ -478,45 +728,57 @@ class FsTarget(_Target):
         res = []
         # self.cur_dir_meta = None
         self.cur_dir_meta = DirMetadata(self)
+        if self.stat_index:
+            key = self._get_index_key()
+            dir_stat = os.stat(self.cur_dir)
+            listing = self.stat_index.get(key, dir_stat)
+            if listing is None:
+                listing = self._scan_dir()
+                self.stat_index.put(key, dir_stat, listing)
+                self._inc_stat("stat_index_misses")
+            else:
+                self._inc_stat("stat_index_hits")
+        else:
+            listing = self._scan_dir()
+
+        meta_files = []
+        for name, is_dir, size, mtime, ino in listing:
+            if is_dir:
+                res.append(DirectoryEntry(self, self.cur_dir, name, size, mtime, ino))
+            elif name in DirMetadata.META_FILE_NAMES:
+                meta_files.append(name)
+            # elif not name in (DirMetadata.DEBUG_META_FILE_NAME, ):
+            else:
+                res.append(FileEntry(self, self.cur_dir, name, size, mtime, ino))
+        if meta_files:
+            self.cur_dir_meta.read(meta_files)
+        return res
+
+    def _scan_dir(self):
+        """Return a list of (name, is_dir, size, mtime, ino) tuples for cur_dir.
+
+        os.scandir() returns the entry type without additional system calls, so
+        we only need one lstat() per entry.
+        """
+        res = []
         # List directory. Pass in unicode on Py2, so we get unicode in return
         unicode_cur_dir = to_unicode(self.cur_dir)
-        for name in os.listdir(unicode_cur_dir):
-            name = to_native(name)
-            path = os.path.join(self.cur_dir, name)
-            stat = os.lstat(path)
-            # write(name)
-            # write("    mt : %s" % stat.st_mtime)
-            # write("    lc : %s" % (time.localtime(stat.st_mtime),))
-            # write("       : %s" % time.asctime(time.localtime(stat.st_mtime)))
-            # write("    gmt: %s" % (time.gmtime(stat.st_mtime),))
-            # write("       : %s" % time.asctime(time.gmtime(stat.st_mtime)))
-
-            # utc_stamp = st_mtime_to_utc(stat.st_mtime)
-            # write("    utc: %s" % utc_stamp)
-            # write("    diff: %s" % ((utc_stamp - stat.st_mtime) / (60*60)))
-            # stat.st_mtime is returned as UTC
-            mtime = stat.st_mtime
-            if os.path.isdir(path):
-                res.append(
-                    DirectoryEntry(
-                        self, self.cur_dir, name, stat.st_size, mtime, str(stat.st_ino)
-                    )
-                )
-            elif os.path.isfile(path):
-                if name == DirMetadata.META_FILE_NAME:
-                    self.cur_dir_meta.read()
-                # elif not name in (DirMetadata.DEBUG_META_FILE_NAME, ):
+        with os.scandir(unicode_cur_dir) as it:
+            for dir_entry in it:
+                name = to_native(dir_entry.name)
+                if name.startswith((StatIndex.FILE_NAME, HashCache.FILE_NAME)):
+                    continue
+                stat = dir_entry.stat(follow_symlinks=False)
+                # stat.st_mtime is returned as UTC
+                mtime = stat.st_mtime
+                # Like os.path.isdir() and isfile(), we follow symlinks here
+                if dir_entry.is_dir():
+                    is_dir = True
+                elif dir_entry.is_file():
+                    is_dir = False
                 else:
-                    res.append(
-                        FileEntry(
-                            self,
-                            self.cur_dir,
-                            name,
-                            stat.st_size,
-                            mtime,
-                            str(stat.st_ino),
-                        )
-                    )
+                    continue
+                res.append((name, is_dir, stat.st_size, mtime, str(stat.st_ino)))
         return res
 
     def open_readable(self, name):
@@ -524,14 +786,53 @@ class FsTarget(_Target):
         # print("open_readable({})".format(name))
         return fp
 
-    def open_writable(self, name):
-        fp = open(os.path.join(self.cur_dir, name), "wb")
+    def read_range(self, name, offset, size):
+        with self.open_readable(name) as fp:
+            fp.seek(offset)
+            return fp.read(size)
+
+    def supports_delta(self):
+        return True
+
+    def get_signature(self, name, block_size):
+        path = os.path.join(self.cur_dir, name)
+        if not os.path.isfile(path):
+            return None
+        out = io.BytesIO()
+        delta.write_signature(path, block_size, out)
+        return out.getvalue()
+
+    def write_delta(self, name, signature, fp_out):
+        signature = delta.read_signature(io.BytesIO(signature))
+        delta.write_delta(os.path.join(self.cur_dir, name), signature, fp_out)
+        return True
+
+    def apply_delta(self, name, fp_delta):
+        self.check_write(name)
+        self._invalidate_index()
+        path = os.path.join(self.cur_dir, name)
+        try:
+            delta.apply_delta(path, fp_delta, path + delta.TEMP_SUFFIX)
+        except delta.DeltaError as e:
+            write(f"Could not apply delta to {name}: {e}", warning=True)
+            return False
+        return True
+
+    def open_writable(self, name, offset=0):
+        self._invalidate_index()
+        if offset:
+            fp = open(os.path.join(self.cur_dir, name), "ab")
+            fp.truncate(offset)
+        else:
+            fp = open(os.path.join(self.cur_dir, name), "wb")
         # print("open_readable({})".format(name))
         return fp
 
-    def write_file(self, name, fp_src, blocksize=DEFAULT_BLOCKSIZE, callback=None):
+    def write_file(
+        self, name, fp_src, blocksize=DEFAULT_BLOCKSIZE, callback=None, offset=0
+    ):
         self.check_write(name)
-        with open(os.path.join(self.cur_dir, name), "wb") as fp_dst:
+        with self.open_writable(name, offset) as fp_dst:
             while True:
                 data = fp_src.read(blocksize)
                 # print("write_file({})".format(name), len(data))
@@ -546,9 +847,51 @@ class FsTarget(_Target):
         """Remove cur_dir/name."""
         self.check_write(name)
         path = os.path.join(self.cur_dir, name)
+        self._invalidate_index()
         os.remove(path)
 
+    def get_hash(self, name, algorithms=HASH_ALGORITHMS):
+        for algorithm in algorithms:
+            if algorithm in hashlib.algorithms_available:
+                path = os.path.join(self.cur_dir, name)
+                return algorithm, self.hash_file(path, algorithm)
+        return None
+
+    def hash_file(self, path, algorithm):
+        """Return the hex digest of `path` (using the `--hash-cache`, if enabled).
+
+        Unlike get_hash(), this does not depend on cur_dir, so it may be called
+        by other threads.
+
+        Args:
+            path (str): absolute path of a file below root_dir
+            algorithm (str): hashlib algorithm name
+        Returns:
+            str
+        """
+        cache = self.hash_cache
+        if not cache:
+            return hash_file(path, algorithm)
+        key = os.path.relpath(path, self.root_dir)
+        file_stat = os.stat(path)
+        digest = cache.get(key, algorithm, file_stat)
+        if digest:
+            self._inc_stat("hash_cache_hits")
+            return digest
+        digest = hash_file(path, algorithm)
+        cache.put(key, algorithm, file_stat, digest)
+        self._inc_stat("hash_cache_misses")
+        return digest
+
+    def rename(self, name, new_name):
+        self.check_write(new_name)
+        self._invalidate_index()
+        os.replace(
+            os.path.join(self.cur_dir, name), os.path.join(self.cur_dir, new_name)
+        )
+
     def set_mtime(self, name, mtime, size):
         """Set modification time on file."""
         self.check_write(name)
+        self._invalidate_index()
         os.utime(os.path.join(self.cur_dir, name), (-1, mtime))
@@ -0,0 +1,282 @@
+"""
+(c) 2012-2024 Martin Wendt; see https://github.com/mar10/pyftpsync
+Licensed under the MIT license: https://www.opensource.org/licenses/mit-license.php
+
+Listings of a whole remote tree, received with one request (`--list-tree`).
+
+FTP targets parse recursive `ls -lR` style listings (`LIST -R`, `STAT -R`),
+SFTP targets the output of a `find` command that is run on the server.
+"""
+
+import re
+import threading
+from collections import Counter
+import time
+from calendar import timegm
+from posixpath import join as join_url
+from posixpath import normpath as normpath_url
+
+_MONTHS = {
+    name: i
+    for i, name in enumerate(
+        ("jan", "feb", "mar", "apr", "may", "jun")
+        + ("jul", "aug", "sep", "oct", "nov", "dec"),
+        1,
+    )
+}
+
+#: A line of `ls -l` output, e.g.
+#: '-rw-r--r--   1 owner    group         123 Jan 01 12:00 file name.txt'
+_LS_LINE = re.compile(
+    r"([-dlcbps])[-rwxsStTl]{9}[.+@]?\s+\d+\s+\S+\s+(?:\S+\s+)?(\d+)\s+"
+    r"([A-Za-z]{3})\s+(\d{1,2})\s+(\d{4}|\d{1,2}:\d{2}) (.+)"
+)
+
+
+def parse_ls_time(month, day, time_or_year, now):
+    """Return the epoch time of an `ls -l` date, assuming that it is UTC.
+
+    Servers usually list their local time, see :func:`estimate_time_offset`.
+
+    Dates of the last six months are listed with time but without year
+    ('Jan 01 12:00'), older dates only with year ('Jan 01  2014').
+
+    Args:
+        month (str): 'Jan', 'Feb', ...
+        day (str):
+        time_or_year (str): 'HH:MM' or 'YYYY'
+        now (float): current time (used to guess the missing year)
+    Returns:
+        int
+    Raises:
+        ValueError: if the date is malformed
+    """
+    try:
+        mon = _MONTHS[month.lower()]
+    except KeyError:
+        raise ValueError(f"Invalid month: {month!r}") from None
+    mday = int(day)
+    if ":" not in time_or_year:
+        return timegm((int(time_or_year), mon, mday, 0, 0, 0))
+    hour, _, minute = time_or_year.partition(":")
+    year = time.gmtime(now).tm_year
+    res = timegm((year, mon, mday, int(hour), int(minute), 0))
+    if res > now + 24 * 3600:
+        # A date in the future means: last year
+        res = timegm((year - 1, mon, mday, int(hour), int(minute), 0))
+    return res
+
+
+def parse_ls_line(line, now):
+    """Parse one line of `ls -l` output.
+
+    Returns:
+        (name, type, size, mtime, None) tuple like :func:`ftpsync.mlsd.parse_line`
+        for files and directories, None for other lines (e.g. 'total 12',
+        symbolic links or devices)
+    """
+    m = _LS_LINE.match(line)
+    if not m:
+        return None
+    kind, size, month, day, time_or_year, name = m.groups()
+    if kind == "d":
+        res_type = "dir"
+    elif kind == "-":
+        res_type = "file"
+    else:
+        return None
+    try:
+        mtime = parse_ls_time(month, day, time_or_year, now)
+    except ValueError:
+        return None
+    return name, res_type, int(size), mtime, None
+
+
+def estimate_time_offset(ls_entries, mlsd_entries, now):
+    """Return the offset of the times of an `ls -l` listing to UTC.
+
+    `ls -l` style listings usually report the server's local time. The offset
+    is derived by comparing the `ls` entries with the MLSD listing (UTC) of
+    the same directory. Only files of the last 150 days are compared, because
+    older dates are listed without time of day.
+
+    Args:
+        ls_entries (list): (name, type, size, mtime, unique) tuples, parsed by
+            :func:`parse_ls_line`
+        mlsd_entries (iterable): (name, type, size, mtime, unique) tuples
+        now (float): current time
+    Returns:
+        int: seconds to add to the `ls` times (a multiple of 15 minutes), or
+        None if no file could be compared
+    """
+    mlsd_times = {e[0]: e[3] for e in mlsd_entries if e[1] == "file" and e[3]}
+    min_time = now - 150 * 24 * 3600
+    offsets = Counter()
+    for name, res_type, _size, mtime, _unique in ls_entries:
+        utc_time = mlsd_times.get(name)
+        if res_type == "file" and utc_time and utc_time > min_time:
+            # `ls` truncates the time to minutes, so the difference is
+            # offset + 0..59 seconds
+            offsets[round((utc_time - mtime - 30) / 900) * 900] += 1
+    if not offsets:
+        return None
+    return offsets.most_common(1)[0][0]
+
+
+def _split_records(chunks, sep):
+    """Split a stream of byte chunks into `sep` terminated records (generator)."""
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        end = buffer.rfind(sep) + 1
+        if end:
+            yield from bytes(buffer[: end - 1]).split(sep)
+            del buffer[:end]
+    if buffer:
+        yield bytes(buffer)
+
+
+# ===============================================================================
+# TreeSnapshot
+# ===============================================================================
+class TreeSnapshot:
+    """Directory listings of a remote tree that were received with one request.
+
+    :meth:`ftpsync.targets._Target.get_dir` serves listings from here instead of
+    sending one request per directory.
+    A listing is only used once, and it is discarded when the target writes to
+    the directory.
+
+    Instances are shared by the target's clones (thread safe).
+
+    Args:
+        dirs (dict): {dir path: list of (name, type, size, mtime, unique)}
+        root_entries (list, optional): entries of the listed directory, if
+            they are not part of `dirs` (see :meth:`from_ls_lines`)
+    """
+
+    def __init__(self, dirs, root_entries=None):
+        self.dirs = dirs
+        self.root_entries = root_entries
+        #: All directory paths of the snapshot (also the ones that were popped)
+        self._known = set(dirs)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.dirs)
+
+    def __str__(self):
+        return f"{self.__class__.__name__}<{len(self.dirs)} dirs>"
+
+    @classmethod
+    def from_ls_lines(cls, lines, root_dir, now=None):
+        """Parse a recursive `ls -lR` listing (e.g. a `LIST -R` response).
+
+        Every sub directory starts with a header line like './sub/dir:',
+        'sub/dir:' or '/root/sub/dir:'.
+        Only directories with a header are part of the snapshot, so an empty
+        snapshot is returned if the server ignored the `-R` flag.
+        The listing of `root_dir` itself is not included, but stored as
+        :attr:`root_entries` (e.g. for :func:`estimate_time_offset`).
+        Times are parsed as UTC (see :meth:`shift_times`).
+
+        Args:
+            lines (iterable of str):
+            root_dir (str): the listed directory (absolute path)
+            now (float, optional): current time (default: `time.time()`)
+        Returns:
+            :class:`TreeSnapshot`
+        """
+        if now is None:
+            now = time.time()
+        root_dir = normpath_url(root_dir)
+        dirs = {}
+        root_entries = entries = []
+        for line in lines:
+            if line.startswith("213-"):  # `STAT -R` response
+                line = line[4:]
+            line = line.lstrip(" ")
+            if not line:
+                continue
+            info = parse_ls_line(line, now)
+            if info:
+                if info[0] not in (".", ".."):
+                    entries.append(info)
+            elif line.endswith(":"):
+                path = line[:-1]
+                if not path.startswith("/"):
+                    path = join_url(root_dir, path)
+                path = normpath_url(path)
+                if path == root_dir:
+                    entries = root_entries
+                else:
+                    entries = dirs.setdefault(path, [])
+        return cls(dirs, root_entries)
+
+    @classmethod
+    def from_find_output(cls, chunks, root_dir, encoding="utf-8"):
+        """Parse the output of `find ROOT -mindepth 1 -printf '%y %s %T@ %P\\0'`.
+
+        Every entry is a NUL terminated '<type> <size> <mtime> <path>' record,
+        where the path is relative to `root_dir`. Modification times are
+        truncated to seconds (like SFTP attributes). Entries that are not
+        directories are returned as files (like `listdir_attr()`).
+        The listing of `root_dir` is included.
+
+        Args:
+            chunks (iterable of bytes): the output, as it is received
+            root_dir (str): the listed directory (absolute path)
+            encoding (str, optional): file names that cannot be decoded are
+                decoded as Cp1252 (if `encoding` is 'utf-8')
+        Returns:
+            :class:`TreeSnapshot`
+        Raises:
+            ValueError: if a record is malformed
+        """
+        root_dir = normpath_url(root_dir)
+        fallback_enc = "cp1252" if encoding == "utf-8" else None
+        dirs = {root_dir: []}
+        for record in _split_records(chunks, b"\0"):
+            if not record:
+                continue
+            try:
+                record = record.decode(encoding)
+            except UnicodeDecodeError:
+                if not fallback_enc:
+                    raise
+                record = record.decode(fallback_enc)
+            kind, size, mtime, path = record.split(" ", 3)
+            parent, _, name = path.rpartition("/")
+            parent = join_url(root_dir, parent) if parent else root_dir
+            if kind == "d":
+                info = (name, "dir", int(size), int(float(mtime)), None)
+                dirs.setdefault(join_url(root_dir, path), [])
+            else:
+                info = (name, "file", int(size), int(float(mtime)), None)
+            dirs.setdefault(parent, []).append(info)
+        return cls(dirs)
+
+    def shift_times(self, offset):
+        """Add `offset` seconds to the modification times of all entries."""
+        with self._lock:
+            for entries in self.dirs.values():
+                entries[:] = [
+                    (name, res_type, size, mtime + offset, unique)
+                    for name, res_type, size, mtime, unique in entries
+                ]
+
+    def pop(self, path):
+        """Return and forget the listing of `path` (None if it is unknown)."""
+        with self._lock:
+            return self.dirs.pop(path, None)
+
+    def invalidate(self, path, name=None):
+        """Forget the listing of `path` (and the sub tree `name`, if any)."""
+        with self._lock:
+            self.dirs.pop(path, None)
+            sub_path = name and join_url(path, name)
+            if sub_path in self._known:
+                prefix = sub_path + "/"
+                for p in list(self.dirs):
+                    if p == sub_path or p.startswith(prefix):
+                        del self.dirs[p]
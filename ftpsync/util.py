@@ -5,9 +5,12 @@ Licensed under the MIT license: https://www.opensource.org/licenses/mit-license.
 
 import configparser
 import getpass
+import io
 import logging
+import mmap
 import netrc
 import os
+import random
 import sys
 from datetime import datetime
 
@@ -204,6 +207,12 @@ def pretty_stamp(stamp):
     return datetime.fromtimestamp(stamp).strftime("%Y-%m-%d %H:%M:%S")
 
 
+def format_duration(secs):
+    """Convert a number of seconds to 'H:MM:SS'."""
+    secs = int(round(secs))
+    return "{}:{:02}:{:02}".format(secs // 3600, secs // 60 % 60, secs % 60)
+
+
 _pyftpsyncrc_parser = configparser.RawConfigParser()
 _pyftpsyncrc_parser.read(os.path.expanduser("~/.pyftpsyncrc"))
 
@@ -397,31 +406,85 @@ def ansi_code(name):
         return ""
 
 
+#: Bytes per read() in :func:`byte_compare`
+COMPARE_BLOCKSIZE = 1024 * 1024
+
+
+def find_mismatch(buf_a, buf_b):
+    """Return the offset of the first differing byte of two buffers.
+
+    The mismatch is located by bisection, i.e. by comparing O(log n) slices
+    instead of iterating bytes in Python.
+    If one buffer is a prefix of the other, its length is returned.
+    """
+    # The first mismatch is in [lo, hi]
+    lo, hi = 0, min(len(buf_a), len(buf_b))
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if buf_a[lo : mid + 1] == buf_b[lo : mid + 1]:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def _map_file(stream):
+    """Return a read-only memory map of a local file (positioned like `stream`).
+
+    Returns None for other streams (e.g. a SpooledTemporaryFile, which would
+    roll over to disk when fileno() is called) and for empty files.
+    """
+    if not isinstance(stream, (io.BufferedReader, io.FileIO)):
+        return None
+    try:
+        mm = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    if hasattr(mm, "madvise"):  # Python 3.8+
+        mm.madvise(mmap.MADV_SEQUENTIAL)
+    mm.seek(stream.tell())
+    return mm
+
+
 def byte_compare(stream_a, stream_b):
     """Byte compare two files (early out on first difference).
 
+    Local files are read through memory maps. Blocks are compared as a whole
+    and the offset of the first mismatch is located by :func:`find_mismatch`.
+
     Returns:
-        (bool, int): offset of first mismatch or 0 if equal
+        (bool, int): offset of first mismatch or number of bytes if equal
+    """
+    maps = [_map_file(stream_a), _map_file(stream_b)]
+    try:
+        if maps[0] is not None:
+            stream_a = maps[0]
+        if maps[1] is not None:
+            stream_b = maps[1]
+        ofs = 0
+        while True:
+            b1 = stream_a.read(COMPARE_BLOCKSIZE)
+            b2 = stream_b.read(COMPARE_BLOCKSIZE)
+            if b1 != b2:
+                return (False, ofs + find_mismatch(b1, b2))
+            if not b1:  # both buffers empty
+                return (True, ofs)
+            ofs += len(b1)
+    finally:
+        for mm in maps:
+            if mm is not None:
+                mm.close()
+
+
+def sample_offsets(size, blocksize, count):
+    """Return sorted offsets of blocks that are sampled by a quick compare.
+
+    These are the first and the last block, and `count` random blocks.
     """
-    bufsize = 16 * 1024
-    equal = True
-    ofs = 0
-    while True:
-        b1 = stream_a.read(bufsize)
-        b2 = stream_b.read(bufsize)
-        if b1 != b2:
-            equal = False
-            if b1 and b2:
-                # we have two different buffers: find first mismatch
-                for a, b in zip(b1, b2):
-                    if a != b:
-                        break
-                    ofs += 1
-            break
-        ofs += len(b1)
-        if not b1:  # both buffers empty
-            break
-    return (equal, ofs)
+    last = max(size - blocksize, 0)
+    res = {0, last}
+    res.update(random.randint(0, last) for _ in range(count))
+    return sorted(res)
 
 
 # def decode_dict_keys(d, coding="utf-8"):
@@ -0,0 +1,477 @@
+"""
+(c) 2012-2024 Martin Wendt; see https://github.com/mar10/pyftpsync
+Licensed under the MIT license: https://www.opensource.org/licenses/mit-license.php
+"""
+
+import collections
+import posixpath
+import queue
+import threading
+import time
+
+from ftpsync.targets import _Target
+from ftpsync.util import write, write_error
+
+
+class _TargetArg:
+    """Placeholder for a target argument that is resolved by the worker thread."""
+
+    def __init__(self, target):
+        self.target = target
+        #: The working directory at the time the job was submitted
+        self.path = target.cur_dir
+
+
+#: Sort keys for the `transfer_order` option (None: keep listing order)
+TRANSFER_ORDERS = {
+    "listing": None,
+    "smallest": lambda job: job.size,
+    "largest": lambda job: -job.size,
+    "newest": lambda job: -job.mtime,
+}
+
+
+class _Job:
+    def __init__(self, func, args, callback, size, mtime):
+        self.func = func
+        self.args = args
+        self.callback = callback
+        #: Number of bytes that the job transfers (0 for other operations)
+        self.size = size
+        self.mtime = mtime
+
+
+# ===============================================================================
+# TransferWorkerPool
+# ===============================================================================
+class TransferWorkerPool:
+    """Run file operations of the current directory in parallel worker threads.
+
+    Target arguments of a job are replaced by connections that are borrowed
+    from the synchronizer's :class:`ftpsync.connection_pool.ConnectionPool`, so
+    N workers open up to N additional connections to a remote server.
+
+    Workers never touch metadata. Instead, the optional `callback` of a job is
+    collected and called by the main thread in :meth:`join`.
+    The synchronizer calls :meth:`join` before it changes the working directory
+    or flushes metadata, so meta data is always consistent per directory.
+
+    If `order` is set, jobs are held back until :meth:`join` and then started
+    in that order (see :data:`TRANSFER_ORDERS`).
+    If `large_workers` is set, files of `large_file_size` bytes or more are
+    queued in a separate lane that is served by that many of the workers only,
+    so small files are not blocked behind a few large ones. Large-file workers
+    also process small files while their lane is empty.
+
+    Args:
+        synchronizer (:class:`ftpsync.synchronizers.BaseSynchronizer`):
+        workers (int): number of worker threads
+        order (str): key of :data:`TRANSFER_ORDERS`
+        large_file_size (int): minimum size of files in the large-file lane
+        large_workers (int): number of workers that process large files
+    """
+
+    def __init__(
+        self, synchronizer, workers, order=None, large_file_size=0, large_workers=0
+    ):
+        assert workers > 0
+        self.synchronizer = synchronizer
+        self.workers = workers
+        self.sort_key = TRANSFER_ORDERS[order or "listing"]
+        self.large_file_size = large_file_size if large_workers else 0
+        self.large_workers = min(large_workers, workers) if large_file_size else 0
+        #: Protects all attributes below
+        self._cv = threading.Condition()
+        self._small = collections.deque()
+        self._large = collections.deque()
+        #: Jobs that are held back until join() (if `order` is set)
+        self._held = []
+        self._pending = 0
+        self._closed = False
+        #: Total size of all submitted jobs
+        self.bytes_submitted = 0
+        #: List of (callback, result, exception) tuples (processed by join())
+        self._done = []
+        self._threads = []
+        for i in range(workers):
+            is_large = i < self.large_workers
+            t = threading.Thread(
+                target=self._worker,
+                args=(is_large,),
+                name="pyftpsync-worker-{}{}".format(i + 1, "L" if is_large else ""),
+                daemon=True,
+            )
+            t.start()
+            self._threads.append(t)
+
+    def __str__(self):
+        return f"TransferWorkerPool<workers: {self.workers}, pending: {self._pending}>"
+
+    def submit(self, func, *args, callback=None, entry=None):
+        """Schedule `func(*args)` for execution by the next free worker.
+
+        All :class:`ftpsync.targets._Target` instances in `args` are replaced by
+        a pooled clone, which is positioned in the current working directory of
+        the original target.
+
+        Args:
+            func (callable):
+            args: positional arguments passed to `func`
+            callback (function, optional):
+                Called like `callback(result)` by :meth:`join` in the main thread,
+                after `func` returned successfully
+            entry (:class:`ftpsync.resources.FileEntry`, optional):
+                The file that is transferred (used for scheduling)
+        """
+        args = tuple(_TargetArg(a) if isinstance(a, _Target) else a for a in args)
+        size = (entry.size or 0) if entry else 0
+        mtime = (entry.mtime or 0) if entry else 0
+        job = _Job(func, args, callback, size, mtime)
+        with self._cv:
+            self._pending += 1
+            self.bytes_submitted += size
+            if self.sort_key:
+                self._held.append(job)
+            else:
+                self._dispatch(job)
+
+    def _dispatch(self, job):
+        if self.large_file_size and job.size >= self.large_file_size:
+            self._large.append(job)
+        else:
+            self._small.append(job)
+        self._cv.notify_all()
+
+    def join(self):
+        """Wait for all submitted jobs and run their callbacks in the calling thread.
+
+        Raises:
+            The first exception that was raised by a job (after all callbacks
+            of successful jobs have been called).
+        """
+        synchronizer = self.synchronizer
+        keepalive = synchronizer._get_keepalive()
+        last_ping = time.monotonic()
+        with self._cv:
+            if self._held:
+                held, self._held = self._held, []
+                # Stable sort, so equal keys keep the listing order
+                for job in sorted(held, key=self.sort_key):
+                    self._dispatch(job)
+        while True:
+            with self._cv:
+                if not self._pending:
+                    done, self._done = self._done, []
+                    break
+                # Wake up regularly to update the progress info
+                self._cv.wait(min(keepalive, 1.0) if keepalive else 1.0)
+            synchronizer._tick()
+            if keepalive and time.monotonic() - last_ping >= keepalive:
+                # The primary connections are idle during long transfers
+                synchronizer._keepalive_targets()
+                last_ping = time.monotonic()
+
+        first_exc = None
+        for callback, result, exc in done:
+            if exc is not None:
+                if first_exc is None:
+                    first_exc = exc
+                else:
+                    write_error(f"Worker job failed: {exc!r}")
+            elif callback:
+                callback(result)
+
+        if first_exc is not None:
+            raise first_exc
+        return
+
+    def close(self):
+        """Discard jobs that have not yet been started and stop all workers."""
+        with self._cv:
+            self._pending -= len(self._small) + len(self._large) + len(self._held)
+            self._small.clear()
+            self._large.clear()
+            self._held = []
+            self._closed = True
+            self._cv.notify_all()
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+    def _borrow(self, borrowed, target_arg):
+        pool = self.synchronizer._get_connection_pool(target_arg.target)
+        clone = pool.acquire(target_arg.path)
+        borrowed.append((pool, clone))
+        return clone
+
+    def _next_job(self, is_large):
+        with self._cv:
+            while not self._closed:
+                if is_large and self._large:
+                    return self._large.popleft()
+                elif self._small:
+                    return self._small.popleft()
+                self._cv.wait()
+        return None
+
+    def _worker(self, is_large):
+        while True:
+            job = self._next_job(is_large)
+            if job is None:
+                break
+            result = exc = None
+            #: Connections for this job [(pool, clone), ...]
+            borrowed = []
+            try:
+                args = [
+                    self._borrow(borrowed, a) if isinstance(a, _TargetArg) else a
+                    for a in job.args
+                ]
+                result = job.func(*args)
+            except Exception as e:
+                exc = e
+            finally:
+                for pool, clone in borrowed:
+                    pool.release(clone)
+            with self._cv:
+                self._done.append((job.callback, result, exc))
+                self._pending -= 1
+                self._cv.notify_all()
+        return
+
+
+# ===============================================================================
+# ListingPrefetcher
+# ===============================================================================
+class ListingPrefetcher:
+    """Fetch directory listings of a target in a background thread.
+
+    The prefetcher borrows a pooled clone of the target (i.e. a secondary
+    connection) to call `get_dir()` for directories that the synchronizer will visit later.
+    :meth:`get` then hands the ready-made entry list and metadata to the
+    primary target, so the listing latency is hidden behind transfer time.
+
+    Args:
+        synchronizer (:class:`ftpsync.synchronizers.BaseSynchronizer`):
+        target (:class:`ftpsync.targets._Target`):
+        max_pending (int): maximum number of listings that are held in memory
+    """
+
+    _QUEUED = "queued"
+    _RUNNING = "running"
+
+    def __init__(self, synchronizer, target, max_pending=1000):
+        self.synchronizer = synchronizer
+        self.target = target
+        self.max_pending = max_pending
+        self._queue = queue.Queue()
+        self._cv = threading.Condition()
+        #: {path: _QUEUED | _RUNNING | (entries, dir_meta) | Exception}
+        self._state = {}
+        self._thread = threading.Thread(
+            target=self._worker, name="pyftpsync-prefetch", daemon=True
+        )
+        self._thread.start()
+
+    def __str__(self):
+        return f"ListingPrefetcher<{self.target}, pending: {len(self._state)}>"
+
+    def submit(self, path):
+        """Schedule listing of `path` (an absolute path on the target)."""
+        with self._cv:
+            if path in self._state or len(self._state) >= self.max_pending:
+                return False
+            self._state[path] = self._QUEUED
+        self._queue.put(path)
+        return True
+
+    def get(self, path):
+        """Return the prefetched entries for `path` and adopt its metadata.
+
+        If the listing was not prefetched, it is cancelled (if still queued)
+        and None is returned, so the caller should list the directory itself.
+        Otherwise the entries are re-bound to the primary target and
+        `target.cur_dir_meta` is set to the prefetched metadata.
+
+        Returns:
+            list of :class:`ftpsync.resources._Resource` or None
+        """
+        assert path == self.target.cur_dir
+        with self._cv:
+            state = self._state.get(path)
+            if state is None:
+                return None
+            elif state is self._QUEUED:
+                del self._state[path]
+                return None
+            while self._state[path] is self._RUNNING:
+                self._cv.wait()
+            res = self._state.pop(path)
+
+        if isinstance(res, Exception):
+            if self.synchronizer.verbose >= 4:
+                write(f"Discarding prefetched listing of {path}: {res!r}")
+            return None
+
+        entries, dir_meta = res
+        for entry in entries:
+            entry.target = self.target
+        dir_meta.target = self.target
+        self.target.cur_dir_meta = dir_meta
+        self.synchronizer._inc_stat("prefetched_dirs")
+        return entries
+
+    def discard_children(self, parent):
+        """Forget listings of direct sub-directories of `parent`."""
+        with self._cv:
+            for path in list(self._state):
+                if posixpath.dirname(path) == parent:
+                    del self._state[path]
+
+    def close(self):
+        with self._cv:
+            self._state.clear()
+        self._queue.put(None)
+        self._thread.join()
+
+    def _worker(self):
+        pool = self.synchronizer._get_connection_pool(self.target)
+        while True:
+            path = self._queue.get()
+            if path is None:
+                break
+            with self._cv:
+                if self._state.get(path) is not self._QUEUED:
+                    continue  # cancelled or discarded
+                self._state[path] = self._RUNNING
+            try:
+                with pool.connection(path) as clone:
+                    entries = clone.get_dir()
+                    res = (entries, clone.cur_dir_meta)
+                    # The metadata is handed over to the primary target
+                    clone.cur_dir_meta = None
+            except Exception as e:
+                res = e
+            with self._cv:
+                if path in self._state:
+                    self._state[path] = res
+                self._cv.notify_all()
+        return
+
+
+# ===============================================================================
+# StreamPipe
+# ===============================================================================
+class StreamPipe:
+    """Bounded buffer that streams a file from one remote target to another.
+
+    :meth:`copy` downloads the source with `copy_to_file()` in a background
+    thread, while the calling thread uploads from the pipe with `write_file()`.
+    The download blocks while `max_size` bytes are buffered (back-pressure),
+    so both transfers overlap and neither memory nor temp disk space grow with
+    the file size.
+
+    Args:
+        max_size (int, optional): maximum number of buffered bytes
+            (default: :attr:`DEFAULT_MAX_SIZE`)
+    """
+
+    DEFAULT_MAX_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size or self.DEFAULT_MAX_SIZE
+        self._chunks = collections.deque()
+        self._size = 0
+        self._cv = threading.Condition()
+        #: True when the writer is done
+        self._eof = False
+        #: Exception that stopped the writer (raised by :meth:`read`)
+        self._error = None
+        #: True when the reader gave up (:meth:`write` raises BrokenPipeError)
+        self._aborted = False
+
+    def __str__(self):
+        return f"StreamPipe<{self._size:,d}/{self.max_size:,d} bytes>"
+
+    def write(self, data):
+        """Append `data`, waiting while the buffer is full."""
+        with self._cv:
+            while self._size >= self.max_size and not self._aborted:
+                self._cv.wait()
+            if self._aborted:
+                raise BrokenPipeError("The receiving end of the pipe was closed")
+            self._chunks.append(bytes(data))
+            self._size += len(data)
+            self._cv.notify_all()
+        return len(data)
+
+    def close_write(self, error=None):
+        """Signal the end of the data (or an `error` that stopped the writer)."""
+        with self._cv:
+            self._eof = True
+            self._error = error
+            self._cv.notify_all()
+
+    def read(self, size=-1):
+        """Return up to `size` bytes, waiting for data (b'' at the end)."""
+        with self._cv:
+            while not self._chunks and not self._eof:
+                self._cv.wait()
+            if self._error:
+                raise self._error
+            if not self._chunks or size == 0:
+                return b""
+            if size < 0:
+                data = b"".join(self._chunks)
+                self._chunks.clear()
+            else:
+                data = self._chunks.popleft()
+                if len(data) > size:
+                    self._chunks.appendleft(data[size:])
+                    data = data[:size]
+            self._size -= len(data)
+            self._cv.notify_all()
+        return data
+
+    def abort(self):
+        """Stop the writer, e.g. because the upload failed."""
+        with self._cv:
+            self._aborted = True
+            self._chunks.clear()
+            self._size = 0
+            self._cv.notify_all()
+
+    @classmethod
+    def copy(cls, src, name, dest, dest_name, callback=None, offset=0):
+        """Copy `src.cur_dir/name` to `dest.cur_dir/dest_name` through a pipe.
+
+        Args:
+            src (:class:`ftpsync.targets._Target`):
+            name (str):
+            dest (:class:`ftpsync.targets._Target`):
+            dest_name (str):
+            callback (function, optional):
+                Called like `func(buf)` for every uploaded chunk
+            offset (int, optional):
+                Resume both transfers at this position
+        Raises:
+            The first exception of the download or upload
+        """
+        pipe = cls()
+
+        def _download():
+            try:
+                src.copy_to_file(name, pipe, offset=offset)
+            except Exception as e:
+                pipe.close_write(e)
+            else:
+                pipe.close_write()
+
+        thread = threading.Thread(target=_download, name="pyftpsync-pipe", daemon=True)
+        thread.start()
+        try:
+            dest.write_file(dest_name, pipe, callback=callback, offset=offset)
+        finally:
+            pipe.abort()
+            thread.join()
+        return
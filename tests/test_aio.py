@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for pyftpsync
+"""
+# Allow long lines for readabilty
+# flake8: noqa: E501
+import asyncio
+import json
+import os
+import unittest
+
+from ftpsync.aio import (
+    AsyncBiDirSynchronizer,
+    AsyncDownloadSynchronizer,
+    AsyncTarget,
+    AsyncUploadSynchronizer,
+)
+from ftpsync.metadata import DirMetadata
+from ftpsync.synchronizers import (
+    BiDirSynchronizer,
+    DownloadSynchronizer,
+    UploadSynchronizer,
+)
+from tests.fixture_tools import (
+    PYFTPSYNC_TEST_FOLDER,
+    _SyncTestBase,
+    get_test_folder,
+    remove_test_file,
+    write_test_file,
+)
+from tests.test_workers import _TIMING_STATS
+
+
+def _blocking(async_synchronizer_class):
+    """Return a synchronizer class that can be passed to `_sync_test_folders()`."""
+
+    class _Runner:
+        def __init__(self, local, remote, options):
+            self.s = async_synchronizer_class(local, remote, options)
+
+        def run(self):
+            return asyncio.run(self.s.run())
+
+        def close(self):
+            pass
+
+        def get_stats(self):
+            return self.s.get_stats()
+
+    return _Runner
+
+
+def _get_meta_tree(folder_name):
+    """Return the content of all metadata files below a test folder.
+
+    Time stamps of the run (upload and sync times) are removed, so the result
+    can be compared with another run.
+    """
+
+    def _strip(d):
+        if not isinstance(d, dict):
+            return d
+        return {
+            k: _strip(v)
+            for k, v in d.items()
+            if k not in ("u", ":last_sync")
+            and not k.startswith("_")
+            and not k.endswith("_str")
+        }
+
+    res = {}
+    root_folder = os.path.join(PYFTPSYNC_TEST_FOLDER, folder_name)
+    for dir_path, _dir_names, file_names in os.walk(root_folder):
+        if DirMetadata.META_FILE_NAME in file_names:
+            with open(os.path.join(dir_path, DirMetadata.META_FILE_NAME)) as fp:
+                meta = json.load(fp)
+            res[os.path.relpath(dir_path, root_folder)] = _strip(meta)
+    return res
+
+
+# ===============================================================================
+# AsyncSynchronizerTest
+# ===============================================================================
+class AsyncSynchronizerTest(_SyncTestBase):
+    """Test that the asyncio engine produces the same results as `run()`."""
+
+    def setUp(self):
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+
+    def _run_sync_and_async(self, synchronizer_class, async_class, opts):
+        stats_1 = self.do_run_suite(synchronizer_class, opts)
+        local_1 = get_test_folder("local")
+        remote_1 = get_test_folder("remote")
+        meta_1 = _get_meta_tree("local"), _get_meta_tree("remote")
+
+        self._prepare_initial_synced_fixture()
+
+        opts = dict(opts, workers=3)
+        stats_2 = self.do_run_suite(_blocking(async_class), opts)
+        local_2 = get_test_folder("local")
+        remote_2 = get_test_folder("remote")
+        meta_2 = _get_meta_tree("local"), _get_meta_tree("remote")
+
+        self.assert_test_folder_equal(local_1, local_2)
+        self.assert_test_folder_equal(remote_1, remote_2)
+        self.assertEqual(meta_1, meta_2)
+        for name in _TIMING_STATS:
+            stats_1.pop(name, None)
+            stats_2.pop(name, None)
+        self.assertDictEqual(stats_1, stats_2)
+
+    def test_bidir(self):
+        opts = {"verbose": self.verbose, "resolve": "local"}
+        self._run_sync_and_async(BiDirSynchronizer, AsyncBiDirSynchronizer, opts)
+
+    def test_upload_delete(self):
+        opts = {"verbose": self.verbose, "resolve": "local", "delete": True}
+        self._run_sync_and_async(UploadSynchronizer, AsyncUploadSynchronizer, opts)
+
+    def test_download_delete(self):
+        opts = {"verbose": self.verbose, "resolve": "remote", "delete": True}
+        self._run_sync_and_async(
+            DownloadSynchronizer, AsyncDownloadSynchronizer, opts
+        )
+
+    def test_delete_and_recreate(self):
+        """Deleted files are removed from the metadata."""
+        self._prepare_initial_synced_fixture()
+        opts = {"verbose": self.verbose, "resolve": "local", "workers": 3}
+        self._sync_test_folders(_blocking(AsyncBiDirSynchronizer), opts)
+
+        remove_test_file("local/folder1/file1_1.txt")
+        stats = self._sync_test_folders(_blocking(AsyncBiDirSynchronizer), opts)
+        self.assertEqual(stats["files_deleted"], 1)
+
+        write_test_file(
+            "remote/folder1/file1_1.txt", dt="2014-01-01 13:00:00", content="new"
+        )
+        opts["resolve"] = "skip"
+        stats = self._sync_test_folders(_blocking(AsyncBiDirSynchronizer), opts)
+        self.assertEqual(stats["files_written"], 1)
+        self.assertEqual(stats["conflict_files"], 0)
+        self.assertEqual(
+            get_test_folder("local")["folder1/file1_1.txt"]["content"], "new"
+        )
+
+    def test_initial_copy(self):
+        self._prepare_initial_local_fixture()
+        stats = self._sync_test_folders(
+            _blocking(AsyncBiDirSynchronizer), {"workers": 2}
+        )
+        self.assertEqual(stats["files_written"], 16)
+        self.assertEqual(stats["dirs_created"], 7)
+        self.assert_test_folder_equal(
+            get_test_folder("remote"), _SyncTestBase.local_fixture_unmodified
+        )
+
+    def test_no_interactive_resolve(self):
+        remote = self._make_remote_target()
+        with self.assertRaises(RuntimeError):
+            AsyncBiDirSynchronizer(remote, remote, {"resolve": "ask"})
+
+    def test_async_target(self):
+        self._prepare_initial_synced_fixture()
+
+        async def _main(target):
+            await target.open()
+            try:
+                # More listings than connections are in flight
+                listings = await asyncio.gather(
+                    *(target.get_dir(p) for p in ("", "folder1", "folder2", "folder3"))
+                )
+                async with target.open_readable("folder1", "file1_1.txt") as fp:
+                    data = fp.read()
+                # Connections are re-used
+                self.assertEqual(len(target._conns), 2)
+            finally:
+                await target.close()
+            return listings, data
+
+        target = AsyncTarget(self._make_remote_target(), connections=2)
+        listings, data = asyncio.run(_main(target))
+
+        names = sorted(e.name for e in listings[1])
+        self.assertIn("file1_1.txt", names)
+        self.assertEqual(len(listings), 4)
+        self.assertEqual(data, b"local1_1")
+
+
+class FtpAsyncSynchronizerTest(AsyncSynchronizerTest):
+    """Run the AsyncSynchronizerTest tests against an FTP server."""
+
+    use_ftp_target = True
+
+
+# ===============================================================================
+# Main
+# ===============================================================================
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for pyftpsync
+"""
+# Allow long lines for readabilty
+# flake8: noqa: E501
+import io
+import unittest
+
+from ftpsync import binary_meta
+from ftpsync.metadata import DirMetadata
+from ftpsync.synchronizers import BiDirSynchronizer
+from tests.fixture_tools import _SyncTestBase, get_test_folder, is_test_file
+
+META_DICT = {
+    "mtimes": {
+        "file1.txt": {"m": 1388577600.0, "s": 6, "u": 1700000000.5},
+        "Ä ü.txt": {"m": 1388577600.25, "s": 0, "u": 1700000001.0},
+    },
+    "peer_sync": {
+        "ftp.example.com/www": {
+            ":last_sync": 1700000002.0,
+            "file1.txt": {"m": 1388577600.0, "s": 6, "u": 1700000002.0},
+            "folder1": {"m": None, "s": None, "u": 1700000002.0},
+        }
+    },
+}
+
+
+class _SlowReader(io.BytesIO):
+    """Return at most a few bytes per read() call."""
+
+    def read(self, size=-1):
+        return super().read(7)
+
+
+# ===============================================================================
+# BinaryFormatTest
+# ===============================================================================
+class BinaryFormatTest(unittest.TestCase):
+    """Test the compact binary metadata format."""
+
+    def test_round_trip(self):
+        for compress in (False, True):
+            data = binary_meta.dumps(META_DICT, compress=compress)
+            self.assertEqual(binary_meta.load(io.BytesIO(data)), (META_DICT, len(data)))
+            # Records are decoded incrementally
+            self.assertEqual(binary_meta.load(_SlowReader(data))[0], META_DICT)
+
+    def test_size(self):
+        meta_dict = {
+            "mtimes": {
+                f"file_{i}.txt": {"m": 1388577600.0 + i, "s": i, "u": 1700000000.0 + i}
+                for i in range(1000)
+            },
+            "peer_sync": {},
+        }
+        data = binary_meta.dumps(meta_dict)
+        self.assertLess(len(data), len(DirMetadata._dumps(meta_dict)) / 2)
+        self.assertEqual(binary_meta.load(io.BytesIO(data))[0], meta_dict)
+
+    def test_invalid(self):
+        data = binary_meta.dumps(META_DICT, compress=False)
+        with self.assertRaises(ValueError):
+            binary_meta.load(io.BytesIO(data[:-3]))
+        with self.assertRaises(ValueError):
+            binary_meta.load(io.BytesIO(b'{"mtimes": {}}'))
+        with self.assertRaises(ValueError):
+            binary_meta.load(io.BytesIO(b"PFSM\x63\x00"))
+
+    def test_truncated(self):
+        data = binary_meta.dumps(META_DICT, compress=False)
+        header_size = binary_meta._HEADER.size
+        # A cut right behind the first record type byte
+        with self.assertRaisesRegex(ValueError, "Truncated metadata record"):
+            binary_meta.load(io.BytesIO(data[: header_size + 1]))
+        complete = 0
+        for cut in range(len(data)):
+            try:
+                binary_meta.load(io.BytesIO(data[:cut]))
+                complete += 1
+            except ValueError:
+                pass
+        # Only cuts at record boundaries (i.e. before a type byte) are not detected
+        records = list(binary_meta.RecordReader(io.BytesIO(data)))
+        self.assertEqual(complete, len(records))
+
+
+# ===============================================================================
+# BinaryMetaSyncTest
+# ===============================================================================
+class BinaryMetaSyncTest(_SyncTestBase):
+    """Test `--meta-format binary`."""
+
+    def test_bidir(self):
+        opts = {"verbose": self.verbose, "resolve": "local"}
+        self.do_run_suite(BiDirSynchronizer, opts)
+        local_1 = get_test_folder("local")
+        remote_1 = get_test_folder("remote")
+
+        self._prepare_initial_synced_fixture()
+        opts["meta_format"] = "binary"
+        self.do_run_suite(BiDirSynchronizer, opts)
+        self.assert_test_folder_equal(get_test_folder("local"), local_1)
+        self.assert_test_folder_equal(get_test_folder("remote"), remote_1)
+
+        # Modified directories were converted
+        self.assertTrue(is_test_file("local/" + DirMetadata.BINARY_META_FILE_NAME))
+        self.assertFalse(is_test_file("local/" + DirMetadata.META_FILE_NAME))
+
+        stats = self._sync_test_folders(BiDirSynchronizer, opts)
+        self.assertEqual(stats["files_written"], 0)
+        self.assertEqual(stats["conflict_files"], 0)
+
+    def test_migration(self):
+        opts = {"verbose": self.verbose, "resolve": "local", "meta_format": "binary"}
+        json_path = "local/folder1/" + DirMetadata.META_FILE_NAME
+        binary_path = "local/folder1/" + DirMetadata.BINARY_META_FILE_NAME
+        stats = self._sync_test_folders(BiDirSynchronizer, opts)
+        self.assertEqual(stats["files_written"], 0)
+        self.assertEqual(stats["conflict_files"], 0)
+        self.assertTrue(is_test_file(binary_path))
+        self.assertFalse(is_test_file(json_path))
+
+        # ... and back
+        stats = self._sync_test_folders(
+            BiDirSynchronizer, dict(opts, meta_format="json")
+        )
+        self.assertEqual(stats["files_written"], 0)
+        self.assertEqual(stats["conflict_files"], 0)
+        self.assertFalse(is_test_file(binary_path))
+        self.assertTrue(is_test_file(json_path))
+
+
+class FtpBinaryMetaSyncTest(BinaryMetaSyncTest):
+    """Run the BinaryMetaSyncTest tests against an FTP server."""
+
+    use_ftp_target = True
+
+
+# ===============================================================================
+# Main
+# ===============================================================================
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for pyftpsync
+"""
+# Allow long lines for readabilty
+# flake8: noqa: E501
+import threading
+import time
+import unittest
+from posixpath import join as join_url
+
+from ftpsync import ftp_target
+from ftpsync.connection_pool import ConnectionPool
+from tests.fixture_tools import _SyncTestBase
+
+
+# ===============================================================================
+# ConnectionPoolTest
+# ===============================================================================
+class ConnectionPoolTest(_SyncTestBase):
+    """Test ConnectionPool with a file system target."""
+
+    def setUp(self):
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+
+    def test_reuse(self):
+        remote = self._make_remote_target()
+        pool = ConnectionPool(remote, max_size=2, keepalive=0)
+        try:
+            clone = pool.acquire(remote.root_dir)
+            self.assertTrue(clone.connected)
+            self.assertIs(clone.primary, remote)
+            pool.release(clone)
+
+            folder = join_url(remote.root_dir, "folder1")
+            with pool.connection(folder) as clone_2:
+                self.assertIs(clone_2, clone)
+                self.assertEqual(clone_2.cur_dir, folder)
+                names = {e.name for e in clone_2.get_dir()}
+                self.assertIn("file1_1.txt", names)
+        finally:
+            pool.close()
+        self.assertFalse(clone.connected)
+
+    def test_max_size(self):
+        remote = self._make_remote_target()
+        pool = ConnectionPool(remote, max_size=2, keepalive=0)
+        res = []
+        try:
+            clone_1 = pool.acquire()
+            clone_2 = pool.acquire()
+            self.assertIsNot(clone_1, clone_2)
+
+            def _borrow():
+                with pool.connection() as clone:
+                    res.append(clone)
+
+            t = threading.Thread(target=_borrow)
+            t.start()
+            time.sleep(0.1)
+            # Blocked, until a connection is returned
+            self.assertEqual(res, [])
+            pool.release(clone_2)
+            t.join()
+            self.assertEqual(res, [clone_2])
+            pool.release(clone_1)
+        finally:
+            pool.close()
+
+    def test_keepalive(self):
+        remote = self._make_remote_target()
+        pool = ConnectionPool(remote, keepalive=0.1)
+        try:
+            clone = pool.acquire()
+            pool.release(clone)
+            time.sleep(0.3)
+            # Still usable after the keepalive thread has visited it
+            with pool.connection() as clone_2:
+                self.assertIs(clone_2, clone)
+                self.assertTrue(clone_2.get_dir())
+        finally:
+            pool.close()
+
+    def test_reconnect(self):
+        if not self.use_ftp_target:
+            self.skipTest("Only for FTP targets")
+        remote = self._make_remote_target()
+        remote.open()
+        try:
+            self.assertIn((remote.host, remote.port, remote.tls), ftp_target._server_features)
+            remote.cwd("folder1")
+            # Simulate a connection drop
+            remote.ftp.sock.close()
+            remote.keepalive()
+            self.assertEqual(remote.cur_dir, join_url(remote.root_dir, "folder1"))
+            names = {e.name for e in remote.get_dir()}
+            self.assertIn("file1_1.txt", names)
+            remote.cwd("..")
+        finally:
+            remote.close()
+
+
+class FtpConnectionPoolTest(ConnectionPoolTest):
+    """Run the ConnectionPoolTest tests against an FTP server."""
+
+    use_ftp_target = True
+
+
+# ===============================================================================
+# Main
+# ===============================================================================
+if __name__ == "__main__":
+    unittest.main()
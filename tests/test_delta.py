@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for pyftpsync
+"""
+# Allow long lines for readabilty
+# flake8: noqa: E501
+import io
+import os
+import subprocess
+import tempfile
+import unittest
+
+from ftpsync import delta
+from ftpsync.synchronizers import DownloadSynchronizer, UploadSynchronizer
+from tests.fixture_tools import (
+    _SyncTestBase,
+    is_test_file,
+    read_test_file,
+    write_test_file,
+)
+from tests.sftp_server import SftpTargetMixin
+
+#: About 2.6 MB of unique lines
+LINES = "".join(f"line {i}\n" for i in range(250_000))
+
+
+def _delta_round_trip(old_path, new_path):
+    """Patch `old_path` to the content of `new_path` and return the delta size."""
+    signature = io.BytesIO()
+    block_size = delta.block_size_for(os.path.getsize(new_path))
+    delta.write_signature(old_path, block_size, signature)
+    signature.seek(0)
+    fp_delta = io.BytesIO()
+    delta.write_delta(new_path, delta.read_signature(signature), fp_delta)
+    fp_delta.seek(0)
+    delta.apply_delta(old_path, fp_delta, old_path + delta.TEMP_SUFFIX)
+    return len(fp_delta.getvalue())
+
+
+# ===============================================================================
+# DeltaTest
+# ===============================================================================
+class DeltaTest(unittest.TestCase):
+    """Test ftpsync.delta."""
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.old_path = os.path.join(self.folder.name, "old.txt")
+        self.new_path = os.path.join(self.folder.name, "new.txt")
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def _write(self, old, new):
+        for path, content in ((self.old_path, old), (self.new_path, new)):
+            with open(path, "wb") as fp:
+                fp.write(content)
+
+    def test_round_trip(self):
+        old = LINES.encode("ascii")
+        cases = {
+            "same": (old, 10_000),
+            "append": (old + b"appended\n" * 1000, 20_000),
+            "insert": (old[:1_000_000] + b"inserted\n" * 10 + old[1_000_000:], 10_000),
+            "modify": (old[:500] + b"X" + old[501:], 10_000),
+            "prefix": (os.urandom(1_500_000) + old, 1_500_000 + delta.SEARCH_WINDOW),
+            "truncate": (old[:1_234_567], 10_000),
+            "empty": (b"", 100),
+        }
+        for name, (new, max_size) in cases.items():
+            self._write(old, new)
+            size = _delta_round_trip(self.old_path, self.new_path)
+            with open(self.old_path, "rb") as fp:
+                self.assertEqual(fp.read(), new, name)
+            self.assertLess(size, max_size, name)
+            self.assertFalse(os.path.exists(self.old_path + delta.TEMP_SUFFIX))
+
+    def test_invalid(self):
+        self._write(b"old content", b"new content")
+        for data in (b"", b"PFSD1", b"PFSD1X", b"PFSD1" + b"E" + bytes(40)):
+            with self.assertRaises(delta.DeltaError):
+                delta.apply_delta(
+                    self.old_path, io.BytesIO(data), self.old_path + delta.TEMP_SUFFIX
+                )
+            with open(self.old_path, "rb") as fp:
+                self.assertEqual(fp.read(), b"old content")
+            self.assertFalse(os.path.exists(self.old_path + delta.TEMP_SUFFIX))
+        with self.assertRaises(delta.DeltaError):
+            delta.read_signature(io.BytesIO(b"PFSD1" + bytes(8)))
+
+    def test_helper(self):
+        old = LINES.encode("ascii")
+        new = old + b"appended\n"
+        self._write(old, new)
+
+        def _run(*args, input=b""):
+            cmd = delta.helper_command(*args)
+            return subprocess.run(cmd, shell=True, input=input, capture_output=True)
+
+        res = _run("signature", self.old_path, 4096)
+        self.assertEqual(res.returncode, 0)
+        signature = res.stdout
+        res = _run("delta", self.new_path, input=signature)
+        self.assertEqual(res.returncode, 0)
+        res = _run("patch", self.old_path, self.old_path + ".tmp", input=res.stdout)
+        self.assertEqual(res.returncode, 0)
+        with open(self.old_path, "rb") as fp:
+            self.assertEqual(fp.read(), new)
+
+        self.assertEqual(_run("signature", self.old_path + "x", 4096).returncode, 2)
+        self.assertEqual(_run("patch", self.old_path, "x", input=b"x").returncode, 3)
+
+
+# ===============================================================================
+# FsDeltaTest
+# ===============================================================================
+class FsDeltaTest(_SyncTestBase):
+    """Test `--delta` with two local targets."""
+
+    def _write_big_files(self, src, dest, content):
+        write_test_file(f"{dest}/big.txt", content=LINES, dt="2014-01-01 13:00:00")
+        write_test_file(f"{src}/big.txt", content=content, dt="2014-01-01 13:00:05")
+
+    def test_upload(self):
+        content = LINES[:1_000_000] + "inserted\n" + LINES[1_000_000:] + "appended\n"
+        self._write_big_files("local", "remote", content)
+        opts = {"verbose": self.verbose, "resolve": "local", "delta": True}
+        stats = self._sync_test_folders(UploadSynchronizer, opts)
+        self.assertEqual(stats["upload_files_written"], 1)
+        self.assertEqual(stats["delta_files_written"], 1)
+        self.assertLess(stats["upload_bytes_written"], 50_000)
+        self.assertGreater(stats["delta_bytes_saved"], 2_500_000)
+        self.assertEqual(read_test_file("remote/big.txt"), content)
+
+        stats = self._sync_test_folders(UploadSynchronizer, opts)
+        self.assertEqual(stats["upload_files_written"], 0)
+
+    def test_download(self):
+        content = LINES + "appended\n"
+        self._write_big_files("remote", "local", content)
+        opts = {"verbose": self.verbose, "resolve": "remote", "delta": True}
+        stats = self._sync_test_folders(DownloadSynchronizer, opts)
+        self.assertEqual(stats["delta_files_written"], 1)
+        self.assertLess(stats["download_bytes_written"], 50_000)
+        self.assertEqual(read_test_file("local/big.txt"), content)
+
+    def test_new_file(self):
+        write_test_file("local/big.txt", content=LINES)
+        opts = {"verbose": self.verbose, "delta": True}
+        stats = self._sync_test_folders(UploadSynchronizer, opts)
+        self.assertEqual(stats["upload_files_written"], 1)
+        self.assertNotIn("delta_files_written", stats)
+        self.assertEqual(read_test_file("remote/big.txt"), LINES)
+
+    def test_disabled(self):
+        self._write_big_files("local", "remote", LINES + "appended\n")
+        opts = {"verbose": self.verbose, "resolve": "local"}
+        stats = self._sync_test_folders(UploadSynchronizer, opts)
+        self.assertNotIn("delta_files_written", stats)
+        self.assertEqual(stats["upload_bytes_written"], len(LINES) + 9)
+
+
+# ===============================================================================
+# SftpDeltaTest
+# ===============================================================================
+class SftpDeltaTest(SftpTargetMixin, FsDeltaTest):
+    """Test `--delta` with SFTP targets (using tests.sftp_server)."""
+
+    def test_refused(self):
+        content = LINES + "appended\n"
+        self._write_big_files("local", "remote", content)
+        self.server.allow_exec = False
+        try:
+            opts = {"verbose": self.verbose, "resolve": "local", "delta": True}
+            stats = self._sync_test_folders(UploadSynchronizer, opts)
+        finally:
+            self.server.allow_exec = True
+        self.assertEqual(stats["upload_files_written"], 1)
+        self.assertNotIn("delta_files_written", stats)
+        self.assertEqual(read_test_file("remote/big.txt"), content)
+        self.assertFalse(is_test_file("remote/big.txt" + delta.TEMP_SUFFIX))
+
+
+# ===============================================================================
+# Main
+# ===============================================================================
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for pyftpsync
+"""
+# Allow long lines for readabilty
+# flake8: noqa: E501
+import os
+import unittest
+
+from ftpsync.synchronizers import UploadSynchronizer
+from ftpsync.targets import make_target
+from tests.fixture_tools import (
+    PYFTPSYNC_TEST_FOLDER,
+    _SyncTestBase,
+    read_test_file,
+    write_test_file,
+)
+from tests.ftp_server import FTPServerThread, RecursiveListHandler
+
+
+class NoActiveHandler(RecursiveListHandler):
+    """A server that refuses active mode (and therefore FXP as destination)."""
+
+    def ftp_PORT(self, line):
+        self.respond("500 Active data connections are not allowed.")
+
+
+# ===============================================================================
+# FxpTest
+# ===============================================================================
+class FxpTest(_SyncTestBase):
+    """Test `--fxp` with two in-process FTP servers (local and remote)."""
+
+    remote_handler = RecursiveListHandler
+
+    def setUp(self):
+        super().setUp()
+        self.server = FTPServerThread()
+        self.local_url = self.server.add_server(
+            os.path.join(PYFTPSYNC_TEST_FOLDER, "local")
+        )
+        self.remote_url = self.server.add_server(
+            os.path.join(PYFTPSYNC_TEST_FOLDER, "remote"), self.remote_handler
+        )
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+        super().tearDown()
+
+    def _upload(self, opts):
+        local = make_target(self.local_url)
+        remote = make_target(self.remote_url)
+        s = UploadSynchronizer(local, remote, dict(opts, verbose=self.verbose))
+        s.run()
+        s.close()
+        return s.get_stats()
+
+    def test_fxp(self):
+        write_test_file("local/big.txt", size=300_000)
+        write_test_file("local/folder1/new.txt", content="new")
+        stats = self._upload({"fxp": True})
+        self.assertEqual(stats["upload_files_written"], 2)
+        self.assertEqual(stats["fxp_files_written"], 2)
+        self.assertEqual(stats["upload_bytes_written"], 300_003)
+        self.assertEqual(read_test_file("remote/big.txt"), "*" * 300_000)
+        self.assertEqual(read_test_file("remote/folder1/new.txt"), "new")
+
+        stats = self._upload({"fxp": True})
+        self.assertEqual(stats["upload_files_written"], 0)
+
+    def test_relay(self):
+        write_test_file("local/big.txt", size=300_000)
+        stats = self._upload({})
+        self.assertEqual(stats["upload_files_written"], 1)
+        self.assertNotIn("fxp_files_written", stats)
+        self.assertEqual(stats["upload_bytes_written"], 300_000)
+        self.assertEqual(read_test_file("remote/big.txt"), "*" * 300_000)
+
+
+class FxpRefusedTest(FxpTest):
+    """`--fxp` falls back to relaying if the destination refuses PORT."""
+
+    remote_handler = NoActiveHandler
+
+    def test_fxp(self):
+        write_test_file("local/big.txt", size=300_000)
+        write_test_file("local/folder1/new.txt", content="new")
+        stats = self._upload({"fxp": True})
+        self.assertEqual(stats["upload_files_written"], 2)
+        self.assertNotIn("fxp_files_written", stats)
+        self.assertEqual(stats["upload_bytes_written"], 300_003)
+        self.assertEqual(read_test_file("remote/big.txt"), "*" * 300_000)
+        self.assertEqual(read_test_file("remote/folder1/new.txt"), "new")
+
+
+# ===============================================================================
+# Main
+# ===============================================================================
+if __name__ == "__main__":
+    unittest.main()
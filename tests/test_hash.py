@@ -0,0 +1,469 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for pyftpsync
+"""
+# Allow long lines for readabilty
+# flake8: noqa: E501
+import hashlib
+import io
+import os
+import unittest
+
+from ftpsync.hash_cache import HashCache
+from ftpsync.synchronizers import BiDirSynchronizer, UploadSynchronizer
+from ftpsync.targets import FsTarget, make_target
+from ftpsync.util import byte_compare, find_mismatch, sample_offsets
+from tests.fixture_tools import (
+    PYFTPSYNC_TEST_FOLDER,
+    _SyncTestBase,
+    is_test_file,
+    read_test_file,
+    touch_test_file,
+    write_test_file,
+)
+from tests.ftp_server import FTPServerThread, RecursiveListHandler
+from tests.sftp_server import SftpTargetMixin
+
+
+def _hexdigest(algorithm, name):
+    with open(os.path.join(PYFTPSYNC_TEST_FOLDER, name), "rb") as fp:
+        return hashlib.new(algorithm, fp.read()).hexdigest()
+
+
+def _write_big_files(size, ofs=None):
+    """Write local/big.txt and remote/big.txt (differing at `ofs`)."""
+    write_test_file("local/big.txt", size=size, dt="2014-01-01 13:00:00")
+    content = "*" * size
+    if ofs is not None:
+        content = content[:ofs] + "!" + content[ofs + 1 :]
+    write_test_file("remote/big.txt", content=content, dt="2014-01-01 13:00:05")
+
+
+# ===============================================================================
+# ByteCompareTest
+# ===============================================================================
+class ByteCompareTest(unittest.TestCase):
+    """Test ftpsync.util.byte_compare() and helpers."""
+
+    def test_find_mismatch(self):
+        data = bytes(range(256)) * 10
+        for ofs in (0, 1, 255, 1000, len(data) - 1):
+            other = data[:ofs] + b"!" + data[ofs + 1 :]
+            self.assertEqual(find_mismatch(data, other), ofs)
+        self.assertEqual(find_mismatch(data, data[:100]), 100)
+        self.assertEqual(find_mismatch(b"", data), 0)
+
+    def test_streams(self):
+        data = b"x" * 3_000_000
+        other = data[:2_500_000] + b"y" + data[2_500_001:]
+        self.assertEqual(
+            byte_compare(io.BytesIO(data), io.BytesIO(data)), (True, len(data))
+        )
+        self.assertEqual(
+            byte_compare(io.BytesIO(data), io.BytesIO(other)), (False, 2_500_000)
+        )
+        self.assertEqual(
+            byte_compare(io.BytesIO(data), io.BytesIO(data[:10])), (False, 10)
+        )
+        self.assertEqual(byte_compare(io.BytesIO(), io.BytesIO()), (True, 0))
+
+    def test_sample_offsets(self):
+        res = sample_offsets(1000, 100, 3)
+        self.assertEqual(res[0], 0)
+        self.assertEqual(res[-1], 900)
+        self.assertLessEqual(len(res), 5)
+        self.assertListEqual(res, sorted(res))
+        self.assertListEqual(sample_offsets(50, 100, 3), [0])
+
+
+class FsByteCompareTest(_SyncTestBase):
+    """Test byte_compare() with local files (memory mapped)."""
+
+    def _compare(self):
+        with open(os.path.join(PYFTPSYNC_TEST_FOLDER, "local/big.txt"), "rb") as a:
+            with open(os.path.join(PYFTPSYNC_TEST_FOLDER, "remote/big.txt"), "rb") as b:
+                return byte_compare(a, b)
+
+    def test_files(self):
+        _write_big_files(3_000_000)
+        self.assertEqual(self._compare(), (True, 3_000_000))
+        for ofs in (0, 1_048_576, 2_999_999):
+            _write_big_files(3_000_000, ofs)
+            self.assertEqual(self._compare(), (False, ofs))
+        write_test_file("local/big.txt", content="")
+        write_test_file("remote/big.txt", content="")
+        self.assertEqual(self._compare(), (True, 0))
+        write_test_file("remote/big.txt", content="x")
+        self.assertEqual(self._compare(), (False, 0))
+
+    def test_compare_content(self):
+        _write_big_files(5_000_000, 4_000_000)
+        opts = {"verbose": self.verbose, "resolve": "skip", "compare_content": True}
+        stats = self._sync_test_folders(BiDirSynchronizer, opts)
+        # Local files are not sampled
+        self.assertNotIn("sample_compares", stats)
+        self.assertEqual(stats["hash_compares"], 1)
+        self.assertEqual(stats["conflict_files"], 1)
+
+
+# ===============================================================================
+# FsHashTest
+# ===============================================================================
+class FsHashTest(_SyncTestBase):
+    """Test FsTarget.get_hash()."""
+
+    def test_get_hash(self):
+        write_test_file("local/big.txt", size=3_000_000)
+        local = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "local"))
+        local.open()
+        self.assertEqual(
+            local.get_hash("big.txt"),
+            ("blake2b", _hexdigest("blake2b", "local/big.txt")),
+        )
+        self.assertEqual(
+            local.get_hash("big.txt", ("sha256",)),
+            ("sha256", _hexdigest("sha256", "local/big.txt")),
+        )
+        self.assertEqual(
+            local.get_hash("big.txt", ("foo", "md5")),
+            ("md5", _hexdigest("md5", "local/big.txt")),
+        )
+        self.assertIsNone(local.get_hash("big.txt", ("foo",)))
+        local.close()
+
+
+# ===============================================================================
+# FtpHashTest
+# ===============================================================================
+class FtpHashTest(_SyncTestBase):
+    """Test FTPTarget.get_hash() with an in-process FTP server."""
+
+    def setUp(self):
+        super().setUp()
+        self.server = FTPServerThread()
+        self.hash_url = self.server.add_server(
+            os.path.join(PYFTPSYNC_TEST_FOLDER, "remote")
+        )
+        self.plain_url = self.server.add_server(
+            os.path.join(PYFTPSYNC_TEST_FOLDER, "local"), RecursiveListHandler
+        )
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+        super().tearDown()
+
+    def _get_hashes(self, url, refused=(), algorithms=None):
+        remote = make_target(url)
+        remote.open()
+        try:
+            remote.refused_hash_commands.update(refused)
+            remote.cwd("folder1")
+            args = (algorithms,) if algorithms else ()
+            res = [
+                remote.get_hash("file1_1.txt", *args),
+                remote.get_hash("file1_1.txt", *args),
+                remote.get_hash("missing.txt", *args),
+            ]
+            return res, remote.refused_hash_commands
+        finally:
+            remote.close()
+
+    def test_hash(self):
+        sha256 = ("sha256", _hexdigest("sha256", "remote/folder1/file1_1.txt"))
+        md5 = ("md5", _hexdigest("md5", "remote/folder1/file1_1.txt"))
+        res, refused = self._get_hashes(self.hash_url)
+        self.assertListEqual(res, [sha256, sha256, None])
+        self.assertSetEqual(refused, set())
+        res, refused = self._get_hashes(self.hash_url, algorithms=("foo", "md5"))
+        self.assertListEqual(res, [md5, md5, None])
+
+    def test_x_commands(self):
+        sha1 = ("sha1", _hexdigest("sha1", "remote/folder1/file1_1.txt"))
+        res, refused = self._get_hashes(self.hash_url, refused={"HASH"})
+        self.assertListEqual(res[:2], [res[0]] * 2)
+        self.assertEqual(res[0][0], "sha256")
+        res, refused = self._get_hashes(
+            self.hash_url, refused={"HASH", "XSHA256"}, algorithms=("sha256", "sha1")
+        )
+        self.assertListEqual(res, [sha1, sha1, None])
+
+    def test_unsupported(self):
+        res, refused = self._get_hashes(self.plain_url)
+        self.assertListEqual(res, [None, None, None])
+        self.assertSetEqual(refused, {"XSHA256", "XSHA1", "XMD5"})
+
+    def test_compare_file(self):
+        local = make_target(self.plain_url)
+        remote = make_target(self.hash_url)
+        opts = {"verbose": self.verbose, "resolve": "skip", "compare_content": True}
+        s = BiDirSynchronizer(local, remote, opts)
+        local.open()
+        remote.open()
+        try:
+            entries = [
+                {e.name: e for e in t.get_dir()}["file1.txt"] for t in (local, remote)
+            ]
+            self.assertTrue(s._compare_file(*entries))
+            self.assertEqual(s.get_stats()["byte_compares"], 1)
+            self.assertNotIn("hash_compares", s.get_stats())
+        finally:
+            s.close()
+
+    def _compare_big_files(self):
+        local = make_target(self.plain_url)
+        remote = make_target(self.hash_url)
+        opts = {"verbose": self.verbose, "compare_content": True}
+        s = BiDirSynchronizer(local, remote, opts)
+        local.open()
+        remote.open()
+        try:
+            entries = [
+                {e.name: e for e in t.get_dir()}["big.txt"] for t in (local, remote)
+            ]
+            return s._compare_content(*entries), s.get_stats()
+        finally:
+            s.close()
+
+    def test_read_range(self):
+        _write_big_files(300_000)
+        remote = make_target(self.hash_url)
+        remote.open()
+        try:
+            self.assertEqual(remote.read_range("big.txt", 0, 10), b"*" * 10)
+            self.assertEqual(remote.read_range("big.txt", 299_990, 100), b"*" * 10)
+            self.assertEqual(remote.read_range("big.txt", 100, 100_000), b"*" * 100_000)
+            # The connection is still usable
+            self.assertEqual(remote.read_text("file1.txt"), "local1")
+        finally:
+            remote.close()
+
+    def test_sample_compare(self):
+        for ofs in (0, 4_999_999):
+            _write_big_files(5_000_000, ofs)
+            (res, info), stats = self._compare_big_files()
+            self.assertFalse(res)
+            self.assertEqual(info, f"sampled, at offset {ofs:,d}")
+            self.assertEqual(stats["sample_mismatches"], 1)
+            self.assertNotIn("byte_compares", stats)
+
+        _write_big_files(5_000_000)
+        (res, info), stats = self._compare_big_files()
+        self.assertTrue(res)
+        self.assertEqual(stats["sample_compares"], 1)
+        self.assertNotIn("sample_mismatches", stats)
+        self.assertEqual(stats["byte_compares"], 1)
+
+
+# ===============================================================================
+# SftpHashTest
+# ===============================================================================
+class SftpHashTest(SftpTargetMixin, _SyncTestBase):
+    """Test SFTPTarget.get_hash() (using tests.sftp_server)."""
+
+    def _get_hash(self, refused=(), algorithms=None):
+        # paramiko's server needs at least 256 bytes for `check-file`
+        write_test_file("remote/folder1/file1_1.txt", size=1000)
+        remote = self._make_remote_target()
+        remote.open()
+        try:
+            remote.refused_hash_methods.update(refused)
+            remote.cwd("folder1")
+            args = (algorithms,) if algorithms else ()
+            return remote.get_hash("file1_1.txt", *args), remote.refused_hash_methods
+        finally:
+            remote.close()
+
+    def test_check_file(self):
+        # paramiko's server supports sha1 and md5 (not sha256)
+        res, refused = self._get_hash()
+        self.assertEqual(
+            res, ("sha1", _hexdigest("sha1", "remote/folder1/file1_1.txt"))
+        )
+        self.assertSetEqual(refused, {("check-file", "sha256")})
+
+    def test_exec(self):
+        check_file = {("check-file", a) for a in ("sha256", "sha1", "md5")}
+        res, refused = self._get_hash(refused=check_file)
+        if self.sftp_allow_exec:
+            self.assertEqual(
+                res, ("sha256", _hexdigest("sha256", "remote/folder1/file1_1.txt"))
+            )
+            self.assertSetEqual(refused, check_file)
+        else:
+            self.assertIsNone(res)
+            self.assertSetEqual(
+                refused, check_file | {("exec", a) for a in ("sha256", "sha1", "md5")}
+            )
+
+
+    def test_read_range(self):
+        _write_big_files(300_000, 200_000)
+        remote = self._make_remote_target()
+        remote.open()
+        try:
+            self.assertEqual(remote.read_range("big.txt", 199_999, 3), b"*!*")
+            self.assertEqual(remote.read_range("big.txt", 299_990, 100), b"*" * 10)
+        finally:
+            remote.close()
+
+
+class SftpNoExecHashTest(SftpHashTest):
+    """Without exec channels, only `check-file` is available."""
+
+    sftp_allow_exec = False
+
+
+# ===============================================================================
+# CompareContentTest
+# ===============================================================================
+class CompareContentTest(_SyncTestBase):
+    """Test `--compare-content`."""
+
+    def test_without_meta(self):
+        self._prepare_synced_fixture_without_meta()
+        # Same content, but remote looks newer
+        write_test_file("local/file1.txt", size=5000, dt="2014-01-01 12:00:00")
+        write_test_file("remote/file1.txt", size=5000, dt="2014-01-01 13:00:00")
+        touch_test_file("remote/file3.txt", dt="2014-01-01 13:00:00")
+        # Other content of the same size
+        write_test_file("remote/file2.txt", content="remot2", dt="2014-01-01 13:00:00")
+        opts = {"verbose": self.verbose, "resolve": "skip"}
+        stats = self._sync_test_folders(BiDirSynchronizer, dict(opts, dry_run=True))
+        self.assertEqual(stats["download_files_written"], 3)
+
+        stats = self._sync_test_folders(
+            BiDirSynchronizer, dict(opts, compare_content=True)
+        )
+        self.assertEqual(stats["hash_compares"], 1)
+        self.assertEqual(stats["byte_compares"], 2)  # Small files
+        self.assertEqual(stats["download_files_written"], 1)
+        self.assertEqual(stats["upload_files_written"], 0)
+        self.assertEqual(read_test_file("local/file2.txt"), "remot2")
+
+        # The equal files were recorded as synchronized
+        stats = self._sync_test_folders(
+            BiDirSynchronizer, dict(opts, compare_content=True)
+        )
+        self.assertNotIn("hash_compares", stats)
+        self.assertNotIn("byte_compares", stats)
+        self.assertEqual(stats["files_written"], 0)
+
+    def test_conflict(self):
+        # Both files were modified the same way
+        write_test_file("local/file1.txt", size=5000, dt="2014-01-01 13:00:00")
+        write_test_file("remote/file1.txt", size=5000, dt="2014-01-01 13:00:05")
+        write_test_file(
+            "local/file2.txt", content="a" * 5000, dt="2014-01-01 13:00:00"
+        )
+        write_test_file(
+            "remote/file2.txt", content="b" * 5000, dt="2014-01-01 13:00:05"
+        )
+        opts = {"verbose": self.verbose, "resolve": "skip"}
+        stats = self._sync_test_folders(BiDirSynchronizer, dict(opts, dry_run=True))
+        self.assertEqual(stats["conflict_files"], 2)
+
+        opts["compare_content"] = True
+        stats = self._sync_test_folders(BiDirSynchronizer, opts)
+        self.assertEqual(stats["hash_compares"], 2)
+        self.assertEqual(stats["conflict_files"], 1)
+        self.assertEqual(stats["conflict_files_skipped"], 1)
+
+        stats = self._sync_test_folders(BiDirSynchronizer, opts)
+        self.assertEqual(stats["hash_compares"], 1)
+        self.assertEqual(stats["conflict_files"], 1)
+        self.assertEqual(stats["files_written"], 0)
+
+
+# ===============================================================================
+# HashCacheTest
+# ===============================================================================
+class HashCacheTest(_SyncTestBase):
+    """Test `--hash-cache`."""
+
+    def test_cache(self):
+        path = os.path.join(PYFTPSYNC_TEST_FOLDER, "local", "file1.txt")
+        cache = HashCache(os.path.join(PYFTPSYNC_TEST_FOLDER, HashCache.FILE_NAME))
+        try:
+            file_stat = os.stat(path)
+            cache.put("file1.txt", "md5", file_stat, "abc")
+            self.assertEqual(cache.get("file1.txt", "md5", file_stat), "abc")
+            self.assertIsNone(cache.get("file1.txt", "sha1", file_stat))
+            touch_test_file("local/file1.txt", dt="2014-01-01 12:00:01")
+            self.assertIsNone(cache.get("file1.txt", "md5", os.stat(path)))
+            # Modified just before it was hashed
+            touch_test_file("local/file1.txt")
+            file_stat = os.stat(path)
+            cache.put("file1.txt", "md5", file_stat, "abc")
+            self.assertIsNone(cache.get("file1.txt", "md5", file_stat))
+
+            self.assertIsNone(cache.get_synced("peer", "file1.txt"))
+            cache.set_synced("peer", "file1.txt", 1.5, "md5", "abc")
+            self.assertEqual(cache.get_synced("peer", "file1.txt"), (1.5, "md5", "abc"))
+            self.assertIsNone(cache.get_synced("other", "file1.txt"))
+        finally:
+            cache.close()
+
+    def test_hits(self):
+        write_test_file("local/file1.txt", size=5000, dt="2014-01-01 13:00:00")
+        write_test_file("remote/file1.txt", size=5000, dt="2014-01-01 13:00:05")
+        write_test_file(
+            "local/file2.txt", content="a" * 5000, dt="2014-01-01 13:00:00"
+        )
+        write_test_file(
+            "remote/file2.txt", content="b" * 5000, dt="2014-01-01 13:00:05"
+        )
+        opts = {
+            "verbose": self.verbose,
+            "resolve": "skip",
+            "compare_content": True,
+            "hash_cache": True,
+        }
+        stats = self._sync_test_folders(BiDirSynchronizer, opts)
+        self.assertEqual(stats["hash_compares"], 2)
+        self.assertEqual(stats["hash_cache_misses"], 4)
+        self.assertEqual(stats["conflict_files"], 1)
+
+        stats = self._sync_test_folders(BiDirSynchronizer, opts)
+        self.assertEqual(stats["hash_compares"], 1)
+        self.assertGreaterEqual(stats["hash_cache_hits"], 2)
+        self.assertNotIn("hash_cache_misses", stats)
+        self.assertEqual(stats["conflict_files"], 1)
+        # Both targets keep their own cache, which is not synchronized
+        self.assertTrue(is_test_file("local/" + HashCache.FILE_NAME))
+        self.assertTrue(is_test_file("remote/" + HashCache.FILE_NAME))
+        self.assertEqual(stats["local_files"], stats["remote_files"])
+
+    def test_touched(self):
+        opts = {"verbose": self.verbose, "compare_content": True, "hash_cache": True}
+        write_test_file("local/big.txt", size=5000, dt="2014-01-01 13:00:00")
+        stats = self._sync_test_folders(UploadSynchronizer, opts)
+        self.assertEqual(stats["upload_files_written"], 1)
+
+        # Only the mtime changed
+        touch_test_file("local/big.txt", dt="2014-01-01 14:00:00")
+        stats = self._sync_test_folders(UploadSynchronizer, opts)
+        self.assertEqual(stats["touched_files"], 1)
+        self.assertEqual(stats["upload_files_written"], 0)
+        stats = self._sync_test_folders(UploadSynchronizer, opts)
+        self.assertNotIn("touched_files", stats)
+        self.assertEqual(stats["upload_files_written"], 0)
+
+        # Synchronized without the cache: the stored digest is outdated
+        write_test_file("local/big.txt", content="a" * 5000, dt="2014-01-01 15:00:00")
+        stats = self._sync_test_folders(
+            UploadSynchronizer, dict(opts, hash_cache=False)
+        )
+        self.assertEqual(stats["upload_files_written"], 1)
+        write_test_file("local/big.txt", size=5000, dt="2014-01-01 16:00:00")
+        stats = self._sync_test_folders(UploadSynchronizer, opts)
+        self.assertNotIn("touched_files", stats)
+        self.assertEqual(stats["upload_files_written"], 1)
+        self.assertEqual(read_test_file("remote/big.txt"), "*" * 5000)
+
+
+# ===============================================================================
+# Main
+# ===============================================================================
+if __name__ == "__main__":
+    unittest.main()
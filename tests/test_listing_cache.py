@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for pyftpsync
+"""
+# Allow long lines for readabilty
+# flake8: noqa: E501
+import os
+import shutil
+import unittest
+
+from ftpsync.listing_cache import RemoteListingCache
+from ftpsync.synchronizers import BiDirSynchronizer, DownloadSynchronizer
+from tests.fixture_tools import (
+    PYFTPSYNC_TEST_FOLDER,
+    _SyncTestBase,
+    read_test_file,
+    write_test_file,
+)
+from tests.test_workers import _TIMING_STATS
+
+_CACHE_STATS = {"listing_cache_hits", "listing_cache_misses", "meta_bytes_read"}
+
+
+# ===============================================================================
+# ListingCacheTest
+# ===============================================================================
+class ListingCacheTest(_SyncTestBase):
+    """Test `--trust-cache` and `--refresh-cache` (requires an FTP server)."""
+
+    use_ftp_target = True
+
+    def setUp(self):
+        super().setUp()
+        self._cache_dir = RemoteListingCache.CACHE_DIR
+        self._racy_secs = RemoteListingCache.RACY_SECS
+        RemoteListingCache.CACHE_DIR = os.path.join(PYFTPSYNC_TEST_FOLDER, "cache")
+        # The fixture was just created, so all directories would be 'racy'
+        RemoteListingCache.RACY_SECS = float("-inf")
+
+    def tearDown(self):
+        shutil.rmtree(RemoteListingCache.CACHE_DIR, ignore_errors=True)
+        RemoteListingCache.CACHE_DIR = self._cache_dir
+        RemoteListingCache.RACY_SECS = self._racy_secs
+        super().tearDown()
+
+    def test_unchanged_dirs(self):
+        opts = {"verbose": self.verbose, "resolve": "local", "trust_cache": True}
+        stats = self._sync_test_folders(BiDirSynchronizer, opts)
+        self.assertNotIn("listing_cache_hits", stats)
+        self.assertGreaterEqual(stats["listing_cache_misses"], 8)
+        self.assertEqual(len(os.listdir(RemoteListingCache.CACHE_DIR)), 1)
+
+        stats_1 = self._sync_test_folders(BiDirSynchronizer, opts)
+        self.assertGreaterEqual(stats_1["listing_cache_hits"], 7)
+        # The root folder is always listed
+        self.assertEqual(stats_1["listing_cache_misses"], 1)
+
+        stats_2 = self._sync_test_folders(
+            BiDirSynchronizer, dict(opts, trust_cache=False)
+        )
+        self.assertNotIn("listing_cache_misses", stats_2)
+        for name in _TIMING_STATS | _CACHE_STATS:
+            stats_1.pop(name, None)
+            stats_2.pop(name, None)
+        self.assertDictEqual(stats_1, stats_2)
+
+    def test_own_writes_invalidate(self):
+        opts = {"verbose": self.verbose, "resolve": "local", "trust_cache": True}
+        self._sync_test_folders(BiDirSynchronizer, opts)
+
+        write_test_file(
+            "local/folder2/file2_1.txt",
+            dt="2014-01-01 13:00:00",
+            content="local 13:00 (new size)",
+        )
+        stats = self._sync_test_folders(BiDirSynchronizer, opts)
+        self.assertEqual(stats["files_written"], 1)
+        self.assertEqual(
+            read_test_file("remote/folder2/file2_1.txt"), "local 13:00 (new size)"
+        )
+
+        # folder2 is listed again, so the new metadata is used
+        stats = self._sync_test_folders(BiDirSynchronizer, opts)
+        self.assertEqual(stats["files_written"], 0)
+        self.assertEqual(stats["listing_cache_misses"], 2)
+
+    def test_refresh_cache(self):
+        opts = {"verbose": self.verbose, "resolve": "remote", "trust_cache": True}
+        self._sync_test_folders(DownloadSynchronizer, opts)
+
+        # Modified in place, so the directory's modify fact is unchanged
+        write_test_file("remote/folder2/file2_1.txt", content="remote (new size)")
+
+        stats = self._sync_test_folders(DownloadSynchronizer, opts)
+        self.assertEqual(stats["files_written"], 0)
+
+        stats = self._sync_test_folders(
+            DownloadSynchronizer, dict(opts, refresh_cache=True)
+        )
+        self.assertNotIn("listing_cache_hits", stats)
+        self.assertEqual(stats["files_written"], 1)
+        self.assertEqual(
+            read_test_file("local/folder2/file2_1.txt"), "remote (new size)"
+        )
+
+
+# ===============================================================================
+# Main
+# ===============================================================================
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for pyftpsync
+"""
+# Allow long lines for readabilty
+# flake8: noqa: E501
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from ftpsync.ftp_target import FTPTarget
+from ftpsync.metadata import DirMetadata, Manifest
+from ftpsync.synchronizers import BiDirSynchronizer, UploadSynchronizer
+from ftpsync.targets import FsTarget
+from tests.fixture_tools import (
+    _SyncTestBase,
+    get_test_folder,
+    is_test_file,
+    read_test_file,
+    write_test_file,
+)
+
+
+def _read_manifest():
+    return json.loads(read_test_file("remote/" + Manifest.FILE_NAME))
+
+
+# ===============================================================================
+# ManifestTest
+# ===============================================================================
+class ManifestTest(_SyncTestBase):
+    """Test `--manifest` (requires an FTP server)."""
+
+    use_ftp_target = True
+
+    def test_bidir(self):
+        opts = {"verbose": self.verbose, "resolve": "local"}
+        self.do_run_suite(BiDirSynchronizer, opts)
+        local_1 = get_test_folder("local")
+        remote_1 = get_test_folder("remote")
+
+        self._prepare_initial_synced_fixture()
+        opts["manifest"] = True
+        self.do_run_suite(BiDirSynchronizer, opts)
+        self.assert_test_folder_equal(get_test_folder("local"), local_1)
+        self.assert_test_folder_equal(get_test_folder("remote"), remote_1)
+
+        manifest = _read_manifest()
+        self.assertEqual(manifest["_file_version"], Manifest.VERSION)
+        self.assertIn("file2_1.txt", manifest["dirs"]["folder2"]["mtimes"])
+
+        # The per-directory files were migrated to the manifest
+        self.assertFalse(is_test_file("remote/folder2/" + DirMetadata.META_FILE_NAME))
+        stats = self._sync_test_folders(BiDirSynchronizer, opts)
+        self.assertEqual(stats["files_written"], 0)
+        self.assertEqual(stats["conflict_files"], 0)
+
+    def test_migrate_meta_files(self):
+        """Directories that are not in the manifest use .pyftpsync-meta.json."""
+        self.assertTrue(is_test_file("remote/folder2/" + DirMetadata.META_FILE_NAME))
+        opts = {"verbose": self.verbose, "resolve": "local", "manifest": True}
+        stats = self._sync_test_folders(BiDirSynchronizer, opts)
+        self.assertEqual(stats["files_written"], 0)
+        self.assertEqual(stats["conflict_files"], 0)
+
+        # The files were moved to the manifest
+        manifest = _read_manifest()
+        self.assertIn("file2_1.txt", manifest["dirs"]["folder2"]["mtimes"])
+        self.assertFalse(is_test_file("remote/folder2/" + DirMetadata.META_FILE_NAME))
+
+        stats = self._sync_test_folders(BiDirSynchronizer, opts)
+        self.assertEqual(stats["files_written"], 0)
+        self.assertEqual(stats["conflict_files"], 0)
+
+    def test_flush_interval(self):
+        """The manifest is also written during a run."""
+        write_test_file(
+            "local/folder2/file2_1.txt",
+            dt="2014-01-01 13:00:00",
+            content="local 13:00 (new size)",
+        )
+        opts = {"verbose": self.verbose, "resolve": "local", "manifest": True}
+        # Simulate an interrupted run (the manifest is not written on close)
+        with patch.object(Manifest, "FLUSH_INTERVAL", 0), patch.object(
+            FTPTarget, "_close_manifest"
+        ):
+            stats = self._sync_test_folders(UploadSynchronizer, opts)
+        self.assertEqual(stats["files_written"], 1)
+
+        manifest = _read_manifest()
+        self.assertEqual(
+            manifest["dirs"]["folder2"]["mtimes"]["file2_1.txt"]["s"],
+            len("local 13:00 (new size)"),
+        )
+
+    def test_write_error(self):
+        """Modified directories are written to .pyftpsync-meta.json on errors."""
+        write_test_file(
+            "local/folder2/file2_1.txt",
+            dt="2014-01-01 13:00:00",
+            content="local 13:00 (new size)",
+        )
+        opts = {"verbose": self.verbose, "resolve": "local", "manifest": True}
+        with patch.object(FTPTarget, "rename", side_effect=OSError("denied")):
+            stats = self._sync_test_folders(UploadSynchronizer, opts)
+        self.assertEqual(stats["files_written"], 1)
+        self.assertFalse(is_test_file("remote/" + Manifest.FILE_NAME))
+
+        meta = json.loads(
+            read_test_file("remote/folder2/" + DirMetadata.META_FILE_NAME)
+        )
+        self.assertEqual(
+            meta["mtimes"]["file2_1.txt"]["s"], len("local 13:00 (new size)")
+        )
+
+        stats = self._sync_test_folders(UploadSynchronizer, opts)
+        self.assertEqual(stats["files_written"], 0)
+
+
+# ===============================================================================
+# ManifestCopyTest
+# ===============================================================================
+class ManifestCopyTest(unittest.TestCase):
+    """The manifest does not share dicts with DirMetadata instances."""
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        os.mkdir(os.path.join(self.folder.name, "a"))
+        self.target = FsTarget(self.folder.name)
+        self.target.open()
+        self.manifest = Manifest(self.target)
+        self.path = os.path.join(self.target.root_dir, "a")
+
+    def tearDown(self):
+        self.target.close()
+        self.folder.cleanup()
+
+    def test_copies(self):
+        mtimes = {"f1": {"m": 1, "s": 2}}
+        self.manifest.put(self.path, mtimes, {})
+        mtimes["f2"] = {"m": 3, "s": 4}
+        dir_data = self.manifest.get(self.path)
+        self.assertEqual(list(dir_data["mtimes"]), ["f1"])
+        dir_data["mtimes"].clear()
+        self.assertEqual(list(self.manifest.get(self.path)["mtimes"]), ["f1"])
+
+    def test_dumps_error(self):
+        """Serialization errors fall back to per-directory files."""
+        self.manifest.put(self.path, {"f1": {"m": 1, "s": 2}}, {})
+        with patch.object(DirMetadata, "_dumps", side_effect=[RuntimeError, "{}"]):
+            self.manifest.flush()
+        self.assertFalse(
+            os.path.exists(os.path.join(self.folder.name, Manifest.FILE_NAME))
+        )
+        self.assertTrue(
+            os.path.exists(os.path.join(self.path, DirMetadata.META_FILE_NAME))
+        )
+        self.assertEqual(self.target.cur_dir, self.target.root_dir)
+
+
+# ===============================================================================
+# Main
+# ===============================================================================
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for pyftpsync
+"""
+# Allow long lines for readabilty
+# flake8: noqa: E501
+import json
+import os
+import unittest
+
+from ftpsync.metadata import DirMetadata
+from ftpsync.synchronizers import BiDirSynchronizer
+from tests.fixture_tools import (
+    PYFTPSYNC_TEST_FOLDER,
+    _SyncTestBase,
+    get_test_folder,
+    is_test_file,
+    read_test_file,
+    write_test_file,
+)
+
+META_PATH = "local/folder1/" + DirMetadata.META_FILE_NAME
+JOURNAL_PATH = "local/folder1/" + DirMetadata.JOURNAL_FILE_NAME
+
+
+# ===============================================================================
+# MetaJournalTest
+# ===============================================================================
+class MetaJournalTest(_SyncTestBase):
+    """Test `--meta-journal`."""
+
+    def setUp(self):
+        super().setUp()
+        self._compact_size = DirMetadata.JOURNAL_COMPACT_SIZE
+
+    def tearDown(self):
+        DirMetadata.JOURNAL_COMPACT_SIZE = self._compact_size
+        super().tearDown()
+
+    def _modify(self, i):
+        write_test_file(
+            "local/folder1/file1_1.txt",
+            dt=f"2014-01-01 13:{i:02}:00",
+            content=f"local {i}",
+        )
+
+    def test_append(self):
+        opts = {"verbose": self.verbose, "resolve": "local", "meta_journal": True}
+        meta = read_test_file(META_PATH)
+
+        self._modify(1)
+        stats = self._sync_test_folders(BiDirSynchronizer, opts)
+        self.assertEqual(stats["files_written"], 1)
+        self.assertEqual(read_test_file("remote/folder1/file1_1.txt"), "local 1")
+        # The metadata file was not rewritten
+        self.assertEqual(read_test_file(META_PATH), meta)
+        journal = read_test_file(JOURNAL_PATH).splitlines()
+        self.assertEqual(len(journal), 1)
+        op, _peer_id, name, info = json.loads(journal[0])
+        self.assertEqual((op, name, info["s"]), ("p", "file1_1.txt", 7))
+
+        self._modify(2)
+        stats = self._sync_test_folders(BiDirSynchronizer, opts)
+        self.assertEqual(stats["files_written"], 1)
+        self.assertEqual(len(read_test_file(JOURNAL_PATH).splitlines()), 2)
+
+        # The journal is also read without `--meta-journal`
+        local_1 = get_test_folder("local")
+        stats = self._sync_test_folders(
+            BiDirSynchronizer, dict(opts, meta_journal=False)
+        )
+        self.assertEqual(stats["files_written"], 0)
+        self.assertEqual(stats["conflict_files"], 0)
+        self.assert_test_folder_equal(get_test_folder("local"), local_1)
+
+    def test_compaction(self):
+        opts = {"verbose": self.verbose, "resolve": "local", "meta_journal": True}
+        DirMetadata.JOURNAL_COMPACT_SIZE = 0
+        meta = read_test_file(META_PATH)
+        for i in range(20):
+            self._modify(i)
+            stats = self._sync_test_folders(BiDirSynchronizer, opts)
+            self.assertEqual(stats["files_written"], 1)
+            if not is_test_file(JOURNAL_PATH):
+                break
+        # The journal grew larger than the metadata file and was merged
+        self.assertFalse(is_test_file(JOURNAL_PATH))
+        self.assertNotEqual(read_test_file(META_PATH), meta)
+
+        stats = self._sync_test_folders(BiDirSynchronizer, opts)
+        self.assertEqual(stats["files_written"], 0)
+        self.assertEqual(stats["conflict_files"], 0)
+
+    def test_invalid_record(self):
+        opts = {"verbose": self.verbose, "resolve": "local", "meta_journal": True}
+        self._modify(1)
+        self._sync_test_folders(BiDirSynchronizer, opts)
+
+        # An interrupted append
+        path = os.path.join(PYFTPSYNC_TEST_FOLDER, JOURNAL_PATH)
+        with open(path, "ab") as fp:
+            fp.write(b'["m", "file1_1.t')
+
+        stats = self._sync_test_folders(BiDirSynchronizer, opts)
+        self.assertEqual(stats["files_written"], 0)
+        self.assertEqual(stats["conflict_files"], 0)
+        # The valid records were merged into the metadata file
+        self.assertFalse(is_test_file(JOURNAL_PATH))
+
+        stats = self._sync_test_folders(BiDirSynchronizer, opts)
+        self.assertEqual(stats["files_written"], 0)
+        self.assertEqual(stats["conflict_files"], 0)
+
+
+class FtpMetaJournalTest(MetaJournalTest):
+    """Run the MetaJournalTest tests against an FTP server."""
+
+    use_ftp_target = True
+
+
+# ===============================================================================
+# Main
+# ===============================================================================
+if __name__ == "__main__":
+    unittest.main()
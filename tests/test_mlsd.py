@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for pyftpsync
+"""
+# Allow long lines for readabilty
+# flake8: noqa: E501
+import calendar
+import contextlib
+import os
+import time
+import timeit
+import unittest
+from unittest.mock import patch
+
+from ftpsync import mlsd
+from ftpsync.ftp_target import iter_decoded_lines
+from ftpsync.targets import make_target
+from tests.fixture_tools import PYFTPSYNC_TEST_FOLDER, _SyncTestBase, write_test_file
+from tests.ftp_server import FTPServerThread
+from tests.test_bench import DO_BENCHMARKS
+
+
+def _legacy_parse_line(line):
+    """The MLSD parser of FTPTarget.get_dir() up to v4.0 (reference)."""
+    data, _, name = line.partition("; ")
+    res_type = size = mtime = unique = None
+    for field in data.split(";"):
+        field_name, _, field_value = field.partition("=")
+        field_name = field_name.lower()
+        if field_name == "type":
+            res_type = field_value
+        elif field_name in ("sizd", "size"):
+            size = int(field_value)
+        elif field_name == "modify":
+            if "." in field_value:
+                mtime = calendar.timegm(time.strptime(field_value, "%Y%m%d%H%M%S.%f"))
+            else:
+                mtime = calendar.timegm(time.strptime(field_value, "%Y%m%d%H%M%S"))
+        elif field_name == "unique":
+            unique = field_value
+    return name, res_type, size, mtime, unique
+
+
+def _legacy_split_lines(chunks, encoding):
+    """The line splitter of FTPTarget._ftp_retrlines_native() up to v4.0."""
+    lines = []
+    buffer = b""
+    for chunk in chunks:
+        chunk = chunk.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+        chunk = buffer + chunk
+        try:
+            while True:
+                item, chunk = chunk.split(b"\n", 1)
+                try:
+                    lines.append(item.decode(encoding))
+                except UnicodeDecodeError:
+                    lines.append(item.decode("cp1252"))
+        except ValueError:
+            pass
+        buffer = chunk
+    return lines
+
+
+def _make_chunks(lines, size):
+    data = "".join(s + "\r\n" for s in lines).encode("utf-8")
+    return [data[i : i + size] for i in range(0, len(data), size)]
+
+
+def _make_listing(count):
+    lines = ["type=cdir;modify=20240101120000;unique=801g1; .", "type=pdir; .."]
+    for i in range(count):
+        lines.append(
+            "type=file;size={};modify=2024{:02}{:02}{:02}{:02}{:02}.{:03};"
+            "UNIX.mode=0644;unique=801g{:x}; file_{}.txt".format(
+                i * 7, i % 12 + 1, i % 28 + 1, i % 24, i % 60, i % 59, i % 1000, i, i
+            )
+        )
+    return lines
+
+
+# ===============================================================================
+# MlsdParserTest
+# ===============================================================================
+class MlsdParserTest(unittest.TestCase):
+    """Test the MLSD parser (ftpsync.mlsd)."""
+
+    def test_parse_line(self):
+        self.assertEqual(
+            mlsd.parse_line(
+                "Type=file;Size=1234;Modify=20240229235960.123;Unique=801g3c; a; b.txt"
+            ),
+            ("a; b.txt", "file", 1234, 1709251200, "801g3c"),
+        )
+        self.assertEqual(
+            mlsd.parse_line("type=dir;sizd=4096;modify=19700101000001; sub dir"),
+            ("sub dir", "dir", 4096, 1, None),
+        )
+        self.assertEqual(mlsd.parse_line("perm=el; x"), ("x", None, None, None, None))
+
+    def test_legacy_compatible(self):
+        lines = _make_listing(2000)
+        expected = [_legacy_parse_line(s) for s in lines]
+        self.assertListEqual(list(mlsd.parse_lines(lines)), expected)
+        text = "\r\n".join(lines) + "\r\n"
+        self.assertListEqual(mlsd.parse_listing(text), expected)
+
+    def test_invalid_time(self):
+        for value in (
+            "2024010112000",
+            "20241301120000",
+            "20240230120000",
+            "20240101240000",
+            "2024010112x000",
+            "x",
+        ):
+            with self.assertRaises(ValueError, msg=value):
+                mlsd.parse_time(value)
+        # Cached day, invalid time
+        mlsd.parse_time("20240101120000")
+        with self.assertRaises(ValueError):
+            mlsd.parse_time("20240101126000")
+        with self.assertRaises(ValueError):
+            mlsd.parse_line("type=file;size=12k; x")
+
+
+# ===============================================================================
+# DecodedLinesTest
+# ===============================================================================
+class DecodedLinesTest(unittest.TestCase):
+    """Test ftp_target.iter_decoded_lines()."""
+
+    def test_chunk_boundaries(self):
+        data = "type=file; ä\r\nb\r\n\rc\nd".encode() + b"\r\n\r\nx\xe4y\r\nz"
+        expected = ["type=file; ä", "b", "c", "d", "xäy", "z"]
+        for size in range(1, len(data) + 1):
+            chunks = [data[i : i + size] for i in range(0, len(data), size)]
+            fallbacks = []
+            lines = iter_decoded_lines(
+                chunks, "utf-8", lambda *args: fallbacks.append(args)
+            )
+            self.assertListEqual(list(lines), expected, size)
+            self.assertListEqual(fallbacks, [(1, "xäy")])
+
+    def test_no_fallback(self):
+        fallbacks = []
+        lines = iter_decoded_lines(
+            [b"a\n\xe4\n"], "ascii", lambda *args: fallbacks.append(args)
+        )
+        self.assertListEqual(list(lines), ["a", "\ufffd"])
+        self.assertListEqual(fallbacks, [(2, "\ufffd")])
+
+    def test_legacy_compatible(self):
+        lines = _make_listing(2000) + ["type=file; Gr\xfc\xdfe"]
+        for size in (10, 8192):
+            chunks = _make_chunks(lines, size)
+            # The legacy splitter returned an empty line for CR/LF pairs that
+            # were split between two chunks
+            expected = [s for s in _legacy_split_lines(chunks, "utf-8") if s]
+            self.assertListEqual(list(iter_decoded_lines(chunks, "utf-8")), expected)
+
+
+# ===============================================================================
+# MlsdBenchmarkTest
+# ===============================================================================
+class MlsdBenchmarkTest(unittest.TestCase):
+    """Compare the MLSD parser with the legacy implementation."""
+
+    def setUp(self):
+        if not DO_BENCHMARKS:
+            self.skipTest("DO_BENCHMARKS is not set.")
+
+    def test_parse_100k_lines(self):
+        lines = _make_listing(100_000)
+        legacy = min(
+            timeit.repeat(lambda: [_legacy_parse_line(s) for s in lines], number=1)
+        )
+        fast = min(timeit.repeat(lambda: list(mlsd.parse_lines(lines)), number=1))
+        self.assertLess(
+            fast,
+            legacy,
+            f"Parse {len(lines):,} MLSD lines: legacy {legacy:.3f} sec, "
+            f"mlsd {fast:.3f} sec",
+        )
+
+    def test_split_1m_lines(self):
+        chunks = _make_chunks(_make_listing(1_000_000), 64 * 1024)
+        legacy = min(
+            timeit.repeat(lambda: _legacy_split_lines(chunks, "utf-8"), number=1)
+        )
+        fast = min(
+            timeit.repeat(lambda: list(iter_decoded_lines(chunks, "utf-8")), number=1)
+        )
+        self.assertLess(
+            fast,
+            legacy,
+            f"Split {sum(map(len, chunks)):,} bytes: legacy {legacy:.3f} sec, "
+            f"iter_decoded_lines {fast:.3f} sec",
+        )
+
+
+# ===============================================================================
+# FtpListingAbortTest
+# ===============================================================================
+class FtpListingAbortTest(_SyncTestBase):
+    """The control connection stays usable if a listing consumer raises."""
+
+    def setUp(self):
+        super().setUp()
+        for i in range(2000):
+            write_test_file(f"remote/many/file_{i}.txt", content="x")
+        self.server = FTPServerThread()
+        self.url = self.server.add_server(os.path.join(PYFTPSYNC_TEST_FOLDER, "remote"))
+        self.server.start()
+        self.remote = make_target(self.url)
+        self.remote.open()
+        self.remote.cwd("many")
+
+    def tearDown(self):
+        self.remote.close()
+        self.server.stop()
+        super().tearDown()
+
+    def _assert_usable(self):
+        self.assertTrue(self.remote.ftp.pwd().endswith("/many"))
+        entries = self.remote.get_dir()
+        self.assertEqual(len(entries), 2000)
+
+    def test_consumer_raises(self):
+        lines = self.remote._ftp_iter_lines_native("MLSD", "utf-8")
+        with self.assertRaises(ValueError):
+            with contextlib.closing(lines):
+                for _line in lines:
+                    raise ValueError("parser failed")
+        self._assert_usable()
+
+    def test_parser_raises(self):
+        def _parse_lines(lines):
+            yield from mlsd.parse_lines([next(iter(lines))])
+            raise ValueError("parser failed")
+
+        with patch("ftpsync.ftp_target.parse_mlsd_lines", _parse_lines):
+            with self.assertRaises(ValueError):
+                self.remote.get_dir()
+        self._assert_usable()
+
+
+# ===============================================================================
+# Main
+# ===============================================================================
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for pyftpsync
+"""
+# Allow long lines for readabilty
+# flake8: noqa: E501
+import json
+import os
+import shutil
+import unittest
+
+from ftpsync.synchronizers import (
+    BiDirSynchronizer,
+    DownloadSynchronizer,
+    UploadSynchronizer,
+)
+from tests.fixture_tools import (
+    PYFTPSYNC_TEST_FOLDER,
+    _SyncTestBase,
+    get_test_folder,
+    read_test_file,
+    write_test_file,
+)
+
+
+def _read_plan(path):
+    with open(path, encoding="utf-8") as fp:
+        return [json.loads(line) for line in fp]
+
+
+# ===============================================================================
+# SyncPlanTest
+# ===============================================================================
+class SyncPlanTest(_SyncTestBase):
+    """Test `--write-plan` and `--execute-plan`."""
+
+    def setUp(self):
+        super().setUp()
+        self.plan_path = os.path.join(PYFTPSYNC_TEST_FOLDER, "plan.jsonl")
+
+    def tearDown(self):
+        if os.path.exists(self.plan_path):
+            os.remove(self.plan_path)
+        super().tearDown()
+
+    def _write_plan(self, synchronizer_class, opts):
+        """Write a plan for the modified fixture and check that nothing changed."""
+        self._prepare_modified_fixture()
+        local = get_test_folder("local")
+        remote = get_test_folder("remote")
+
+        stats = self._sync_test_folders(
+            synchronizer_class, dict(opts, write_plan=self.plan_path)
+        )
+        self.assert_test_folder_equal(get_test_folder("local"), local)
+        self.assert_test_folder_equal(get_test_folder("remote"), remote)
+        self.assertEqual(stats["files_written"], 0)
+        return stats
+
+    def _run_direct_and_planned(self, synchronizer_class, opts):
+        self.do_run_suite(synchronizer_class, opts)
+        local_1 = get_test_folder("local")
+        remote_1 = get_test_folder("remote")
+
+        self._prepare_initial_synced_fixture()
+        self._write_plan(synchronizer_class, opts)
+        self._sync_test_folders(
+            synchronizer_class, dict(opts, execute_plan=self.plan_path)
+        )
+
+        self.assert_test_folder_equal(get_test_folder("local"), local_1)
+        self.assert_test_folder_equal(get_test_folder("remote"), remote_1)
+
+    def test_bidir(self):
+        opts = {"verbose": self.verbose, "resolve": "local"}
+        self._run_direct_and_planned(BiDirSynchronizer, opts)
+
+    def test_upload_delete(self):
+        opts = {"verbose": self.verbose, "resolve": "local", "delete": True}
+        self._run_direct_and_planned(UploadSynchronizer, opts)
+
+    def test_download_delete(self):
+        opts = {"verbose": self.verbose, "resolve": "remote", "delete": True}
+        self._run_direct_and_planned(DownloadSynchronizer, opts)
+
+    def test_plan_format(self):
+        stats = self._write_plan(BiDirSynchronizer, {"resolve": "local"})
+        records = _read_plan(self.plan_path)
+
+        header, summary = records[0], records[-1]
+        self.assertEqual(header["type"], "header")
+        self.assertEqual(header["synchronizer"], "BiDirSynchronizer")
+        self.assertEqual(summary["type"], "summary")
+
+        ops = records[1:-1]
+        self.assertEqual(len(ops), sum(summary["ops"].values()))
+        self.assertEqual(stats["plan_conflict"], summary["ops"]["conflict"])
+        by_path = {(r["dir"], r["name"]): r for r in ops}
+        rec = by_path[("folder2", "file2_1.txt")]
+        self.assertEqual(rec["op"], "copy_local")
+        self.assertEqual(rec["bytes"], len("local 13:00"))
+        self.assertEqual(rec["local"][0], len("local 13:00"))
+        # Unmodified files are not part of the plan
+        self.assertNotIn(("folder1", "file1_1.txt"), by_path)
+
+    def test_stale_entries(self):
+        """Entries that were modified after the plan was written are skipped."""
+        self._write_plan(BiDirSynchronizer, {"resolve": "local"})
+        remote_content = read_test_file("remote/folder2/file2_1.txt")
+        write_test_file(
+            "local/folder2/file2_1.txt",
+            dt="2014-01-01 13:30:00",
+            content="local 13:30 (after plan)",
+        )
+
+        stats = self._sync_test_folders(
+            BiDirSynchronizer, {"resolve": "local", "execute_plan": self.plan_path}
+        )
+        self.assertEqual(stats["plan_skipped"], 1)
+        self.assertEqual(read_test_file("remote/folder2/file2_1.txt"), remote_content)
+        # Other operations were performed
+        self.assertEqual(read_test_file("remote/file2.txt"), "local 13:00")
+
+    def test_removed_dir(self):
+        """Directories that were removed after the plan was written are skipped."""
+        self._write_plan(BiDirSynchronizer, {"resolve": "local"})
+        records = _read_plan(self.plan_path)[1:-1]
+        skipped = [r for r in records if (r["dir"] + "/").startswith("folder2/")]
+        self.assertGreater(len(skipped), 0)
+        shutil.rmtree(os.path.join(PYFTPSYNC_TEST_FOLDER, "remote", "folder2"))
+
+        stats = self._sync_test_folders(
+            BiDirSynchronizer, {"resolve": "local", "execute_plan": self.plan_path}
+        )
+        self.assertEqual(stats["plan_skipped"], len(skipped))
+        # Other operations were performed
+        self.assertEqual(read_test_file("remote/file2.txt"), "local 13:00")
+
+    def test_wrong_synchronizer(self):
+        self._write_plan(UploadSynchronizer, {"resolve": "local"})
+        with self.assertRaises(RuntimeError):
+            self._sync_test_folders(
+                DownloadSynchronizer,
+                {"resolve": "remote", "execute_plan": self.plan_path},
+            )
+
+
+class FtpSyncPlanTest(SyncPlanTest):
+    """Run the SyncPlanTest tests against an FTP server."""
+
+    use_ftp_target = True
+
+
+# ===============================================================================
+# Main
+# ===============================================================================
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for pyftpsync
+"""
+# Allow long lines for readabilty
+# flake8: noqa: E501
+import calendar
+import datetime
+import unittest
+
+from ftpsync.resources import FileEntry
+from ftpsync.synchronizers import (
+    RESUME_MIN_SIZE,
+    BiDirSynchronizer,
+    DownloadSynchronizer,
+    UploadSynchronizer,
+    make_part_name,
+    parse_part_name,
+)
+from tests.fixture_tools import (
+    _SyncTestBase,
+    is_test_file,
+    read_test_file,
+    write_test_file,
+)
+
+DT = "2014-01-01 13:00:00"
+#: Content of the large test file
+CONTENT = "".join(f"{i:07}\n" for i in range(RESUME_MIN_SIZE // 8 + 1000))
+#: Size of the interrupted transfer
+PART_SIZE = 300000
+
+
+def _make_entry(name, mtime=None):
+    if mtime is None:
+        mtime = calendar.timegm(
+            datetime.datetime.strptime(DT, "%Y-%m-%d %H:%M:%S").timetuple()
+        )
+    return FileEntry(None, "", name, len(CONTENT), mtime, None)
+
+
+# ===============================================================================
+# ResumeTest
+# ===============================================================================
+class ResumeTest(_SyncTestBase):
+    """Test resumable transfers (`--resume`)."""
+
+    def setUp(self):
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+
+    def test_part_names(self):
+        part_name = make_part_name(_make_entry("big.bin", 1388581200.5))
+        self.assertEqual(part_name, f"big.bin.{len(CONTENT)}-1388581200.pyftpsync-part")
+        self.assertEqual(parse_part_name(part_name), "big.bin")
+        self.assertIsNone(parse_part_name("big.bin"))
+
+    def test_resume_upload(self):
+        write_test_file("local/big.bin", dt=DT, content=CONTENT)
+        part_name = make_part_name(_make_entry("big.bin"))
+        write_test_file("remote/" + part_name, content=CONTENT[:PART_SIZE])
+
+        stats = self._sync_test_folders(
+            UploadSynchronizer, {"resolve": "local", "resume": True}
+        )
+        self.assertEqual(stats["resumed_files"], 1)
+        self.assertEqual(stats["resumed_bytes"], PART_SIZE)
+        self.assertEqual(stats["upload_bytes_written"], len(CONTENT) - PART_SIZE)
+        self.assertEqual(read_test_file("remote/big.bin"), CONTENT)
+        self.assertFalse(is_test_file("remote/" + part_name))
+
+    def test_resume_download(self):
+        write_test_file("remote/big.bin", dt=DT, content=CONTENT)
+        # FTP servers may report a different mtime
+        remote = self._make_remote_target()
+        remote.open()
+        try:
+            entry = next(e for e in remote.get_dir() if e.name == "big.bin")
+        finally:
+            remote.close()
+        part_name = make_part_name(entry)
+        write_test_file("local/" + part_name, content=CONTENT[:PART_SIZE])
+
+        stats = self._sync_test_folders(
+            DownloadSynchronizer, {"resolve": "remote", "resume": True}
+        )
+        self.assertEqual(stats["resumed_bytes"], PART_SIZE)
+        self.assertEqual(stats["download_bytes_written"], len(CONTENT) - PART_SIZE)
+        self.assertEqual(read_test_file("local/big.bin"), CONTENT)
+        self.assertFalse(is_test_file("local/" + part_name))
+
+    def test_outdated_part(self):
+        """A part file of another version of the source is not resumed."""
+        write_test_file("local/big.bin", dt=DT, content=CONTENT)
+        part_name = make_part_name(_make_entry("big.bin", 1234))
+        write_test_file("remote/" + part_name, content="x" * PART_SIZE)
+
+        stats = self._sync_test_folders(
+            UploadSynchronizer, {"resolve": "local", "resume": True}
+        )
+        self.assertNotIn("resumed_files", stats)
+        self.assertEqual(read_test_file("remote/big.bin"), CONTENT)
+        self.assertFalse(is_test_file("remote/" + part_name))
+
+    def test_part_files_ignored(self):
+        part_name = make_part_name(_make_entry("big.bin"))
+        write_test_file("local/" + part_name, content=CONTENT[:PART_SIZE])
+
+        self._sync_test_folders(BiDirSynchronizer, {"resolve": "local"})
+        self.assertFalse(is_test_file("remote/" + part_name))
+
+
+class FtpResumeTest(ResumeTest):
+    """Run the ResumeTest tests against an FTP server."""
+
+    use_ftp_target = True
+
+
+# ===============================================================================
+# Main
+# ===============================================================================
+if __name__ == "__main__":
+    unittest.main()
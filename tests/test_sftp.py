@@ -2,10 +2,21 @@
 """
 Tests for pyftpsync
 """
+import io
+import os
 import unittest
+from unittest.mock import patch
 
 from ftpsync.sftp_target import SFTPTarget
+from ftpsync.synchronizers import DownloadSynchronizer, UploadSynchronizer
 from ftpsync.targets import make_target
+from tests.fixture_tools import (
+    PYFTPSYNC_TEST_FOLDER,
+    _SyncTestBase,
+    read_test_file,
+    write_test_file,
+)
+from tests.sftp_server import SftpTargetMixin
 
 
 # ===============================================================================
@@ -53,6 +64,97 @@ class SFTPTest(unittest.TestCase):
         self.assertEqual(t.root_dir, "/target/folder")
 
 
+# ===============================================================================
+# SftpTransferTest
+# ===============================================================================
+class SftpTransferTest(SftpTargetMixin, _SyncTestBase):
+    """Test pipelined SFTP transfers (using tests.sftp_server)."""
+
+    # Many small requests per file
+    sftp_target_opts = {"sftp_block_size": 1000, "sftp_window_size": 64 * 1024}
+
+    def setUp(self):
+        super().setUp()
+        self.data = bytes(range(256)) * 1000
+
+    def test_write_and_read(self):
+        remote = self._make_remote_target()
+        remote.open()
+        try:
+            written = []
+            remote.write_file("big.bin", io.BytesIO(self.data), callback=written.append)
+            self.assertEqual(sum(map(len, written)), len(self.data))
+            self.assertTrue(all(len(buf) <= 1000 for buf in written))
+
+            with remote.open_readable("big.bin") as fp:
+                self.assertEqual(fp.read(), self.data)
+
+            # Resumed transfers
+            fp_src = io.BytesIO(self.data[::-1])
+            fp_src.seek(100_000)
+            remote.write_file("big.bin", fp_src, offset=100_000)
+            expected = self.data[:100_000] + self.data[::-1][100_000:]
+            out = io.BytesIO()
+            remote.copy_to_file("big.bin", out)
+            self.assertEqual(out.getvalue(), expected)
+            out = io.BytesIO()
+            remote.copy_to_file("big.bin", out, offset=200_000)
+            self.assertEqual(out.getvalue(), expected[200_000:])
+        finally:
+            remote.close()
+
+    def test_sync(self):
+        write_test_file("local/big.txt", size=300_000)
+        opts = {"verbose": self.verbose, "resolve": "local"}
+        stats = self._sync_test_folders(UploadSynchronizer, opts)
+        self.assertEqual(stats["upload_files_written"], 1)
+        self.assertEqual(stats["upload_bytes_written"], 300_000)
+        self.assertLessEqual(stats["min_file_rate"], stats["max_file_rate"])
+        self.assertIn("max_file_rate_str", stats)
+        self.assertEqual(read_test_file("remote/big.txt"), "*" * 300_000)
+
+    def test_download_streamed(self):
+        write_test_file("remote/big.txt", size=300_000)
+        opts = {"verbose": self.verbose, "resolve": "remote"}
+        opened = []
+        open_readable = SFTPTarget.open_readable
+
+        def _open_readable(target, name):
+            opened.append(name)
+            return open_readable(target, name)
+
+        with patch.object(SFTPTarget, "open_readable", _open_readable):
+            stats = self._sync_test_folders(DownloadSynchronizer, opts)
+        self.assertEqual(stats["download_files_written"], 1)
+        self.assertEqual(stats["download_bytes_written"], 300_000)
+        self.assertEqual(read_test_file("local/big.txt"), "*" * 300_000)
+        # Written to the local file while it was received, not spooled first
+        self.assertNotIn("big.txt", opened)
+
+    def test_remote_to_remote(self):
+        write_test_file("local/big.txt", size=300_000)
+        url = self.server.url(os.path.join(PYFTPSYNC_TEST_FOLDER, "local"))
+        local = make_target(url, {"no_verify_host_keys": True})
+        opts = {"verbose": self.verbose, "resolve": "local"}
+        opened = []
+        open_readable = SFTPTarget.open_readable
+
+        def _open_readable(target, name):
+            opened.append(name)
+            return open_readable(target, name)
+
+        with patch.object(SFTPTarget, "open_readable", _open_readable):
+            s = UploadSynchronizer(local, self._make_remote_target(), opts)
+            s.run()
+            s.close()
+        stats = s.get_stats()
+        self.assertEqual(stats["upload_files_written"], 1)
+        self.assertEqual(stats["upload_bytes_written"], 300_000)
+        self.assertEqual(read_test_file("remote/big.txt"), "*" * 300_000)
+        # Streamed through a pipe, not spooled first
+        self.assertNotIn("big.txt", opened)
+
+
 # class SFTPServerTest(unittest.TestCase):
 #     """Tests that use `pytest.sftpserver` fixture."""
 #     def test_sftp_fetch(self, sftpserver):
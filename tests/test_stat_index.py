@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for pyftpsync
+"""
+# Allow long lines for readabilty
+# flake8: noqa: E501
+import os
+import unittest
+
+from ftpsync.stat_index import StatIndex
+from ftpsync.synchronizers import BiDirSynchronizer
+from ftpsync.targets import FsTarget
+from tests.fixture_tools import (
+    PYFTPSYNC_TEST_FOLDER,
+    _SyncTestBase,
+    read_test_file,
+    remove_test_file,
+    write_test_file,
+)
+from tests.test_workers import _TIMING_STATS
+
+_INDEX_STATS = {"stat_index_hits", "stat_index_misses"}
+
+
+# ===============================================================================
+# StatIndexTest
+# ===============================================================================
+class StatIndexTest(_SyncTestBase):
+    """Test `--stat-index`."""
+
+    def setUp(self):
+        super().setUp()
+        # The fixture was just created, so all directories would be 'racy'
+        self._racy_ns = StatIndex.RACY_NS
+        StatIndex.RACY_NS = 0
+
+    def tearDown(self):
+        StatIndex.RACY_NS = self._racy_ns
+        super().tearDown()
+
+    def test_unchanged_dirs(self):
+        opts = {"verbose": self.verbose, "resolve": "local", "stat_index": True}
+        stats = self._sync_test_folders(BiDirSynchronizer, opts)
+        self.assertEqual(stats.get("stat_index_hits", 0), 0)
+        self.assertGreaterEqual(stats["stat_index_misses"], 8)
+        self.assertTrue(
+            os.path.isfile(
+                os.path.join(PYFTPSYNC_TEST_FOLDER, "local", StatIndex.FILE_NAME)
+            )
+        )
+
+        stats_1 = self._sync_test_folders(BiDirSynchronizer, opts)
+        self.assertGreaterEqual(stats_1["stat_index_hits"], 8)
+        self.assertNotIn("stat_index_misses", stats_1)
+
+        stats_2 = self._sync_test_folders(
+            BiDirSynchronizer, dict(opts, stat_index=False)
+        )
+        for name in _TIMING_STATS | _INDEX_STATS:
+            stats_1.pop(name, None)
+            stats_2.pop(name, None)
+        self.assertDictEqual(stats_1, stats_2)
+
+    def test_own_writes_invalidate(self):
+        opts = {"verbose": self.verbose, "resolve": "local", "stat_index": True}
+        self._sync_test_folders(BiDirSynchronizer, opts)
+
+        # Replace the remote file (so its directory mtime changes).
+        # The local file is then overwritten in place by the synchronizer.
+        remove_test_file("remote/folder2/file2_1.txt")
+        write_test_file(
+            "remote/folder2/file2_1.txt",
+            dt="2014-01-01 13:00:00",
+            content="remote 13:00 (new size)",
+        )
+        stats = self._sync_test_folders(BiDirSynchronizer, opts)
+        self.assertEqual(stats["files_written"], 1)
+        self.assertEqual(
+            read_test_file("local/folder2/file2_1.txt"), "remote 13:00 (new size)"
+        )
+
+        stats = self._sync_test_folders(BiDirSynchronizer, opts)
+        self.assertEqual(stats["files_written"], 0)
+        self.assertGreaterEqual(stats["stat_index_misses"], 1)
+
+    def test_modified_in_place_is_missed(self):
+        """Documented limitation: in-place modifications are not detected."""
+        opts = {"verbose": self.verbose, "resolve": "local", "stat_index": True}
+        self._sync_test_folders(BiDirSynchronizer, opts)
+
+        # Overwrite a local file in place (the directory mtime is unchanged)
+        write_test_file(
+            "local/folder1/file1_1.txt", dt="2014-01-01 13:00:00", content="local1_X"
+        )
+        stats = self._sync_test_folders(BiDirSynchronizer, opts)
+        self.assertEqual(stats["files_written"], 0)
+        self.assertEqual(read_test_file("remote/folder1/file1_1.txt"), "local1_1")
+
+        # It is detected as soon as the directory is modified
+        write_test_file("local/folder1/new.txt", content="new")
+        stats = self._sync_test_folders(BiDirSynchronizer, opts)
+        self.assertEqual(stats["files_written"], 2)
+        self.assertEqual(read_test_file("remote/folder1/file1_1.txt"), "local1_X")
+
+    def test_listing(self):
+        """Cached and scanned listings are equal."""
+        local = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "local"))
+
+        def _get_dir(opts):
+            local.extra_opts = opts
+            local.open()
+            try:
+                local.cwd("folder1")
+                entries = local.get_dir()
+                return sorted(
+                    (e.name, e.is_dir(), e.size, e.mtime, e.unique) for e in entries
+                ), local.cur_dir_meta.dir
+            finally:
+                local.close()
+
+        expected = _get_dir({})
+        self.assertEqual(_get_dir({"stat_index": True}), expected)
+        self.assertEqual(_get_dir({"stat_index": True}), expected)
+
+
+class FtpStatIndexTest(StatIndexTest):
+    """Run the StatIndexTest tests against an FTP server."""
+
+    use_ftp_target = True
+
+
+# ===============================================================================
+# Main
+# ===============================================================================
+if __name__ == "__main__":
+    unittest.main()
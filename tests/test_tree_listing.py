@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for pyftpsync
+"""
+# Allow long lines for readabilty
+# flake8: noqa: E501
+import os
+import time
+import unittest
+from calendar import timegm
+
+from ftpsync.ftp_target import FTPTarget
+from ftpsync.synchronizers import BiDirSynchronizer
+from ftpsync.targets import make_target
+from ftpsync.tree_listing import TreeSnapshot, estimate_time_offset, parse_ls_line
+from tests.fixture_tools import (
+    PYFTPSYNC_TEST_FOLDER,
+    _SyncTestBase,
+    get_test_folder,
+    is_test_file,
+    read_test_file,
+    remove_test_file,
+    write_test_file,
+)
+from tests.ftp_server import FTPServerThread, LocalTimeListHandler
+from tests.sftp_server import SftpTargetMixin
+from tests.test_workers import _TIMING_STATS
+
+#: 2024-03-01 12:00:00 UTC
+NOW = timegm((2024, 3, 1, 12, 0, 0))
+
+LS_LINES = """\
+total 12
+-rw-r--r--   1 owner    group         809 Feb 29 10:30 .pyftpsync-meta.json
+drwxr-xr-x   2 owner    group        4096 Jan 01  2014 sub dir
+-rw-r--r--   1 owner    group           6 Dec 24 18:00 file1.txt
+
+./sub dir:
+total 8
+drwxr-xr-x   2 owner    group        4096 Mar 01 11:00 .
+drwxr-xr-x   2 owner    group        4096 Mar 01 11:00 ..
+-rw-r--r--   1 owner  123456 Jun  7  2019  two  spaces.txt
+lrwxrwxrwx   1 owner    group           9 Jan 01  2014 link -> file1.txt
+drwxr-xr-x   2 owner    group        4096 Jan 01  2014 empty
+
+/root/sub dir/empty:
+"""
+
+FIND_OUTPUT = (
+    b"f 6 1388577600.1234567890 file1.txt\0"
+    b"d 4096 1388577600.0 sub dir\0"
+    b"f 7 1388577601.9 sub dir/a b.txt\0"
+    b"l 9 1388577600.0 sub dir/link\0"
+    b"d 4096 1388577600.0 sub dir/empty\0"
+    b"f 3 1388577600.0 sub dir/Gr\xfc\xdfe.txt\0"
+)
+
+
+# ===============================================================================
+# TreeSnapshotTest
+# ===============================================================================
+class TreeSnapshotTest(unittest.TestCase):
+    """Test ftpsync.tree_listing."""
+
+    def test_parse_ls_line(self):
+        self.assertEqual(
+            parse_ls_line(
+                "-rw-r--r--   1 owner    group         809 Feb 29 10:30 a: b", NOW
+            ),
+            ("a: b", "file", 809, timegm((2024, 2, 29, 10, 30, 0)), None),
+        )
+        # A date in the future means: last year
+        self.assertEqual(
+            parse_ls_line("-rw-r--r-- 1 owner group 6 Dec 24 18:00 x", NOW)[3],
+            timegm((2023, 12, 24, 18, 0, 0)),
+        )
+        self.assertIsNone(parse_ls_line("total 12", NOW))
+        self.assertIsNone(parse_ls_line("crw-rw-rw- 1 o g 0 Jan 01  2014 null", NOW))
+        self.assertIsNone(parse_ls_line("-rw-r--r-- 1 o g 0 Foo 01  2014 x", NOW))
+
+    def test_from_ls_lines(self):
+        for prefix in ("", "213-", " "):
+            lines = [prefix + line for line in LS_LINES.splitlines()]
+            snapshot = TreeSnapshot.from_ls_lines(lines, "/root/", now=NOW)
+            self.assertDictEqual(
+                snapshot.dirs,
+                {
+                    "/root/sub dir": [
+                        (
+                            " two  spaces.txt",
+                            "file",
+                            123456,
+                            timegm((2019, 6, 7, 0, 0, 0)),
+                            None,
+                        ),
+                        ("empty", "dir", 4096, timegm((2014, 1, 1, 0, 0, 0)), None),
+                    ],
+                    "/root/sub dir/empty": [],
+                },
+            )
+            self.assertEqual(
+                [e[0] for e in snapshot.root_entries],
+                [".pyftpsync-meta.json", "sub dir", "file1.txt"],
+            )
+        # The server ignored `-R`
+        lines = LS_LINES.split("\n\n")[0].splitlines()
+        self.assertEqual(len(TreeSnapshot.from_ls_lines(lines, "/root", now=NOW)), 0)
+
+    def test_time_offset(self):
+        snapshot = TreeSnapshot.from_ls_lines(LS_LINES.splitlines(), "/root", now=NOW)
+        # The server lists UTC+9 (JST)
+        jst = 9 * 3600
+        mlsd_entries = [
+            (
+                ".pyftpsync-meta.json",
+                "file",
+                809,
+                timegm((2024, 2, 29, 1, 30, 17)),
+                None,
+            ),
+            ("sub dir", "dir", 4096, timegm((2013, 12, 31, 15, 0, 0)), None),
+            ("file1.txt", "file", 6, timegm((2023, 12, 24, 9, 0, 59)), None),
+        ]
+        self.assertEqual(
+            estimate_time_offset(snapshot.root_entries, mlsd_entries, NOW), -jst
+        )
+        # Only old files
+        self.assertIsNone(
+            estimate_time_offset(snapshot.root_entries, mlsd_entries, NOW + 1e8)
+        )
+        snapshot.shift_times(-jst)
+        self.assertEqual(
+            snapshot.dirs["/root/sub dir"][1][3], timegm((2014, 1, 1, 0, 0, 0)) - jst
+        )
+
+    def test_from_find_output(self):
+        expected = {
+            "/root": [
+                ("file1.txt", "file", 6, 1388577600, None),
+                ("sub dir", "dir", 4096, 1388577600, None),
+            ],
+            "/root/sub dir": [
+                ("a b.txt", "file", 7, 1388577601, None),
+                ("link", "file", 9, 1388577600, None),
+                ("empty", "dir", 4096, 1388577600, None),
+                ("Gr\xfc\xdfe.txt", "file", 3, 1388577600, None),
+            ],
+            "/root/sub dir/empty": [],
+        }
+        for size in (1, 7, len(FIND_OUTPUT)):
+            chunks = [
+                FIND_OUTPUT[i : i + size] for i in range(0, len(FIND_OUTPUT), size)
+            ]
+            snapshot = TreeSnapshot.from_find_output(chunks, "/root/")
+            self.assertDictEqual(snapshot.dirs, expected)
+        # An empty tree
+        snapshot = TreeSnapshot.from_find_output([], "/root")
+        self.assertDictEqual(snapshot.dirs, {"/root": []})
+        with self.assertRaises(ValueError):
+            TreeSnapshot.from_find_output([b"f 6 x\0"], "/root")
+
+    def test_invalidate(self):
+        snapshot = TreeSnapshot.from_ls_lines(LS_LINES.splitlines(), "/root", now=NOW)
+        snapshot.invalidate("/root", "file1.txt")
+        self.assertEqual(len(snapshot), 2)
+        snapshot.invalidate("/root", "sub dir")
+        self.assertEqual(len(snapshot), 0)
+        self.assertIsNone(snapshot.pop("/root/sub dir"))
+
+
+# ===============================================================================
+# FtpTreeListingTest
+# ===============================================================================
+class FtpTreeListingTest(_SyncTestBase):
+    """Test `--list-tree` (requires an FTP server that supports `LIST -R`)."""
+
+    use_ftp_target = True
+
+    def setUp(self):
+        super().setUp()
+        self._commands = FTPTarget.TREE_LIST_COMMANDS
+
+    def tearDown(self):
+        FTPTarget.TREE_LIST_COMMANDS = self._commands
+        super().tearDown()
+
+    def _walk(self, opts):
+        remote = self._make_remote_target()
+        remote.extra_opts = opts
+        remote.open()
+        try:
+            snapshot = remote.tree_snapshot
+            res = sorted(
+                (e.get_rel_path(), e.is_dir(), e.size, e.mtime) for e in remote.walk()
+            )
+            return res, snapshot
+        finally:
+            remote.close()
+
+    def test_walk(self):
+        expected, snapshot = self._walk({})
+        self.assertIsNone(snapshot)
+        for commands in (("LIST -R",), ("STAT -R",)):
+            FTPTarget.TREE_LIST_COMMANDS = commands
+            entries, snapshot = self._walk({"list_tree": True})
+            self.assertEqual(len(snapshot), 0)  # All listings were used
+            # Files have metadata, but directory times are truncated
+            self.assertListEqual(
+                [e for e in entries if not e[1]], [e for e in expected if not e[1]]
+            )
+            self.assertListEqual([e[:3] for e in entries], [e[:3] for e in expected])
+
+    def test_sync(self):
+        opts = {"verbose": self.verbose, "resolve": "local", "list_tree": True}
+        stats_1 = self._sync_test_folders(BiDirSynchronizer, opts)
+        self.assertGreaterEqual(stats_1["tree_listing_hits"], 7)
+        self.assertEqual(stats_1["files_written"], 0)
+        self.assertEqual(stats_1["conflict_files"], 0)
+
+        stats_2 = self._sync_test_folders(
+            BiDirSynchronizer, dict(opts, list_tree=False)
+        )
+        self.assertNotIn("tree_listing_hits", stats_2)
+        for name in _TIMING_STATS | {"tree_listing_hits"}:
+            stats_1.pop(name, None)
+            stats_2.pop(name, None)
+        self.assertDictEqual(stats_1, stats_2)
+
+    def test_modified(self):
+        opts = {"verbose": self.verbose, "resolve": "local"}
+        stats_1 = self.do_run_suite(BiDirSynchronizer, opts)
+        local_1 = get_test_folder("local")
+        remote_1 = get_test_folder("remote")
+
+        self._prepare_initial_synced_fixture()
+        stats_2 = self.do_run_suite(BiDirSynchronizer, dict(opts, list_tree=True))
+        self.assertGreaterEqual(stats_2["tree_listing_hits"], 1)
+        self.assert_test_folder_equal(get_test_folder("local"), local_1)
+        self.assert_test_folder_equal(get_test_folder("remote"), remote_1)
+        for name in _TIMING_STATS | {"tree_listing_hits"}:
+            stats_1.pop(name, None)
+            stats_2.pop(name, None)
+        self.assertDictEqual(stats_1, stats_2)
+
+    def test_unsupported(self):
+        FTPTarget.TREE_LIST_COMMANDS = ("LIST -X",)
+        opts = {"verbose": self.verbose, "resolve": "local", "list_tree": True}
+        stats = self._sync_test_folders(BiDirSynchronizer, opts)
+        self.assertNotIn("tree_listing_hits", stats)
+        self.assertEqual(stats["files_written"], 0)
+        self.assertEqual(stats["conflict_files"], 0)
+
+
+class FtpTreeListingTimeZoneTest(_SyncTestBase):
+    """`LIST -R` listings in the server's local time (UTC+9)."""
+
+    def setUp(self):
+        super().setUp()
+        self._tz = os.environ.get("TZ")
+        os.environ["TZ"] = "Etc/GMT-9"
+        time.tzset()
+        self.server = FTPServerThread()
+        self.url = self.server.add_server(
+            os.path.join(PYFTPSYNC_TEST_FOLDER, "remote"), LocalTimeListHandler
+        )
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+        if self._tz is None:
+            os.environ.pop("TZ", None)
+        else:
+            os.environ["TZ"] = self._tz
+        time.tzset()
+        super().tearDown()
+
+    def test_sync(self):
+        self._prepare_initial_local_fixture()
+        opts = {"verbose": self.verbose, "resolve": "local"}
+        stats = self._sync_test_folders(
+            BiDirSynchronizer, opts, remote=make_target(self.url)
+        )
+        self.assertEqual(stats["files_written"], 16)
+
+        # The uploaded files keep their metadata
+        opts["list_tree"] = True
+        stats = self._sync_test_folders(
+            BiDirSynchronizer, opts, remote=make_target(self.url)
+        )
+        self.assertGreaterEqual(stats["tree_listing_hits"], 7)
+        self.assertEqual(stats["files_written"], 0)
+        self.assertEqual(stats["conflict_files"], 0)
+
+
+# ===============================================================================
+# SftpTreeListingTest
+# ===============================================================================
+class SftpTreeListingTest(SftpTargetMixin, _SyncTestBase):
+    """Test `--list-tree` with SFTP targets (using tests.sftp_server)."""
+
+    def _walk(self, opts):
+        remote = self._make_remote_target()
+        remote.extra_opts.update(opts)
+        remote.open()
+        try:
+            snapshot = remote.tree_snapshot
+            res = sorted(
+                (e.get_rel_path(), e.is_dir(), e.size, e.mtime) for e in remote.walk()
+            )
+            return res, snapshot
+        finally:
+            remote.close()
+
+    def test_walk(self):
+        expected, snapshot = self._walk({})
+        self.assertIsNone(snapshot)
+        entries, snapshot = self._walk({"list_tree": True})
+        if self.sftp_allow_exec:
+            self.assertEqual(len(snapshot), 0)  # All listings were used
+        else:
+            self.assertIsNone(snapshot)
+        self.assertListEqual(entries, expected)
+
+    def test_sync(self):
+        opts = {"verbose": self.verbose, "resolve": "local", "list_tree": True}
+        stats_1 = self._sync_test_folders(BiDirSynchronizer, opts)
+        if self.sftp_allow_exec:
+            self.assertGreaterEqual(stats_1["tree_listing_hits"], 7)
+        else:
+            self.assertNotIn("tree_listing_hits", stats_1)
+        self.assertEqual(stats_1["files_written"], 0)
+        self.assertEqual(stats_1["conflict_files"], 0)
+
+        stats_2 = self._sync_test_folders(
+            BiDirSynchronizer, dict(opts, list_tree=False)
+        )
+        self.assertNotIn("tree_listing_hits", stats_2)
+        for name in _TIMING_STATS | {"tree_listing_hits"}:
+            stats_1.pop(name, None)
+            stats_2.pop(name, None)
+        self.assertDictEqual(stats_1, stats_2)
+
+    def test_modified(self):
+        opts = {"verbose": self.verbose, "resolve": "local", "list_tree": True}
+        write_test_file("local/folder1/file1_1.txt", content="local 1")
+        remove_test_file("local/folder2/file2_1.txt")
+        stats = self._sync_test_folders(BiDirSynchronizer, opts)
+        self.assertEqual(stats["files_written"], 1)
+        self.assertEqual(stats["upload_files_written"], 1)
+        self.assertEqual(read_test_file("remote/folder1/file1_1.txt"), "local 1")
+        self.assertFalse(is_test_file("remote/folder2/file2_1.txt"))
+
+        stats = self._sync_test_folders(BiDirSynchronizer, opts)
+        self.assertEqual(stats["files_written"], 0)
+        self.assertEqual(stats["conflict_files"], 0)
+
+
+class SftpNoExecTreeListingTest(SftpTreeListingTest):
+    """`--list-tree` falls back to SFTP listings if commands are not allowed."""
+
+    sftp_allow_exec = False
+
+
+# ===============================================================================
+# Main
+# ===============================================================================
+if __name__ == "__main__":
+    unittest.main()
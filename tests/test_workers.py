@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for pyftpsync
+"""
+# Allow long lines for readabilty
+# flake8: noqa: E501
+import os
+import threading
+import time
+import unittest
+
+from ftpsync.resources import FileEntry
+from ftpsync.synchronizers import (
+    BiDirSynchronizer,
+    DownloadSynchronizer,
+    UploadSynchronizer,
+)
+from ftpsync.targets import FsTarget, make_target
+from ftpsync.util import format_duration
+from ftpsync.workers import StreamPipe, TransferWorkerPool
+from tests.fixture_tools import (
+    PYFTPSYNC_TEST_FOLDER,
+    _SyncTestBase,
+    get_test_folder,
+    write_test_file,
+)
+from tests.ftp_server import FTPServerThread
+
+#: Stats that depend on timing and are ignored for comparisons
+_TIMING_STATS = {
+    "elap_secs",
+    "elap_str",
+    "local_list_time",
+    "meta_bytes_read",
+    "max_file_rate",
+    "max_file_rate_str",
+    "meta_bytes_written",
+    "min_file_rate",
+    "min_file_rate_str",
+    "prefetched_dirs",
+    "remote_list_time",
+    "download_rate_str",
+    "download_write_time",
+    "upload_rate_str",
+    "upload_write_time",
+    "write_time",
+}
+
+
+# ===============================================================================
+# WorkerPoolTest
+# ===============================================================================
+class WorkerPoolTest(_SyncTestBase):
+    """Test that `--workers` produces the same results as the serial synchronizer."""
+
+    def setUp(self):
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+
+    def _run_serial_and_parallel(self, synchronizer_class, opts, parallel_opts=None):
+        stats_1 = self.do_run_suite(synchronizer_class, opts)
+        local_1 = get_test_folder("local")
+        remote_1 = get_test_folder("remote")
+
+        self._prepare_initial_synced_fixture()
+
+        opts = dict(opts, **(parallel_opts or {"workers": 4}))
+        stats_2 = self.do_run_suite(synchronizer_class, opts)
+        local_2 = get_test_folder("local")
+        remote_2 = get_test_folder("remote")
+
+        self.assert_test_folder_equal(local_1, local_2)
+        self.assert_test_folder_equal(remote_1, remote_2)
+        for name in _TIMING_STATS:
+            stats_1.pop(name, None)
+            stats_2.pop(name, None)
+        self.assertDictEqual(stats_1, stats_2)
+
+    def test_bidir(self):
+        opts = {"verbose": self.verbose, "resolve": "local"}
+        self._run_serial_and_parallel(BiDirSynchronizer, opts)
+
+    def test_upload_delete(self):
+        opts = {"verbose": self.verbose, "resolve": "local", "delete": True}
+        self._run_serial_and_parallel(UploadSynchronizer, opts)
+
+    def test_download_delete(self):
+        opts = {"verbose": self.verbose, "resolve": "remote", "delete": True}
+        self._run_serial_and_parallel(DownloadSynchronizer, opts)
+
+    def test_prefetch(self):
+        opts = {"verbose": self.verbose, "resolve": "local"}
+        self._run_serial_and_parallel(
+            BiDirSynchronizer, opts, {"prefetch": True, "workers": 2}
+        )
+        self._prepare_initial_synced_fixture()
+        self._prepare_modified_fixture()
+        stats = self._sync_test_folders(
+            BiDirSynchronizer, {"resolve": "local", "prefetch": True}
+        )
+        # Sub folders that exist on both sides are listed in the background
+        self.assertGreater(stats["prefetched_dirs"], 0)
+
+    def test_listing_times(self):
+        """Local and remote targets are listed concurrently and timed separately."""
+        stats = self.do_run_suite(BiDirSynchronizer, {"resolve": "local"})
+        self.assertGreater(stats["local_list_time"], 0)
+        self.assertGreater(stats["remote_list_time"], 0)
+
+    def test_initial_copy(self):
+        """Recursive copy of new folders uses the workers as well."""
+        self._prepare_initial_local_fixture()
+        stats = self._sync_test_folders(BiDirSynchronizer, {"workers": 3})
+        self.assertEqual(stats["files_written"], 16)
+        self.assertEqual(stats["dirs_created"], 7)
+        self.assert_test_folder_equal(
+            get_test_folder("remote"), _SyncTestBase.local_fixture_unmodified
+        )
+
+    def test_max_connections(self):
+        local = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "local"))
+        s = BiDirSynchronizer(local, local, {"workers": 8, "max_connections": 3})
+        local.synchronizer = s
+        # File system targets have no connection limit
+        self.assertEqual(s._get_worker_count(), 8)
+        local.host = "example.com"
+        self.assertEqual(s._get_worker_count(), 2)
+
+    def test_transfer_order(self):
+        opts = {"verbose": self.verbose, "resolve": "local"}
+        self._run_serial_and_parallel(
+            BiDirSynchronizer,
+            opts,
+            {
+                "workers": 3,
+                "transfer_order": "largest",
+                "large_file_size": 12,
+                "large_file_workers": 1,
+            },
+        )
+
+    def _make_pool(self, workers, **kwargs):
+        local = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "local"))
+        s = BiDirSynchronizer(local, local, {"workers": workers})
+        return TransferWorkerPool(s, workers, **kwargs)
+
+    def test_scheduler_order(self):
+        pool = self._make_pool(1, order="smallest")
+        started = []
+        for name, size in (("b", 200), ("a", 10), ("c", 3000), ("d", 10)):
+            entry = FileEntry(None, "", name, size, 0, None)
+            pool.submit(started.append, name, entry=entry)
+        # Jobs are held back until join()
+        self.assertEqual(started, [])
+        self.assertEqual(pool.bytes_submitted, 3220)
+        pool.join()
+        pool.close()
+        self.assertEqual(started, ["a", "d", "b", "c"])
+
+    def test_large_file_lane(self):
+        pool = self._make_pool(2, large_file_size=1000, large_workers=1)
+        small_done = threading.Event()
+        started = []
+
+        def _large():
+            # Small files are transferred while the large file is in progress
+            return small_done.wait(5)
+
+        def _small(name):
+            started.append(name)
+            if len(started) == 3:
+                small_done.set()
+
+        results = []
+        pool.submit(
+            _large,
+            callback=results.append,
+            entry=FileEntry(None, "", "large", 5000, 0, None),
+        )
+        for name in ("s1", "s2", "s3"):
+            pool.submit(_small, name, entry=FileEntry(None, "", name, 10, 0, None))
+        pool.join()
+        pool.close()
+        self.assertEqual(results, [True])
+        self.assertEqual(len(started), 3)
+
+    def test_eta(self):
+        local = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "local"))
+        s = BiDirSynchronizer(local, local, {"workers": 2})
+        self.assertIsNone(s._get_eta())
+        s._pool = TransferWorkerPool(s, 1)
+        try:
+            s._transfer_start = time.monotonic() - 10
+            s._expected_bytes = 1000
+            s._stats["upload_bytes_written"] = 250
+            self.assertAlmostEqual(s._get_eta(), 30, delta=1)
+        finally:
+            s._pool.close()
+            s._pool = None
+        self.assertEqual(format_duration(3725.4), "1:02:05")
+
+
+class FtpWorkerPoolTest(WorkerPoolTest):
+    """Run the WorkerPoolTest tests against an FTP server."""
+
+    use_ftp_target = True
+
+
+class _PipeTarget:
+    """Minimal source / destination for StreamPipe.copy()."""
+
+    def __init__(self, data=b"", fail_at=None):
+        self.data = data
+        self.fail_at = fail_at
+        self.written = bytearray()
+        #: Largest number of bytes that were buffered by the pipe
+        self.max_buffered = 0
+
+    def copy_to_file(self, name, fp_dest, callback=None, offset=0):
+        for i in range(offset, len(self.data), 1000):
+            if self.fail_at is not None and i >= self.fail_at:
+                raise OSError("Download failed")
+            fp_dest.write(self.data[i : i + 1000])
+
+    def write_file(self, name, fp_src, blocksize=8192, callback=None, offset=0):
+        while True:
+            self.max_buffered = max(self.max_buffered, fp_src._size)
+            data = fp_src.read(blocksize)
+            if not data:
+                break
+            if self.fail_at is not None and len(self.written) >= self.fail_at:
+                raise OSError("Upload failed")
+            self.written += data
+            if callback:
+                callback(data)
+            time.sleep(0.0001)
+
+
+# ===============================================================================
+# StreamPipeTest
+# ===============================================================================
+class StreamPipeTest(unittest.TestCase):
+    """Test StreamPipe (remote to remote copies)."""
+
+    def setUp(self):
+        self._max_size = StreamPipe.DEFAULT_MAX_SIZE
+        StreamPipe.DEFAULT_MAX_SIZE = 20_000
+
+    def tearDown(self):
+        StreamPipe.DEFAULT_MAX_SIZE = self._max_size
+
+    def test_copy(self):
+        data = os.urandom(500_000)
+        src, dest = _PipeTarget(data), _PipeTarget()
+        chunks = []
+        StreamPipe.copy(src, "a", dest, "b", callback=chunks.append)
+        self.assertEqual(dest.written, data)
+        self.assertEqual(sum(map(len, chunks)), len(data))
+        self.assertLessEqual(dest.max_buffered, 20_000 + 1000)
+
+        dest = _PipeTarget()
+        StreamPipe.copy(src, "a", dest, "b", offset=123_456)
+        self.assertEqual(dest.written, data[123_456:])
+
+    def test_errors(self):
+        data = os.urandom(500_000)
+        with self.assertRaisesRegex(OSError, "Download failed"):
+            StreamPipe.copy(_PipeTarget(data, fail_at=100_000), "a", _PipeTarget(), "b")
+        # The download is stopped if the upload fails
+        with self.assertRaisesRegex(OSError, "Upload failed"):
+            StreamPipe.copy(_PipeTarget(data), "a", _PipeTarget(fail_at=100_000), "b")
+
+    def test_read(self):
+        pipe = StreamPipe()
+        pipe.write(b"abc")
+        pipe.write(b"def")
+        self.assertEqual(pipe.read(2), b"ab")
+        self.assertEqual(pipe.read(0), b"")
+        pipe.close_write()
+        self.assertEqual(pipe.read(), b"cdef")
+        self.assertEqual(pipe.read(10), b"")
+        pipe.abort()
+        with self.assertRaises(BrokenPipeError):
+            pipe.write(b"x")
+
+
+class FtpStreamPipeTest(_SyncTestBase):
+    """The FTP source stays usable if the upload of a pipe copy fails."""
+
+    def setUp(self):
+        super().setUp()
+        write_test_file("remote/big.txt", size=20_000_000)
+        self._max_size = StreamPipe.DEFAULT_MAX_SIZE
+        StreamPipe.DEFAULT_MAX_SIZE = 20_000
+        self.server = FTPServerThread()
+        self.url = self.server.add_server(os.path.join(PYFTPSYNC_TEST_FOLDER, "remote"))
+        self.server.start()
+        self.remote = make_target(self.url)
+        self.remote.open()
+
+    def tearDown(self):
+        self.remote.close()
+        self.server.stop()
+        StreamPipe.DEFAULT_MAX_SIZE = self._max_size
+        super().tearDown()
+
+    def test_upload_fails(self):
+        dest = _PipeTarget(fail_at=100_000)
+        with self.assertRaisesRegex(OSError, "Upload failed"):
+            StreamPipe.copy(self.remote, "big.txt", dest, "b")
+        # The control connection is in sync
+        self.assertEqual(self.remote.ftp.pwd(), "/")
+        dest = _PipeTarget()
+        StreamPipe.copy(self.remote, "big.txt", dest, "b")
+        self.assertEqual(len(dest.written), 20_000_000)
+
+
+# ===============================================================================
+# Main
+# ===============================================================================
+if __name__ == "__main__":
+    unittest.main()